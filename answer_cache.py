@@ -0,0 +1,175 @@
+"""
+Semantic answer cache.
+Many board-exam questions are near-duplicates, so final formatted answers are
+stored with their question embedding. A new question whose embedding has
+cosine similarity >= ANSWER_CACHE_THRESHOLD with a cached one, and the same
+numbers, variables and operators, gets the stored answer, skipping Supabase
+and the LLM entirely.
+Off by default: "solve 2x+3=7" and "solve 2x+5=7" embed far above any
+useful threshold, so the math check is what keeps one student from getting
+another's worked answer. Turn it on only with that in mind.
+"""
+import hashlib
+import os
+import re
+import time
+import unicodedata
+import numpy as np
+from prompts import ANSWER_PROMPT
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "0") == "1"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "2000"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.98"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600)))
+
+# Numbers, words and operator symbols of a normalized question
+_MATH_TOKEN = re.compile(r"\d+(?:\.\d+)?|[^\W\d_]+|[+\-*/^=<>%×÷·−√π∫∑]")
+
+
+def answer_fingerprint(provider, model, prompt=ANSWER_PROMPT):
+    """
+    Identify everything that shapes an answer (the full prompt layout,
+    instructions and input template). A change means cached answers are stale.
+    """
+    raw = f"{provider}\0{model}\0{prompt}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def math_signature(question):
+    """
+    The numbers, single-letter variables and operators of a question, in
+    order. Two questions may share an answer only if these are equal.
+    """
+    text = unicodedata.normalize("NFKC", question or "").lower()
+    tokens = _MATH_TOKEN.findall(text)
+    # Longer words are prose ("solve", "find"), which the embedding already compares
+    return tuple(token for token in tokens if not token.isalpha() or len(token) == 1)
+
+
+class SemanticAnswerCache:
+    """
+    Fixed-capacity store of (unit-norm embedding, math signature, answer) entries.
+    Embeddings live in one contiguous float32 matrix so a lookup is a single
+    matrix-vector product. When full, the least recently used entry is evicted.
+    """
+
+    def __init__(self, max_size=ANSWER_CACHE_SIZE, threshold=ANSWER_CACHE_THRESHOLD,
+                 ttl=ANSWER_CACHE_TTL, fingerprint=None):
+        self.max_size = max(1, max_size)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0  # close enough to hit, but different numbers or variables
+        self.invalidations = 0
+        self._reset()
+
+    def _reset(self):
+        self._matrix = None  # allocated on first add, once the dimension is known
+        self._answers = [None] * self.max_size
+        self._signatures = [None] * self.max_size
+        self._last_used = np.zeros(self.max_size, dtype=np.float64)
+        self._expires = np.zeros(self.max_size, dtype=np.float64)
+        self._count = 0
+
+    def check_fingerprint(self, fingerprint):
+        """
+        Drop every entry if the prompt or model changed since they were cached.
+        """
+        if fingerprint != self.fingerprint:
+            if self._count:
+                self.invalidations += 1
+                print(f"Answer cache invalidated ({self._count} entries)")
+            self._reset()
+            self.fingerprint = fingerprint
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding, question=None):
+        """
+        Return the cached answer for the closest question above the threshold
+        with the same math signature as `question`, or None.
+        """
+        if not self._count or self._matrix is None or len(embedding) != self._matrix.shape[1]:
+            self.misses += 1
+            return None
+
+        now = time.time()
+        scores = self._matrix[:self._count] @ self._normalize(embedding)
+        scores[self._expires[:self._count] < now] = -1.0
+        # Above the threshold is not enough: the numbers and variables must match too
+        signature = math_signature(question)
+        candidates = [slot for slot in np.flatnonzero(scores >= self.threshold)
+                      if self._signatures[slot] == signature]
+        if not candidates:
+            if scores.max() >= self.threshold:
+                self.mismatches += 1
+            self.misses += 1
+            return None
+        best = int(max(candidates, key=lambda slot: scores[slot]))
+
+        self.hits += 1
+        self._last_used[best] = now
+        return self._answers[best]
+
+    def add(self, embedding, answer, question=None):
+        vector = self._normalize(embedding)
+        if self._matrix is None or self._matrix.shape[1] != len(vector):
+            self._reset()
+            self._matrix = np.zeros((self.max_size, len(vector)), dtype=np.float32)
+
+        now = time.time()
+        if self._count < self.max_size:
+            slot = self._count
+            self._count += 1
+        else:
+            # Expired entries go first, then the least recently used one
+            last_used = np.where(self._expires < now, -1.0, self._last_used)
+            slot = int(np.argmin(last_used))
+
+        self._matrix[slot] = vector
+        self._answers[slot] = answer
+        self._signatures[slot] = math_signature(question)
+        self._last_used[slot] = now
+        self._expires[slot] = now + self.ttl
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": self._count,
+            "max_size": self.max_size,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "math_mismatches": self.mismatches,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+# One cache per AI provider, since embedding spaces differ between providers
+_caches = {}
+
+
+def get_answer_cache(provider, model):
+    """
+    Return the answer cache for a provider, invalidated if its model or prompt changed.
+    Returns None when ANSWER_CACHE_ENABLED is off.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    cache = _caches.get(provider)
+    if cache is None:
+        cache = SemanticAnswerCache()
+        _caches[provider] = cache
+    cache.check_fingerprint(answer_fingerprint(provider, model))
+    return cache
+
+
+def answer_cache_stats():
+    return {provider: cache.stats() for provider, cache in _caches.items()}
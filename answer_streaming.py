@@ -0,0 +1,146 @@
+"""
+Progressive delivery of streamed LLM answers.
+Tokens from the provider stream go through the incremental WhatsApp formatter,
+and its finished lines are collected into sections (split at a blank line once
+a section is long enough). Each section is sent as its own WhatsApp message
+while the model is still writing the rest.
+"""
+import asyncio
+import os
+import time
+from markdown_formatter import StreamingFormatter
+
+ANSWER_STREAMING = os.getenv("ANSWER_STREAMING", "0") == "1"
+# Sections shorter than this are merged with the next one, to avoid a flood of tiny messages
+STREAM_MIN_SECTION_CHARS = int(os.getenv("STREAM_MIN_SECTION_CHARS", "400"))
+
+_stats = {
+    "answers": 0,
+    "messages": 0,
+    "first_token_s_total": 0.0,
+    "first_chunk_s_total": 0.0,
+    "last_chunk_s_total": 0.0,
+    "first_chunk_s_max": 0.0,
+}
+
+
+class SectionSplitter:
+    """
+    Groups formatted lines into sections. Headers and lists are always preceded
+    by a blank line in the formatted output, so splitting only at blank lines
+    keeps them intact and "\n\n".join(sections) is the whole formatted answer.
+    """
+
+    def __init__(self, min_chars=STREAM_MIN_SECTION_CHARS):
+        self.min_chars = min_chars
+        self._section = []
+        self._section_len = 0
+
+    def _flush(self):
+        section = "\n".join(self._section)
+        self._section = []
+        self._section_len = 0
+        return section
+
+    def feed(self, lines):
+        """
+        Add formatted lines, return the list of sections completed by them.
+        """
+        sections = []
+        for line in lines:
+            if not line:
+                if self._section_len >= self.min_chars:
+                    sections.append(self._flush())
+                    continue
+                if not self._section:
+                    continue
+            self._section.append(line)
+            self._section_len += len(line) + 1
+        return sections
+
+    def close(self):
+        """
+        Return whatever is left once the stream has ended.
+        """
+        section = self._flush()
+        return [section] if section else []
+
+
+async def stream_answer(token_stream, send_formatted, min_chars=STREAM_MIN_SECTION_CHARS):
+    """
+    Consume an async iterator of text deltas and send each finished section
+    via `await send_formatted(text)`. Sends run in order in a separate task,
+    so reading the model stream never waits on WhatsApp.
+    Returns (raw_answer, formatted_sections).
+    """
+    started = time.monotonic()
+    formatter = StreamingFormatter()
+    splitter = SectionSplitter(min_chars)
+    outbox = asyncio.Queue()
+    raw_parts = []
+    formatted_sections = []
+    timings = {}
+
+    async def sender():
+        while True:
+            section = await outbox.get()
+            if section is None:
+                return
+            await send_formatted(section)
+            now = time.monotonic() - started
+            timings.setdefault("first_chunk", now)
+            timings["last_chunk"] = now
+
+    def enqueue(sections):
+        for section in sections:
+            formatted_sections.append(section)
+            outbox.put_nowait(section)
+
+    sender_task = asyncio.create_task(sender())
+    try:
+        async for delta in token_stream:
+            if not delta:
+                continue
+            timings.setdefault("first_token", time.monotonic() - started)
+            raw_parts.append(delta)
+            enqueue(splitter.feed(formatter.feed(delta)))
+        enqueue(splitter.feed(formatter.close()) + splitter.close())
+    finally:
+        outbox.put_nowait(None)
+        await sender_task
+
+    _record(timings, len(formatted_sections))
+    print(f"Streamed answer in {len(formatted_sections)} messages: "
+          f"first token {timings.get('first_token', 0):.2f}s, "
+          f"first chunk {timings.get('first_chunk', 0):.2f}s, "
+          f"last chunk {timings.get('last_chunk', 0):.2f}s")
+    return "".join(raw_parts).strip(), formatted_sections
+
+
+def _record(timings, messages):
+    if not messages:
+        return
+    _stats["answers"] += 1
+    _stats["messages"] += messages
+    _stats["first_token_s_total"] += timings.get("first_token", 0.0)
+    _stats["first_chunk_s_total"] += timings.get("first_chunk", 0.0)
+    _stats["last_chunk_s_total"] += timings.get("last_chunk", 0.0)
+    _stats["first_chunk_s_max"] = max(_stats["first_chunk_s_max"], timings.get("first_chunk", 0.0))
+
+
+def streaming_stats():
+    """
+    Average time to first token, first chunk and last chunk sent, in seconds.
+    """
+    answers = _stats["answers"]
+    if not answers:
+        return {"enabled": ANSWER_STREAMING, "answers": 0}
+    return {
+        "enabled": ANSWER_STREAMING,
+        "answers": answers,
+        "messages_per_answer": round(_stats["messages"] / answers, 2),
+        "time_to_first_token_avg_s": round(_stats["first_token_s_total"] / answers, 3),
+        "time_to_first_chunk_avg_s": round(_stats["first_chunk_s_total"] / answers, 3),
+        "time_to_first_chunk_max_s": round(_stats["first_chunk_s_max"], 3),
+        "time_to_last_chunk_avg_s": round(_stats["last_chunk_s_total"] / answers, 3),
+    }
@@ -0,0 +1,211 @@
+"""
+Retrieval quality and latency of hybrid (BM25 + vector, RRF) vs. vector-only.
+Each query is built from one chunk and that chunk is the relevant answer;
+reports recall@k and MRR for vector-only, BM25-only and fused rankings,
+and the per-query latency of the BM25 lookup and of the fusion.
+
+The default synthetic corpus mimics textbook chunks: each belongs to a
+topic (shared vocabulary) and names a few rare terms, like chapter terms
+and formula names. Questions paraphrase the topic with synonyms and name
+one rare term. Embeddings are bags of hashed token vectors that treat
+synonyms alike, so, as with real embeddings, they find the topic but the
+rare term is only a few tokens among many; BM25 matches the rare term but
+misses the synonyms. With --index, queries are word windows from real
+chunks, embedded with the OpenAI embedding model (needs OPENAI_API_KEY).
+
+Usage:
+    python benchmarks/bench_hybrid.py
+    python benchmarks/bench_hybrid.py --index rag_index --queries 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import zlib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bm25 import BM25Index, rrf_fuse  # noqa: E402
+from local_index import LocalIndexWriter, LocalVectorIndex, normalize_rows  # noqa: E402
+
+# Weight of a rare term in a synthetic embedding, relative to a topic word
+RARE_TERM_WEIGHT = 3.0
+
+
+def _token_vector(token, dimensions):
+    # Synonyms ("v12" for "w12") embed identically but don't match lexically
+    if token.startswith("v"):
+        token = "w" + token[1:]
+    rng = np.random.default_rng(zlib.crc32(token.encode("utf-8")))
+    return rng.standard_normal(dimensions).astype(np.float32)
+
+
+def synthetic_embed(texts, rare, dimensions):
+    vectors = np.zeros((len(texts), dimensions), dtype=np.float32)
+    cache = {}
+    for i, text in enumerate(texts):
+        for token in text.split():
+            vector = cache.get(token)
+            if vector is None:
+                vector = cache[token] = _token_vector(token, dimensions)
+            vectors[i] += vector * (RARE_TERM_WEIGHT if token in rare else 1.0)
+    return normalize_rows(vectors)
+
+
+def synthetic_corpus(count, topics, seed):
+    """
+    Returns (chunks, topic vocabulary of each chunk, rare terms of each
+    chunk, set of all rare terms).
+    """
+    rng = np.random.default_rng(seed)
+    common = [f"w{i}" for i in range(3000)]
+    topic_words = [[common[j] for j in rng.choice(len(common), 60, replace=False)] for _ in range(topics)]
+    # Each rare term turns up in a few dozen chunks, like a formula name used across a chapter
+    rare_pool = [f"term{i}" for i in range(max(1, count // 20))]
+    chunks = []
+    chunk_topics = []
+    chunk_rare = []
+    for _ in range(count):
+        topic = topic_words[rng.integers(topics)]
+        words = [topic[j] for j in rng.integers(0, len(topic), 80)]
+        terms = [rare_pool[j] for j in rng.choice(len(rare_pool), 3, replace=False)]
+        for term in terms:
+            words.insert(int(rng.integers(len(words))), term)
+        chunks.append(" ".join(words))
+        chunk_topics.append(topic)
+        chunk_rare.append(terms)
+    return chunks, chunk_topics, chunk_rare, set(rare_pool)
+
+
+def synthetic_queries(chunks, chunk_topics, chunk_rare, count, seed):
+    """
+    A question paraphrases its topic (mostly synonyms of the topic words)
+    and names one of the target chunk's rare terms. Every chunk of that
+    topic naming that term is relevant. Returns (queries, relevant id sets).
+    """
+    rng = np.random.default_rng(seed)
+    targets = rng.choice(len(chunks), count, replace=False)
+    by_term = {}
+    for i, terms in enumerate(chunk_rare):
+        for term in terms:
+            by_term.setdefault(term, []).append(i)
+    queries = []
+    relevant = []
+    for target in targets:
+        topic = chunk_topics[target]
+        words = [topic[j] for j in rng.choice(len(topic), 6, replace=False)]
+        words = ["v" + word[1:] if rng.random() < 0.7 else word for word in words]
+        term = str(rng.choice(chunk_rare[target]))
+        queries.append(" ".join(words + [term]))
+        relevant.append({i for i in by_term[term] if chunk_topics[i] is topic})
+    return queries, relevant
+
+
+def real_queries(chunks, count, seed):
+    rng = np.random.default_rng(seed)
+    candidates = [i for i, chunk in enumerate(chunks) if len(chunk.split()) >= 20]
+    targets = rng.choice(candidates, min(count, len(candidates)), replace=False)
+    queries = []
+    for target in targets:
+        words = chunks[target].split()
+        start = int(rng.integers(0, len(words) - 10))
+        queries.append(" ".join(words[start:start + 10]))
+    return queries, [{int(target)} for target in targets]
+
+
+def embed_queries_openai(queries):
+    from openai_utils import create_embeddings
+    return normalize_rows(np.asarray(create_embeddings(queries), dtype=np.float32))
+
+
+def quality(rankings, relevant, k):
+    """
+    Share of queries with a relevant chunk in the top k, and mean reciprocal
+    rank of the first relevant chunk.
+    """
+    hits = 0
+    reciprocal = 0.0
+    for ranking, wanted in zip(rankings, relevant):
+        ranks = [rank for rank, chunk_id in enumerate(ranking, start=1) if chunk_id in wanted]
+        if ranks and ranks[0] <= k:
+            hits += 1
+        if ranks:
+            reciprocal += 1.0 / ranks[0]
+    return hits / len(relevant), reciprocal / len(relevant)
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--index", help="existing index directory (default: build a synthetic one)")
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--candidates", type=int, default=20, help="results taken from each ranking before fusion")
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--rrf-k", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.index:
+        vector_index = LocalVectorIndex(args.index, dtype="float32")
+        chunks = vector_index.chunks
+        queries, relevant = real_queries(chunks, args.queries, args.seed)
+        print(f"Embedding {len(queries)} queries...")
+        query_vectors = embed_queries_openai(queries)
+    else:
+        path = tempfile.mkdtemp(prefix="bench_hybrid_")
+        print(f"Building synthetic corpus: {args.count} chunks, {args.topics} topics in {path}")
+        chunks, chunk_topics, chunk_rare, rare = synthetic_corpus(args.count, args.topics, args.seed)
+        writer = LocalIndexWriter(path, meta={"source": "synthetic"})
+        for start in range(0, len(chunks), 10000):
+            block = chunks[start:start + 10000]
+            writer.add(block, synthetic_embed(block, rare, args.dimensions))
+        writer.close(ivf=False)
+        vector_index = LocalVectorIndex(path, dtype="float32")
+        queries, relevant = synthetic_queries(chunks, chunk_topics, chunk_rare, args.queries, args.seed + 1)
+        query_vectors = synthetic_embed(queries, rare, args.dimensions)
+
+    start = time.perf_counter()
+    lexical_index = BM25Index.build(chunks)
+    print(f"BM25 build: {time.perf_counter() - start:.1f}s, {lexical_index.meta['terms']} terms, "
+          f"{lexical_index.meta['postings']} postings "
+          f"({(lexical_index.docs.nbytes + lexical_index.weights.nbytes) / 1e6:.1f} MB)")
+
+    vector_rankings, lexical_rankings, fused_rankings = [], [], []
+    vector_ms, lexical_ms, fusion_ms = [], [], []
+    for query, vector in zip(queries, query_vectors):
+        t0 = time.perf_counter()
+        vector_ranking = [chunk_id for chunk_id, _ in vector_index.search(vector, args.candidates)]
+        t1 = time.perf_counter()
+        lexical_ranking = [chunk_id for chunk_id, _ in lexical_index.search(query, args.candidates)]
+        t2 = time.perf_counter()
+        fused = rrf_fuse([vector_ranking, lexical_ranking], args.rrf_k)
+        t3 = time.perf_counter()
+        vector_rankings.append(vector_ranking)
+        lexical_rankings.append(lexical_ranking)
+        fused_rankings.append(fused)
+        vector_ms.append(1000 * (t1 - t0))
+        lexical_ms.append(1000 * (t2 - t1))
+        fusion_ms.append(1000 * (t3 - t2))
+
+    print(f"\n{'retrieval':<14}{f'recall@{args.k}':>11}{'MRR':>8}{'p50 ms':>9}{'p99 ms':>9}")
+    for label, rankings, ms in (
+        ("vector", vector_rankings, vector_ms),
+        ("bm25", lexical_rankings, lexical_ms),
+        ("hybrid (rrf)", fused_rankings, [a + b + c for a, b, c in zip(vector_ms, lexical_ms, fusion_ms)]),
+    ):
+        recall, mrr = quality(rankings, relevant, args.k)
+        print(f"{label:<14}{recall:>11.3f}{mrr:>8.3f}{percentile(ms, 50):>9.3f}{percentile(ms, 99):>9.3f}")
+    print(f"\nRRF fusion alone: p50 {percentile(fusion_ms, 50):.3f} ms, p99 {percentile(fusion_ms, 99):.3f} ms")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    main()
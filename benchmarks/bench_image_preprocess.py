@@ -0,0 +1,140 @@
+"""
+Image preprocessing before the vision call: old compress_image vs. preprocess_image.
+Reports output bytes, time per image and peak RSS growth. Each variant runs in
+a fresh process, so the RSS numbers don't include the other one's allocations.
+Without --images, a synthetic 12 MP phone-style JPEG (4000x3000, EXIF rotated)
+is used.
+
+Usage:
+    python benchmarks/bench_image_preprocess.py
+    python benchmarks/bench_image_preprocess.py --images photo1.jpg photo2.jpg --repeat 10
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from io import BytesIO
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+
+def compress_image_old(img_bytes, max_size=(1024, 1024), quality=85):
+    # openai_utils.compress_image before the shared preprocessing stage
+    from PIL import Image
+    try:
+        img = Image.open(BytesIO(img_bytes))
+        if img.mode == 'RGBA':
+            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+            rgb_img.paste(img, mask=img.split()[3])
+            img = rgb_img
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=quality, optimize=True)
+        return output.getvalue()
+    except Exception as e:
+        print(f"Image compression error: {e}, using original")
+        return img_bytes
+
+
+def synthetic_photo(width=4000, height=3000):
+    """
+    A photographed worksheet: off-white paper with lighting gradient, sensor
+    noise, dark handwriting-like strokes, and EXIF orientation 6 (portrait).
+    """
+    import numpy as np
+    from PIL import Image, ImageDraw
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    paper = 215 + 25 * (x / width) - 15 * (y / height)
+    pixels = np.stack([paper, paper - 4, paper - 12], axis=-1) + rng.normal(0, 6, (height, width, 3))
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    draw = ImageDraw.Draw(img)
+    for line in range(200, height - 200, 140):
+        px = 250
+        while px < width - 300:
+            length = int(rng.integers(40, 260))
+            draw.line([(px, line), (px + length, line + int(rng.integers(-20, 20)))], fill=(30, 35, 70), width=9)
+            px += length + int(rng.integers(30, 90))
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    output = BytesIO()
+    img.save(output, format="JPEG", quality=92, exif=exif)
+    return output.getvalue()
+
+
+def peak_rss_kb():
+    # VmHWM is reset by exec, unlike ru_maxrss which a spawned child inherits from its parent
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run(name, images, repeat, results):
+    # Runs in a fresh process, so the RSS peak is this variant's own
+    from PIL import Image  # noqa: F401
+    import image_preprocess
+    func = compress_image_old if name == "old" else image_preprocess.preprocess_image
+    rss_before = peak_rss_kb()
+    func(images[0])
+    sizes = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        sizes = [len(func(img)) for img in images]
+    elapsed = time.perf_counter() - start
+    rss_after = peak_rss_kb()
+    results.put({
+        "ms": 1000 * elapsed / (repeat * len(images)),
+        "bytes": sum(sizes) / len(sizes),
+        "peak_rss_mb": rss_after / 1024,
+        "rss_growth_mb": (rss_after - rss_before) / 1024,
+    })
+
+
+def measure(name, images, repeat):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_run, args=(name, images, repeat, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", nargs="*", help="image files to preprocess (default: synthetic 12 MP photo)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.images:
+        images = []
+        for path in args.images:
+            with open(path, "rb") as f:
+                images.append(f.read())
+    else:
+        images = [synthetic_photo()]
+    print(f"{len(images)} images, {sum(map(len, images)) / len(images) / 1024:.0f} KB average input\n")
+
+    old = measure("old", images, args.repeat)
+    new = measure("new", images, args.repeat)
+    rows = [
+        ("output KB", old["bytes"] / 1024, new["bytes"] / 1024),
+        ("ms per image", old["ms"], new["ms"]),
+        ("peak RSS MB", old["peak_rss_mb"], new["peak_rss_mb"]),
+        ("RSS growth MB", old["rss_growth_mb"], new["rss_growth_mb"]),
+    ]
+    print(f"{'':30} {'old':>9} {'new':>9}")
+    for label, old_value, new_value in rows:
+        print(f"{label:30} {old_value:9.1f} {new_value:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Per-answer speed of the compiled LaTeX converter vs. the old rule-by-rule one.
+Runs every answer in the corpus through both converters (per line, whole answer,
+and the full WhatsApp formatting pipeline), fails if any output differs, then
+times them.
+
+Usage:
+    python benchmarks/bench_latex_converter.py
+    python benchmarks/bench_latex_converter.py --corpus answers.jsonl --repeat 50
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+import latex_converter  # noqa: E402
+import latex_reference  # noqa: E402
+import markdown_formatter  # noqa: E402
+
+DEFAULT_CORPUS = os.path.join(BENCH_DIR, "data", "latex_answers.jsonl")
+
+
+def load_answers(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["answer"] for line in f if line.strip()]
+
+
+def format_with(module, answer):
+    # The formatter calls convert_math_expressions by name, so swap it in
+    original = markdown_formatter.convert_math_expressions
+    markdown_formatter.convert_math_expressions = module.convert_math_expressions
+    try:
+        return markdown_formatter.format_answer_for_whatsapp(answer)
+    finally:
+        markdown_formatter.convert_math_expressions = original
+
+
+def check(answers):
+    mismatches = 0
+    for number, answer in enumerate(answers, 1):
+        cases = [("line", line) for line in answer.split("\n")] + [("answer", answer)]
+        for kind, text in cases:
+            for name in ("latex_to_text", "convert_math_expressions"):
+                old = getattr(latex_reference, name)(text)
+                new = getattr(latex_converter, name)(text)
+                if old != new:
+                    mismatches += 1
+                    print(f"answer {number} {kind} {name}:\n  input {text!r}\n  old   {old!r}\n  new   {new!r}")
+        if format_with(latex_reference, answer) != format_with(latex_converter, answer):
+            mismatches += 1
+            print(f"answer {number}: format_answer_for_whatsapp output differs")
+    return mismatches
+
+
+def per_answer_ms(func, answers, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for answer in answers:
+            func(answer)
+    return 1000 * (time.perf_counter() - start) / (repeat * len(answers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="JSONL file with an \"answer\" field per line")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    answers = load_answers(args.corpus)
+    lines = sum(answer.count("\n") + 1 for answer in answers)
+    print(f"{len(answers)} answers, {lines} lines")
+
+    mismatches = check(answers)
+    if mismatches:
+        print(f"{mismatches} outputs differ from the old converter")
+        sys.exit(1)
+    print("Outputs identical to the old converter\n")
+
+    def lines_with(module):
+        return lambda answer: [module.convert_math_expressions(line) for line in answer.split("\n")]
+
+    benchmarks = [
+        ("convert_math_expressions per line", lines_with(latex_reference), lines_with(latex_converter)),
+        ("format_answer_for_whatsapp", lambda a: format_with(latex_reference, a), lambda a: format_with(latex_converter, a)),
+    ]
+    print(f"{'ms per answer':36} {'old':>8} {'new':>8} {'speed-up':>9}")
+    for label, old_func, new_func in benchmarks:
+        old_ms = per_answer_ms(old_func, answers, args.repeat)
+        new_ms = per_answer_ms(new_func, answers, args.repeat)
+        print(f"{label:36} {old_ms:8.3f} {new_ms:8.3f} {old_ms / new_ms:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
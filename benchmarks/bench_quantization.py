@@ -0,0 +1,90 @@
+"""
+Recall vs. memory benchmark for quantized local index storage.
+Compares float16 and int8 (with and without float32 re-rank) against exact
+float32 search, on an existing index or a synthetic clustered corpus.
+
+Usage:
+    python benchmarks/bench_quantization.py
+    python benchmarks/bench_quantization.py --index rag_index --queries 500
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from local_index import LocalIndexWriter, LocalVectorIndex, normalize_rows  # noqa: E402
+
+
+def synthetic_index(path, count, dimensions, topics, seed):
+    # Clustered vectors look more like real embeddings than pure noise
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dimensions)).astype(np.float32)
+    writer = LocalIndexWriter(path, meta={"source": "synthetic"})
+    for start in range(0, count, 10000):
+        size = min(10000, count - start)
+        block = centers[rng.integers(0, topics, size)] + 0.8 * rng.standard_normal((size, dimensions)).astype(np.float32)
+        writer.add([f"chunk {start + i}" for i in range(size)], block)
+    writer.close(ivf=False)
+
+
+def make_queries(index, count, seed):
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(len(index), count, replace=False)
+    base = np.asarray(index.embeddings[np.sort(ids)], dtype=np.float32)
+    return normalize_rows(base + 0.05 * rng.standard_normal(base.shape).astype(np.float32))
+
+
+def run(index, queries, k):
+    start = time.perf_counter()
+    results = [[chunk_id for chunk_id, _ in index.search(q, k)] for q in queries]
+    return results, 1000 * (time.perf_counter() - start) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--index", help="existing index directory (default: build a synthetic one)")
+    parser.add_argument("--count", type=int, default=50000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=400)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--rerank", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    path = args.index
+    if not path:
+        path = tempfile.mkdtemp(prefix="bench_quantization_")
+        print(f"Building synthetic index: {args.count} x {args.dimensions} in {path}")
+        synthetic_index(path, args.count, args.dimensions, args.topics, args.seed)
+
+    exact_index = LocalVectorIndex(path, dtype="float32")
+    queries = make_queries(exact_index, min(args.queries, len(exact_index)), args.seed + 1)
+    truth, exact_ms = run(exact_index, queries, args.k)
+    base_bytes = exact_index.vector_bytes()
+
+    configs = [
+        ("float32", "float32", 0),
+        ("float16", "float16", 0),
+        (f"float16 + rerank {args.rerank}", "float16", args.rerank),
+        ("int8", "int8", 0),
+        (f"int8 + rerank {args.rerank}", "int8", args.rerank),
+    ]
+    print(f"\n{'storage':<24}{'vector MB':>10}{'x smaller':>10}{f'recall@{args.k}':>11}{'ms/query':>10}")
+    for label, dtype, rerank in configs:
+        index = exact_index if dtype == "float32" else LocalVectorIndex(path, dtype=dtype, rerank=rerank)
+        results, ms = (truth, exact_ms) if index is exact_index else run(index, queries, args.k)
+        recall = np.mean([len(set(got) & set(want)) / len(want) for got, want in zip(results, truth)])
+        size = index.vector_bytes()
+        print(f"{label:<24}{size / 1e6:>10.1f}{base_bytes / size:>10.2f}{recall:>11.4f}{ms:>10.2f}")
+
+    if not args.index:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+"""
+Local stand-ins for every external service the app calls, for load tests.
+Serves the OpenAI chat (plain, streamed and vision) and embeddings APIs,
+the Supabase match_cbse_context RPC, the Graph API media and messages
+endpoints and the Twilio Messages API, each under its own path prefix.
+Every route sleeps for a latency drawn from a lognormal distribution and
+fails with a configurable probability, per service. Outgoing WhatsApp
+messages are recorded with a timestamp, so the load test can measure the
+time until a user gets a reply (GET /_events).
+
+Gemini is not faked: the google-generativeai SDK only honours a custom
+endpoint on its sync REST transport, and the app uses the async calls.
+
+Usage (normally started by load_test.py):
+    python benchmarks/fake_providers.py --port 8901 --profile profile.json
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+from io import BytesIO
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Per-service latency (lognormal: median and sigma of log-latency) and failure rate.
+# Medians are in the range seen in production for each call.
+DEFAULT_PROFILE = {
+    "openai.chat": {"median_ms": 2500, "sigma": 0.35, "error_rate": 0.0},
+    "openai.vision": {"median_ms": 1800, "sigma": 0.3, "error_rate": 0.0},
+    "openai.embeddings": {"median_ms": 120, "sigma": 0.4, "error_rate": 0.0},
+    "supabase.rpc": {"median_ms": 80, "sigma": 0.3, "error_rate": 0.0},
+    "graph.media": {"median_ms": 150, "sigma": 0.3, "error_rate": 0.0},
+    "graph.download": {"median_ms": 250, "sigma": 0.4, "error_rate": 0.0},
+    "graph.send": {"median_ms": 200, "sigma": 0.3, "error_rate": 0.0},
+    "twilio.send": {"median_ms": 250, "sigma": 0.3, "error_rate": 0.0},
+    "twilio.download": {"median_ms": 300, "sigma": 0.4, "error_rate": 0.0},
+}
+
+# Fraction of failures answered with 429 + Retry-After instead of 500
+RATE_LIMITED_SHARE = 0.5
+
+EXTRACTED_QUESTIONS = [
+    "Solve the quadratic equation 2x^2 - 7x + 3 = 0.",
+    "Prove that the square root of 2 is irrational.",
+    "Find the area of a triangle with vertices (1, 2), (3, 5) and (6, 1).",
+    "A ball is dropped from a height of 20 m. Find its speed just before it hits the ground.",
+    "Balance the equation: Fe + H2O -> Fe3O4 + H2.",
+]
+
+RAG_ROWS = [
+    {"content": "Quadratic equations: the roots of ax^2 + bx + c = 0 are (-b ± √(b² - 4ac)) / 2a."},
+    {"content": "The nature of the roots depends on the discriminant D = b² - 4ac."},
+    {"content": "CBSE marking scheme: write the formula, substitute, simplify, state the answer."},
+]
+
+
+def load_profile(path=None, latency_scale=1.0, error_rate=None):
+    """
+    DEFAULT_PROFILE updated with a JSON file of the same shape (partial
+    entries allowed), latencies multiplied by latency_scale, and an optional
+    error rate applied to every service.
+    """
+    profile = {name: dict(values) for name, values in DEFAULT_PROFILE.items()}
+    if path:
+        with open(path) as f:
+            for name, values in json.load(f).items():
+                profile.setdefault(name, {"median_ms": 0, "sigma": 0.0, "error_rate": 0.0}).update(values)
+    for values in profile.values():
+        values["median_ms"] *= latency_scale
+        if error_rate is not None:
+            values["error_rate"] = error_rate
+    return profile
+
+
+def load_answers(limit=50):
+    answers = []
+    with open(os.path.join(BENCH_DIR, "data", "latex_answers.jsonl")) as f:
+        for line in f:
+            if line.strip():
+                answers.append(json.loads(line)["answer"])
+            if len(answers) >= limit:
+                break
+    return answers
+
+
+def worksheet_jpeg(width=1600, height=1200):
+    """
+    A re-compressed phone photo of a worksheet, as WhatsApp delivers it.
+    """
+    import numpy as np
+    from PIL import Image, ImageDraw
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    paper = 215 + 25 * (x / width) - 15 * (y / height)
+    pixels = np.stack([paper, paper - 4, paper - 12], axis=-1) + rng.normal(0, 6, (height, width, 3))
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    draw = ImageDraw.Draw(img)
+    for line in range(100, height - 100, 70):
+        px = 120
+        while px < width - 150:
+            length = int(rng.integers(20, 130))
+            draw.line([(px, line), (px + length, line + int(rng.integers(-10, 10)))], fill=(30, 35, 70), width=4)
+            px += length + int(rng.integers(15, 45))
+    output = BytesIO()
+    img.save(output, format="JPEG", quality=80)
+    return output.getvalue()
+
+
+def create_app(profile, seed=0):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+    app = FastAPI()
+    rng = random.Random(seed)
+    answers = load_answers()
+    image = worksheet_jpeg()
+    events = []  # outgoing WhatsApp messages: {"t", "service", "to", "chars"}
+    counters = {"requests": {}, "errors": {}}
+    seen_prefixes = set()  # system messages already sent to the chat API
+
+    def sample_latency(service):
+        values = profile.get(service, {})
+        median = values.get("median_ms", 0) / 1000
+        if median <= 0:
+            return 0.0
+        return median * rng.lognormvariate(0, values.get("sigma", 0.0))
+
+    async def call(service):
+        """
+        Sleep for the service latency; return an error response or None.
+        """
+        counters["requests"][service] = counters["requests"].get(service, 0) + 1
+        await asyncio.sleep(sample_latency(service))
+        if rng.random() < profile.get(service, {}).get("error_rate", 0.0):
+            counters["errors"][service] = counters["errors"].get(service, 0) + 1
+            if rng.random() < RATE_LIMITED_SHARE:
+                return JSONResponse(status_code=429, headers={"Retry-After": "1"},
+                                    content={"error": {"message": "Rate limited (fake)", "type": "rate_limit"}})
+            return JSONResponse(status_code=500, content={"error": {"message": "Internal error (fake)"}})
+        return None
+
+    def pick_answer(text):
+        # Same question, same answer, so answer caching behaves as in production
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        return answers[digest[0] % len(answers)]
+
+    def vector(text, dims):
+        import numpy as np
+        seed_value = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        v = np.random.default_rng(seed_value).standard_normal(dims).astype(np.float32)
+        return v / np.linalg.norm(v)
+
+    # OpenAI
+
+    @app.post("/openai/v1/embeddings")
+    async def openai_embeddings(request: Request):
+        body = await request.json()
+        error = await call("openai.embeddings")
+        if error is not None:
+            return error
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dims = body.get("dimensions") or 1536
+        data = []
+        for index, text in enumerate(texts):
+            v = vector(str(text), dims)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(v.tobytes()).decode("ascii")
+            else:
+                embedding = v.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        tokens = sum(len(str(text).split()) for text in texts)
+        return {"object": "list", "data": data, "model": body.get("model"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    @app.post("/openai/v1/chat/completions")
+    async def openai_chat(request: Request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        content = messages[-1].get("content") if messages else ""
+        is_vision = isinstance(content, list) and any(part.get("type") == "image_url" for part in content)
+        if is_vision:
+            text = "".join(part.get("text", "") for part in content if part.get("type") == "text")
+            image_url = next(part["image_url"]["url"] for part in content if part.get("type") == "image_url")
+            reply = EXTRACTED_QUESTIONS[hashlib.sha256(image_url.encode()).digest()[0] % len(EXTRACTED_QUESTIONS)]
+        else:
+            text = content if isinstance(content, str) else json.dumps(content)
+            reply = pick_answer(text)
+        completion_id = f"chatcmpl-fake{rng.getrandbits(48):x}"
+        created = int(time.time())
+        model = body.get("model")
+        # Prompt caching like OpenAI's (minus its 1024-token minimum): a system message seen before is cached
+        system = "".join(m.get("content", "") for m in messages
+                         if m.get("role") == "system" and isinstance(m.get("content"), str))
+        prompt_tokens = len(system.split()) + len(text.split())
+        cached_tokens = len(system.split()) if system in seen_prefixes else 0
+        seen_prefixes.add(system)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(reply.split()),
+                 "total_tokens": prompt_tokens + len(reply.split()),
+                 "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+
+        if not body.get("stream"):
+            error = await call("openai.vision" if is_vision else "openai.chat")
+            if error is not None:
+                return error
+            return {"id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": reply},
+                                 "finish_reason": "stop"}],
+                    "usage": usage}
+
+        # Streamed: a quarter of the latency before the first token, the rest spread over the chunks
+        service = "openai.chat"
+        counters["requests"][service] = counters["requests"].get(service, 0) + 1
+        total = sample_latency(service)
+        if rng.random() < profile.get(service, {}).get("error_rate", 0.0):
+            counters["errors"][service] = counters["errors"].get(service, 0) + 1
+            await asyncio.sleep(total / 4)
+            return JSONResponse(status_code=500, content={"error": {"message": "Internal error (fake)"}})
+        words = reply.split(" ")
+        pieces = [" ".join(words[i:i + 4]) + (" " if i + 4 < len(words) else "") for i in range(0, len(words), 4)]
+
+        async def events_stream():
+            await asyncio.sleep(total / 4)
+            delay = 0.75 * total / max(1, len(pieces))
+            for piece in pieces:
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                         "model": model,
+                         "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(delay)
+            done = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            yield f"data: {json.dumps(done)}\n\n"
+            if (body.get("stream_options") or {}).get("include_usage"):
+                usage_chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                               "model": model, "choices": [], "usage": usage}
+                yield f"data: {json.dumps(usage_chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events_stream(), media_type="text/event-stream")
+
+    # Supabase
+
+    @app.get("/supabase/rest/v1/")
+    async def supabase_root():
+        return {}
+
+    @app.post("/supabase/rest/v1/rpc/match_cbse_context")
+    async def supabase_match(request: Request):
+        await request.body()
+        error = await call("supabase.rpc")
+        if error is not None:
+            return error
+        return RAG_ROWS
+
+    # WhatsApp Cloud (Graph API)
+
+    @app.post("/graph/{phone_id}/messages")
+    async def graph_send(phone_id: str, request: Request):
+        body = await request.json()
+        error = await call("graph.send")
+        if error is not None:
+            return error
+        events.append({"t": time.time(), "service": "whatsapp_cloud", "to": body.get("to"),
+                       "chars": len(body.get("text", {}).get("body", ""))})
+        return {"messaging_product": "whatsapp", "contacts": [{"wa_id": body.get("to")}],
+                "messages": [{"id": f"wamid.fake{rng.getrandbits(48):x}"}]}
+
+    @app.get("/graph/media/{media_id}")
+    async def graph_download(media_id: str):
+        error = await call("graph.download")
+        if error is not None:
+            return error
+        return Response(content=image, media_type="image/jpeg")
+
+    @app.get("/graph/{media_id}")
+    async def graph_media(media_id: str, request: Request):
+        error = await call("graph.media")
+        if error is not None:
+            return error
+        return {"url": f"{str(request.base_url).rstrip('/')}/graph/media/{media_id}",
+                "mime_type": "image/jpeg", "id": media_id}
+
+    # Twilio
+
+    @app.post("/twilio/Accounts/{account_sid}/Messages.json")
+    async def twilio_send(account_sid: str, request: Request):
+        form = await request.form()
+        error = await call("twilio.send")
+        if error is not None:
+            return error
+        events.append({"t": time.time(), "service": "twilio", "to": form.get("To", "").replace("whatsapp:", ""),
+                       "chars": len(form.get("Body", ""))})
+        return JSONResponse(status_code=201, content={"sid": f"SMfake{rng.getrandbits(48):x}", "status": "queued"})
+
+    @app.get("/twilio/Accounts/{account_sid}/Messages/{message_sid}/Media/{media_sid}")
+    async def twilio_download(account_sid: str, message_sid: str, media_sid: str):
+        error = await call("twilio.download")
+        if error is not None:
+            return error
+        return Response(content=image, media_type="image/jpeg")
+
+    # Control
+
+    @app.get("/_events")
+    async def get_events(since: int = 0):
+        return {"next": len(events), "events": events[since:]}
+
+    @app.get("/_stats")
+    async def get_stats():
+        return counters
+
+    return app
+
+
+def serve(port, profile, seed=0):
+    """
+    Run the fake server until the process is stopped.
+    """
+    import uvicorn
+    uvicorn.run(create_app(profile, seed), host="127.0.0.1", port=port, log_level="warning",
+                access_log=False, timeout_keep_alive=60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--profile", help="JSON file overriding DEFAULT_PROFILE entries")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiply every median latency")
+    parser.add_argument("--error-rate", type=float, help="failure probability for every service")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    profile = load_profile(args.profile, args.latency_scale, args.error_rate)
+    print(json.dumps(profile, indent=2), file=sys.stderr)
+    serve(args.port, profile, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""
+Load test of the whole app against local fake providers.
+Starts benchmarks/fake_providers.py in a separate process, points every
+external endpoint at it, runs the FastAPI app in-process (with its
+lifespan: job queue, HTTP pools, image pool) and replays recorded webhook
+payloads from benchmarks/data/webhook_payloads.jsonl at a fixed request
+rate. Each replayed message gets a new message ID and sender, so replies
+can be matched to the request that caused them.
+
+Reports webhook latency, time to the first and last reply message,
+throughput, the app's per-stage latencies, CPU time and peak RSS. With
+--baseline, exits with status 1 if throughput, p95 reply latency, CPU per
+message or peak RSS regressed by more than --max-regression.
+
+Text questions get a per-request suffix so they miss the answer cache;
+pass --repeat-questions to measure the cached path instead.
+
+Usage:
+    python benchmarks/load_test.py --rate 20 --duration 30 --latency-scale 0.2
+    python benchmarks/load_test.py --rate 20 --duration 30 --save baseline.json
+    python benchmarks/load_test.py --rate 20 --duration 30 --baseline baseline.json --max-regression 0.1
+"""
+import argparse
+import asyncio
+import contextlib
+import copy
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+RECORDED_TWILIO_BASE = "https://api.twilio.com/2010-04-01"
+
+# (report key, True if higher is better) checked by the regression gate
+GATED_METRICS = [
+    ("throughput_msgs_per_s", True),
+    ("reply_first_p95_ms", False),
+    ("cpu_ms_per_message", False),
+    ("peak_rss_mb", False),
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_fake_providers(profile, seed):
+    import fake_providers
+    port = free_port()
+    process = multiprocessing.get_context("spawn").Process(
+        target=fake_providers.serve, args=(port, profile, seed), daemon=True
+    )
+    process.start()
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=0.2):
+            return process, f"http://127.0.0.1:{port}"
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Fake providers did not start")
+
+
+def configure_environment(base_url, args):
+    """
+    Point the app at the fake providers. Must run before main is imported,
+    since every module reads its configuration at import time.
+    """
+    os.environ.update({
+        "AI_PROVIDER": "gpt",
+        "OPENAI_API_KEY": "sk-fake",
+        "OPENAI_BASE_URL": f"{base_url}/openai/v1",
+        "SUPABASE_URL": f"{base_url}/supabase",
+        "SUPABASE_KEY": "fake-supabase-key",
+        "RAG_BACKEND": "supabase",
+        "GRAPH_API_BASE": f"{base_url}/graph",
+        "WHATSAPP_TOKEN": "fake-token",
+        "WHATSAPP_PHONE_NUMBER_ID": "106540352242922",
+        "TWILIO_API_BASE": f"{base_url}/twilio",
+        "TWILIO_ACCOUNT_SID": "ACxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx",
+        "TWILIO_AUTH_TOKEN": "fake-token",
+        "TWILIO_WHATSAPP_FROM": "whatsapp:+14155238886",
+        "ANSWER_STREAMING": "1" if args.streaming else "0",
+        # A persistent tier would carry cache hits over from earlier runs
+        "EMBEDDING_CACHE_DB": "",
+        "MESSAGE_DEDUP_DB": "",
+    })
+
+
+def load_payloads(path):
+    payloads = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                payloads.append(json.loads(line))
+    return payloads
+
+
+class Replayer:
+    """
+    Turns recorded payloads into fresh requests: new message IDs and senders,
+    media URLs pointed at the fake providers.
+    """
+
+    def __init__(self, payloads, base_url, seed, repeat_questions):
+        self.payloads = payloads
+        self.weights = [payload.get("weight", 1) for payload in payloads]
+        self.twilio_base = f"{base_url}/twilio"
+        self.rng = random.Random(seed)
+        self.repeat_questions = repeat_questions
+        self.messages = 0
+
+    def _next_sender(self):
+        self.messages += 1
+        return f"91{7000000000 + self.messages}", f"{self.messages:08d}"
+
+    def next_request(self, number):
+        """
+        Return (name, path, request kwargs, recipients that should get a reply).
+        """
+        payload = self.rng.choices(self.payloads, self.weights)[0]
+        suffix = "" if self.repeat_questions else f" (#{number})"
+        if "form" in payload:
+            form = dict(payload["form"])
+            sender, unique = self._next_sender()
+            form["From"] = f"whatsapp:+{sender}"
+            form["WaId"] = sender
+            form["MessageSid"] = form["SmsSid"] = form["SmsMessageSid"] = f"SMload{unique}"
+            if form.get("MediaUrl0"):
+                form["MediaUrl0"] = form["MediaUrl0"].replace(RECORDED_TWILIO_BASE, self.twilio_base)
+            elif form.get("Body"):
+                form["Body"] += suffix
+            # The app strips only the "whatsapp:" prefix, so Twilio replies go to +<number>
+            return payload["name"], payload["path"], {"data": form}, [f"+{sender}"]
+
+        body = copy.deepcopy(payload["json"])
+        recipients = []
+        for entry in body.get("entry", []):
+            for change in entry.get("changes", []):
+                value = change.get("value", {})
+                contacts = value.get("contacts", [])
+                for index, message in enumerate(value.get("messages", [])):
+                    sender, unique = self._next_sender()
+                    message["from"] = sender
+                    message["id"] = f"wamid.load{unique}"
+                    if index < len(contacts):
+                        contacts[index]["wa_id"] = sender
+                    if "text" in message:
+                        message["text"]["body"] += suffix
+                    recipients.append(sender)
+        return payload["name"], payload["path"], {"json": body}, recipients
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def peak_rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def run_load(args, base_url, payloads):
+    import httpx
+    import main
+
+    replayer = Replayer(payloads, base_url, args.seed, args.repeat_questions)
+    sent = {}          # recipient -> time the webhook carrying its message was posted
+    webhook_ms = []
+    statuses = {}
+    per_payload = {}
+
+    async with main.lifespan(main.app):
+        app_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://app")
+        fake_client = httpx.AsyncClient(base_url=base_url)
+
+        async def post(name, path, kwargs, recipients):
+            started = time.time()
+            for recipient in recipients:
+                sent[recipient] = started
+            try:
+                response = await app_client.post(path, **kwargs)
+                status = response.status_code
+            except Exception as e:
+                status = type(e).__name__
+            webhook_ms.append(1000 * (time.time() - started))
+            statuses[status] = statuses.get(status, 0) + 1
+            per_payload[name] = per_payload.get(name, 0) + 1
+
+        # Open loop: requests go out on schedule however slow the app gets
+        total = max(1, int(args.rate * args.duration))
+        cpu_start = cpu_seconds(resource.RUSAGE_SELF)
+        start = time.time()
+        tasks = []
+        for number in range(total):
+            delay = start + number / args.rate - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(*replayer.next_request(number))))
+        await asyncio.gather(*tasks)
+        load_end = time.time()
+
+        # Drain: wait for the job queue to empty and the last replies to land
+        deadline = time.time() + args.drain_timeout
+        while time.time() < deadline:
+            stats = main.job_queue.stats()
+            if not stats["depth"] and not stats["in_flight"]:
+                break
+            await asyncio.sleep(0.1)
+        end = time.time()
+        cpu_app = cpu_seconds(resource.RUSAGE_SELF) - cpu_start
+
+        events = (await fake_client.get("/_events")).json()["events"]
+        fake_stats = (await fake_client.get("/_stats")).json()
+        queue_stats = main.job_queue.stats()
+        stage_latency = main.metrics.latency_summary()
+        await app_client.aclose()
+        await fake_client.aclose()
+
+    first_reply, last_reply = {}, {}
+    for event in events:
+        recipient = event["to"]
+        if recipient not in sent:
+            continue
+        first_reply.setdefault(recipient, event["t"])
+        last_reply[recipient] = max(last_reply.get(recipient, 0), event["t"])
+    first_ms = [1000 * (first_reply[r] - sent[r]) for r in first_reply]
+    last_ms = [1000 * (last_reply[r] - sent[r]) for r in last_reply]
+    done = max(last_reply.values(), default=end)
+
+    return {
+        "requests": total,
+        "messages": len(sent),
+        "replied": len(first_reply),
+        "unanswered": len(sent) - len(first_reply),
+        "offered_rate": args.rate,
+        "load_seconds": round(load_end - start, 2),
+        "total_seconds": round(done - start, 2),
+        "throughput_msgs_per_s": round(len(first_reply) / max(1e-9, done - start), 2),
+        "webhook_statuses": {str(key): value for key, value in statuses.items()},
+        "payload_mix": per_payload,
+        "webhook_p50_ms": round(percentile(webhook_ms, 0.5), 1),
+        "webhook_p95_ms": round(percentile(webhook_ms, 0.95), 1),
+        "webhook_p99_ms": round(percentile(webhook_ms, 0.99), 1),
+        "reply_first_p50_ms": round(percentile(first_ms, 0.5), 1),
+        "reply_first_p95_ms": round(percentile(first_ms, 0.95), 1),
+        "reply_first_p99_ms": round(percentile(first_ms, 0.99), 1),
+        "reply_last_p50_ms": round(percentile(last_ms, 0.5), 1),
+        "reply_last_p95_ms": round(percentile(last_ms, 0.95), 1),
+        "reply_last_p99_ms": round(percentile(last_ms, 0.99), 1),
+        "cpu_seconds": round(cpu_app, 2),
+        "cpu_percent": round(100 * cpu_app / max(1e-9, end - start), 1),
+        "cpu_ms_per_message": round(1000 * cpu_app / max(1, len(sent)), 2),
+        "job_queue": queue_stats,
+        "fake_provider_calls": fake_stats,
+        "stages": stage_latency,
+    }
+
+
+def check_regressions(report, baseline, max_regression):
+    """
+    Return a description of each gated metric that got worse than the
+    baseline by more than max_regression (a fraction).
+    """
+    failures = []
+    for key, higher_is_better in GATED_METRICS:
+        old, new = baseline.get(key), report.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > max_regression:
+            failures.append(f"{key}: {old} -> {new} ({100 * change:+.1f}%)")
+    return failures
+
+
+def print_report(report):
+    rows = [
+        ("requests / messages", f"{report['requests']} / {report['messages']}"),
+        ("replied / unanswered", f"{report['replied']} / {report['unanswered']}"),
+        ("webhook statuses", json.dumps(report["webhook_statuses"])),
+        ("throughput (msgs/s)", f"{report['throughput_msgs_per_s']} (offered {report['offered_rate']} req/s)"),
+        ("webhook p50/p95/p99 ms", f"{report['webhook_p50_ms']} / {report['webhook_p95_ms']} / {report['webhook_p99_ms']}"),
+        ("first reply p50/p95/p99 ms",
+         f"{report['reply_first_p50_ms']} / {report['reply_first_p95_ms']} / {report['reply_first_p99_ms']}"),
+        ("last reply p50/p95/p99 ms",
+         f"{report['reply_last_p50_ms']} / {report['reply_last_p95_ms']} / {report['reply_last_p99_ms']}"),
+        ("CPU s / % / ms per message",
+         f"{report['cpu_seconds']} / {report['cpu_percent']} / {report['cpu_ms_per_message']}"),
+        ("peak RSS MB", f"{report['peak_rss_mb']}"),
+        ("job queue wait avg/max ms",
+         f"{report['job_queue']['wait_time_avg_ms']} / {report['job_queue']['wait_time_max_ms']}"),
+    ]
+    for label, value in rows:
+        print(f"{label:28} {value}")
+    print("\nStage latency (p50 / p95 ms):")
+    for stage, providers in report["stages"].items():
+        for provider, values in providers.items():
+            print(f"  {stage + ' ' + provider:26} {values['p50_ms']:8.1f} {values['p95_ms']:8.1f}  ({values['count']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rate", type=float, default=10.0, help="webhook requests per second")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of load")
+    parser.add_argument("--payloads", default=os.path.join(BENCH_DIR, "data", "webhook_payloads.jsonl"))
+    parser.add_argument("--profile", help="JSON file overriding fake_providers.DEFAULT_PROFILE")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiply every fake median latency")
+    parser.add_argument("--error-rate", type=float, help="failure probability for every fake service")
+    parser.add_argument("--streaming", action="store_true", help="run with ANSWER_STREAMING=1")
+    parser.add_argument("--repeat-questions", action="store_true", help="replay text questions unchanged")
+    parser.add_argument("--drain-timeout", type=float, default=120.0, help="max seconds to wait for replies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the report as JSON")
+    parser.add_argument("--baseline", help="report JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.10, help="allowed relative regression")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's own log output")
+    args = parser.parse_args()
+
+    import fake_providers
+    profile = fake_providers.load_profile(args.profile, args.latency_scale, args.error_rate)
+    process, base_url = start_fake_providers(profile, args.seed)
+    try:
+        configure_environment(base_url, args)
+        payloads = load_payloads(args.payloads)
+        print(f"Fake providers on {base_url}; {args.rate} req/s for {args.duration}s", file=sys.stderr)
+        # The app prints every payload it receives, which would bury the report
+        log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+        with log:
+            report = asyncio.run(run_load(args, base_url, payloads))
+        # The image pool workers have exited by now, so their CPU time is in RUSAGE_CHILDREN
+        report["cpu_seconds_image_pool"] = round(cpu_seconds(resource.RUSAGE_CHILDREN), 2)
+        report["peak_rss_mb"] = round(peak_rss_kb() / 1024, 1)
+        report["profile"] = profile
+    finally:
+        process.terminate()
+        process.join()
+
+    print_report(report)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved report to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = check_regressions(report, baseline, args.max_regression)
+        if failures:
+            print(f"\nRegression over {100 * args.max_regression:.0f}% against {args.baseline}:")
+            for failure in failures:
+                print(f"  {failure}")
+            sys.exit(1)
+        print(f"\nNo regression over {100 * args.max_regression:.0f}% against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Lexical (BM25) retrieval over the RAG chunk corpus, fused with vector search.
+Embeddings blur exact terms, so a question naming a chapter term or a
+formula can miss the chunk that defines it. A BM25 inverted index over the
+same chunks finds those, and reciprocal-rank fusion (RRF) merges its
+ranking with the vector ranking before the final chunks are chosen.
+
+Postings are stored CSR-style in flat numpy arrays: the documents of term t
+are docs[offsets[t]:offsets[t + 1]], next to their precomputed BM25 weights,
+so a query is a few array slices and one bincount with no per-posting
+Python work. The files sit next to the local vector index and are written
+by LocalIndexWriter; for an index exported before this, run:
+    python bm25.py build --index rag_index
+
+Enable with RAG_HYBRID=1 (either RAG_BACKEND; with Supabase the chunks come
+from the exported index directory). See benchmarks/bench_hybrid.py.
+"""
+import argparse
+import json
+import os
+import re
+import time
+from array import array
+import numpy as np
+from local_index import CHUNKS_FILE, CONTENT_KEYS, top_k
+
+RAG_HYBRID = os.getenv("RAG_HYBRID", "0") == "1"
+RAG_BM25_DIR = os.getenv("RAG_BM25_DIR", os.getenv("LOCAL_INDEX_DIR", "rag_index"))
+RAG_HYBRID_CANDIDATES = int(os.getenv("RAG_HYBRID_CANDIDATES", "20"))  # fetched from each ranking before fusion
+RAG_RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+BM25_TERMS_FILE = "bm25_terms.json"
+BM25_OFFSETS_FILE = "bm25_offsets.npy"
+BM25_DOCS_FILE = "bm25_docs.npy"
+BM25_WEIGHTS_FILE = "bm25_weights.npy"
+BM25_META_FILE = "bm25_meta.json"
+
+TOKEN_RE = re.compile(r"\w+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how in is it its of on or that the this to was "
+    "were what when where which who why will with".split()
+)
+
+
+def tokenize(text):
+    """
+    Lower-cased word tokens without stopwords, with a plural "s" stripped
+    so "resistors" matches "resistor". Digits are kept ("2", "x2").
+    """
+    tokens = []
+    for token in TOKEN_RE.findall(str(text).lower()):
+        if token in STOPWORDS or (len(token) == 1 and not token.isdigit()):
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class BM25Index:
+    """
+    Inverted index with BM25 weights precomputed per posting (so k1 and b
+    are fixed when the index is built).
+    """
+
+    def __init__(self, terms, offsets, docs, weights, count, chunks=None, meta=None):
+        self.terms = terms
+        self.vocab = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.docs = docs
+        self.weights = weights
+        self.count = count
+        self.chunks = chunks
+        self.meta = meta or {}
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def build(cls, chunks, k1=BM25_K1, b=BM25_B):
+        vocab = {}
+        term_ids = array("i")
+        doc_ids = array("i")
+        tfs = array("f")
+        lengths = np.zeros(len(chunks), dtype=np.float32)
+        for doc, text in enumerate(chunks):
+            counts = {}
+            tokens = tokenize(text)
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            lengths[doc] = len(tokens)
+            for token, tf in counts.items():
+                term_ids.append(vocab.setdefault(token, len(vocab)))
+                doc_ids.append(doc)
+                tfs.append(tf)
+
+        term_ids = np.frombuffer(term_ids, dtype=np.int32)
+        doc_ids = np.frombuffer(doc_ids, dtype=np.int32)
+        tfs = np.frombuffer(tfs, dtype=np.float32)
+        n = len(chunks)
+        avg_length = float(lengths.mean()) if n else 0.0
+
+        df = np.bincount(term_ids, minlength=len(vocab)).astype(np.float32)
+        idf = np.log(1 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = k1 * (1 - b + b * lengths[doc_ids] / max(avg_length, 1e-9))
+        weights = idf[term_ids] * tfs * (k1 + 1) / (tfs + norm)
+
+        order = np.argsort(term_ids, kind="stable")
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df.astype(np.int64), out=offsets[1:])
+        terms = sorted(vocab, key=vocab.get)
+        meta = {"count": n, "terms": len(terms), "postings": int(len(order)),
+                "avg_length": avg_length, "k1": k1, "b": b}
+        return cls(terms, offsets, doc_ids[order].copy(), weights[order].astype(np.float32),
+                   n, chunks=list(chunks), meta=meta)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name, values in ((BM25_OFFSETS_FILE, self.offsets), (BM25_DOCS_FILE, self.docs),
+                             (BM25_WEIGHTS_FILE, self.weights)):
+            tmp = os.path.join(path, name + ".tmp")
+            with open(tmp, "wb") as f:
+                np.save(f, values)
+            os.replace(tmp, os.path.join(path, name))
+        for name, value in ((BM25_TERMS_FILE, self.terms), (BM25_META_FILE, {**self.meta, "created_at": time.time()})):
+            tmp = os.path.join(path, name + ".tmp")
+            with open(tmp, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp, os.path.join(path, name))
+
+    @classmethod
+    def load(cls, path, chunks=None):
+        """
+        Load an index saved in `path`. The chunk texts come from chunks.json
+        there unless passed in (the local vector index already has them).
+        """
+        with open(os.path.join(path, BM25_META_FILE)) as f:
+            meta = json.load(f)
+        with open(os.path.join(path, BM25_TERMS_FILE)) as f:
+            terms = json.load(f)
+        if chunks is None:
+            with open(os.path.join(path, CHUNKS_FILE)) as f:
+                chunks = json.load(f)
+        return cls(
+            terms,
+            np.load(os.path.join(path, BM25_OFFSETS_FILE)),
+            np.load(os.path.join(path, BM25_DOCS_FILE), mmap_mode="r"),
+            np.load(os.path.join(path, BM25_WEIGHTS_FILE), mmap_mode="r"),
+            meta["count"], chunks=chunks, meta=meta,
+        )
+
+    def search(self, query, k=RAG_HYBRID_CANDIDATES):
+        """
+        Return [(chunk_id, bm25_score)] for the k best chunks, best first.
+        """
+        slices = []
+        for token in set(tokenize(query)):
+            term = self.vocab.get(token)
+            if term is not None:
+                slices.append(slice(self.offsets[term], self.offsets[term + 1]))
+        if not slices:
+            return []
+        if len(slices) == 1:
+            ids = np.asarray(self.docs[slices[0]])
+            scores = np.asarray(self.weights[slices[0]])
+        else:
+            # Sum the weights of each document over the query terms
+            docs = np.concatenate([self.docs[s] for s in slices])
+            weights = np.concatenate([self.weights[s] for s in slices])
+            ids, inverse = np.unique(docs, return_inverse=True)
+            scores = np.bincount(inverse, weights=weights).astype(np.float32)
+        best = top_k(scores, k)
+        return [(int(ids[i]), float(scores[i])) for i in best]
+
+    def match(self, query, match_count=RAG_HYBRID_CANDIDATES):
+        """
+        Same row shape as the match_cbse_context RPC, with the BM25 score.
+        """
+        return [{"id": chunk_id, "content": self.chunks[chunk_id], "bm25": score}
+                for chunk_id, score in self.search(query, match_count)]
+
+
+def rrf_fuse(rankings, k=RAG_RRF_K):
+    """
+    Reciprocal-rank fusion: each key scores sum(1 / (k + rank)) over the
+    rankings it appears in (rank from 1). Returns keys, best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda key: -scores[key])
+
+
+def fuse_rows(vector_rows, lexical_rows, count, k=RAG_RRF_K):
+    """
+    Fuse vector and BM25 result rows by their content, keeping the first
+    row seen for each chunk. Returns the `count` best rows.
+    """
+    rows = {}
+    rankings = []
+    for ranked in (vector_rows, lexical_rows):
+        keys = {}
+        for row in ranked:
+            key = next((row[name] for name in CONTENT_KEYS if name in row), None)
+            if key is not None and key not in keys:
+                rows.setdefault(key, row)
+                keys[key] = None
+        rankings.append(list(keys))
+    return [rows[key] for key in rrf_fuse(rankings, k)[:count]]
+
+
+_bm25_index = None
+
+
+def get_bm25_index(chunks=None):
+    """
+    Load RAG_BM25_DIR once per process.
+    """
+    global _bm25_index
+    if _bm25_index is None:
+        _bm25_index = BM25Index.load(RAG_BM25_DIR, chunks)
+        print(f"Loaded BM25 index: {len(_bm25_index)} chunks, {len(_bm25_index.terms)} terms, "
+              f"{_bm25_index.meta.get('postings', 0)} postings")
+    return _bm25_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the BM25 index of the RAG corpus")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="Build the BM25 index from an index directory's chunks.json")
+    build.add_argument("--index", default=RAG_BM25_DIR)
+
+    args = parser.parse_args()
+    if args.command == "build":
+        start = time.time()
+        with open(os.path.join(args.index, CHUNKS_FILE)) as f:
+            chunks = json.load(f)
+        index = BM25Index.build(chunks)
+        index.save(args.index)
+        print(f"Wrote BM25 index: {index.meta['count']} chunks, {index.meta['terms']} terms, "
+              f"{index.meta['postings']} postings to {args.index} in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    main()
@@ -0,0 +1,231 @@
+"""
+Token-budgeted assembly of the RAG context.
+Retrieval over-fetches RAG_CONTEXT_CANDIDATES chunks. Near-duplicates
+(overlapping ingestion chunks, the same paragraph in a book and a past
+paper) are dropped, the rest are ordered by maximal marginal relevance so
+each added chunk is relevant but unlike those already taken, and chunks
+are packed in that order until RAG_CONTEXT_TOKENS is reached. Prompts get
+a predictable size, which keeps time-to-first-token predictable.
+
+Similarities come from the chunk embeddings when the rows carry them (the
+local index does), else from hashed bag-of-words vectors of the chunk text.
+Tokens are counted with tiktoken when it is installed, otherwise estimated.
+"""
+import json
+import math
+import os
+import zlib
+import numpy as np
+from bm25 import tokenize
+from local_index import CONTENT_KEYS, normalize_rows
+
+RAG_CONTEXT_ASSEMBLY = os.getenv("RAG_CONTEXT_ASSEMBLY", "1") == "1"
+RAG_CONTEXT_CANDIDATES = int(os.getenv("RAG_CONTEXT_CANDIDATES", "12"))  # chunks fetched before assembly
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1200"))  # context budget
+RAG_CONTEXT_MAX_CHUNKS = int(os.getenv("RAG_CONTEXT_MAX_CHUNKS", "6"))
+RAG_MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))  # 1 = relevance only, 0 = diversity only
+RAG_DEDUP_THRESHOLD = float(os.getenv("RAG_DEDUP_THRESHOLD", "0.9"))  # text cosine above which chunks are duplicates
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "o200k_base")  # tiktoken encoding
+
+SEPARATOR = "\n\n"
+# Dimensions of the hashed bag-of-words vectors
+TEXT_VECTOR_DIMENSIONS = 2048
+# A partial chunk shorter than this isn't worth adding at the end of the budget
+MIN_PARTIAL_TOKENS = 64
+
+_encoding = None
+_encoding_loaded = False
+
+_stats = {
+    "contexts": 0,
+    "candidates": 0,
+    "duplicates": 0,
+    "chunks": 0,
+    "tokens": 0,
+    "truncated": 0,
+}
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(CONTEXT_TOKENIZER)
+        except Exception as e:
+            print(f"tiktoken unavailable ({type(e).__name__}: {str(e)}), estimating context tokens")
+    return _encoding
+
+
+def count_tokens(text):
+    """
+    Tokens in text: exact with tiktoken, else about 4 characters per token.
+    """
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return max(math.ceil(len(text) / 4), len(text.split()))
+
+
+def truncate_to_tokens(text, budget):
+    """
+    The longest prefix of text within budget tokens, cut at a sentence end
+    or space when there is one in the last quarter.
+    """
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= budget:
+            return text
+        prefix = encoding.decode(tokens[:budget])
+    else:
+        if count_tokens(text) <= budget:
+            return text
+        prefix = text[:budget * 4]
+    for marks in ((". ", "? ", "! ", "\n"), (" ",)):
+        cut = max(prefix.rfind(mark) for mark in marks)
+        if cut >= len(prefix) * 3 // 4:
+            return prefix[:cut + 1].rstrip()
+    return prefix
+
+
+def text_vectors(texts, dimensions=TEXT_VECTOR_DIMENSIONS):
+    """
+    Unit-norm hashed bag-of-words vectors (sublinear term frequency).
+    """
+    rows, columns = [], []
+    for i, text in enumerate(texts):
+        for token in tokenize(text):
+            rows.append(i)
+            columns.append(zlib.crc32(token.encode("utf-8")) % dimensions)
+    counts = np.zeros((len(texts), dimensions), dtype=np.float32)
+    np.add.at(counts, (np.asarray(rows, dtype=np.int64), np.asarray(columns, dtype=np.int64)), 1.0)
+    np.log1p(counts, out=counts)
+    return normalize_rows(counts)
+
+
+def mmr(relevance, similarity, k, lam=RAG_MMR_LAMBDA):
+    """
+    Maximal marginal relevance: indices in pick order, each maximising
+    lam * relevance - (1 - lam) * (max similarity to the picked ones).
+    """
+    n = len(relevance)
+    k = min(k, n)
+    picked = []
+    if not k:
+        return picked
+    max_similarity = np.full(n, -np.inf, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    for _ in range(k):
+        redundancy = np.where(np.isinf(max_similarity), 0.0, max_similarity)
+        scores = np.where(available, lam * relevance - (1 - lam) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return picked
+
+
+def _content(row):
+    return next((row[key] for key in CONTENT_KEYS if key in row), None)
+
+
+def _row_embeddings(rows):
+    vectors = []
+    for row in rows:
+        value = row.get("embedding")
+        if value is None:
+            return None
+        # pgvector columns come back from PostgREST as "[0.1,0.2,...]" strings
+        vectors.append(json.loads(value) if isinstance(value, str) else value)
+    try:
+        return normalize_rows(np.asarray(vectors, dtype=np.float32))
+    except ValueError:
+        return None
+
+
+def _relevance(rows, embeddings, question_embedding):
+    if embeddings is not None and question_embedding is not None \
+            and len(question_embedding) == embeddings.shape[1]:
+        return embeddings @ normalize_rows(question_embedding)
+    if all(isinstance(row.get("similarity"), (int, float)) for row in rows):
+        return np.asarray([row["similarity"] for row in rows], dtype=np.float32)
+    # Fused (hybrid) rankings only have an order
+    return np.linspace(1.0, 0.5, len(rows), dtype=np.float32)
+
+
+def select_chunks(rows, question_embedding=None, budget=RAG_CONTEXT_TOKENS, max_chunks=RAG_CONTEXT_MAX_CHUNKS,
+                  lam=RAG_MMR_LAMBDA, dedup_threshold=RAG_DEDUP_THRESHOLD):
+    """
+    Choose and order chunk texts from retrieved rows (best first): drop
+    near-duplicates, order by MMR, and pack within `budget` tokens.
+    """
+    rows = [row for row in rows or [] if _content(row)]
+    if not rows:
+        return []
+    texts = [_content(row) for row in rows]
+    lexical = text_vectors(texts)
+    embeddings = _row_embeddings(rows)
+    relevance = _relevance(rows, embeddings, question_embedding)
+
+    # Keep the more relevant of each near-duplicate pair
+    text_similarity = lexical @ lexical.T
+    kept = []
+    for i in np.argsort(-relevance, kind="stable"):
+        if all(text_similarity[i, j] < dedup_threshold for j in kept):
+            kept.append(int(i))
+    kept.sort()
+    _stats["candidates"] += len(rows)
+    _stats["duplicates"] += len(rows) - len(kept)
+
+    vectors = embeddings[kept] if embeddings is not None else lexical[kept]
+    order = [kept[i] for i in mmr(relevance[kept], vectors @ vectors.T, len(kept), lam)]
+
+    chosen = []
+    used = 0
+    separator_tokens = count_tokens(SEPARATOR)
+    for i in order:
+        if len(chosen) >= max_chunks:
+            break
+        cost = count_tokens(texts[i]) + (separator_tokens if chosen else 0)
+        if used + cost <= budget:
+            chosen.append(texts[i])
+            used += cost
+            continue
+        left = budget - used - (separator_tokens if chosen else 0)
+        if not chosen or left >= MIN_PARTIAL_TOKENS:
+            # Fill the rest of the budget with the start of this chunk
+            chosen.append(truncate_to_tokens(texts[i], left))
+            used += count_tokens(chosen[-1]) + (separator_tokens if len(chosen) > 1 else 0)
+            _stats["truncated"] += 1
+        break
+
+    _stats["contexts"] += 1
+    _stats["chunks"] += len(chosen)
+    _stats["tokens"] += used
+    return chosen
+
+
+def assemble_context(rows, question_embedding=None, budget=RAG_CONTEXT_TOKENS):
+    """
+    The context string for the prompt from over-fetched retrieval rows.
+    """
+    return SEPARATOR.join(select_chunks(rows, question_embedding, budget))
+
+
+def context_stats():
+    contexts = _stats["contexts"]
+    if not contexts:
+        return {"enabled": RAG_CONTEXT_ASSEMBLY, "contexts": 0, "token_budget": RAG_CONTEXT_TOKENS}
+    return {
+        "enabled": RAG_CONTEXT_ASSEMBLY,
+        "contexts": contexts,
+        "token_budget": RAG_CONTEXT_TOKENS,
+        "tokenizer": CONTEXT_TOKENIZER if _encoding is not None else "estimate",
+        "tokens_avg": round(_stats["tokens"] / contexts, 1),
+        "chunks_avg": round(_stats["chunks"] / contexts, 2),
+        "candidates_avg": round(_stats["candidates"] / contexts, 2),
+        "duplicates_dropped": _stats["duplicates"],
+        "truncated": _stats["truncated"],
+    }
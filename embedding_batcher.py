@@ -0,0 +1,111 @@
+"""
+Micro-batching for embedding requests.
+Concurrent create_embedding_async calls (one per incoming question) are held
+for up to EMBEDDING_BATCH_WAIT_MS, or until EMBEDDING_BATCH_SIZE texts are
+waiting, and then sent as a single batched request. Each caller gets its own
+vector back. During traffic spikes this turns many small embedding calls
+into a few larger ones, which is what the provider rate limits count.
+"""
+import asyncio
+import os
+
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5"))
+
+
+async def embed_in_chunks(batch_func, texts, max_batch):
+    """
+    Call an async batch_func(texts) with at most max_batch texts per request.
+    """
+    texts = list(texts)
+    if len(texts) <= max_batch:
+        return await batch_func(texts)
+    chunks = [texts[i:i + max_batch] for i in range(0, len(texts), max_batch)]
+    results = await asyncio.gather(*(batch_func(chunk) for chunk in chunks))
+    return [vector for chunk in results for vector in chunk]
+
+
+class EmbeddingBatcher:
+    """
+    Collects single-text requests and flushes them through batch_func(texts),
+    an async function returning one vector per text in input order.
+    """
+
+    def __init__(self, batch_func, max_batch=EMBEDDING_BATCH_SIZE, max_wait_ms=EMBEDDING_BATCH_WAIT_MS):
+        self.batch_func = batch_func
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._pending = []
+        self._timer = None
+        self._loop = None
+        self._tasks = set()
+
+        # Counters
+        self.requests = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.largest_batch = 0
+
+    async def embed(self, text):
+        """
+        Return the embedding of one text, batched with concurrent callers.
+        """
+        self.requests += 1
+        if not self.max_wait or self.max_batch == 1:
+            self._count_batch(1)
+            return (await self.batch_func([text]))[0]
+
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Pending requests belong to the loop they were made on
+            self._loop = loop
+            self._pending = []
+            self._timer = None
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = self._loop.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        self._count_batch(len(batch))
+        try:
+            vectors = await self.batch_func([text for text, _ in batch])
+            if len(vectors) != len(batch):
+                raise ValueError(f"Expected {len(batch)} embeddings, got {len(vectors)}")
+        except Exception as e:
+            self.failed_batches += 1
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+    def _count_batch(self, size):
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, size)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+            "avg_batch_size": round(self.requests / self.batches, 2) if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+        }
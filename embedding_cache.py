@@ -0,0 +1,319 @@
+"""
+Cache for question embeddings.
+Students send the same textbook questions again and again, so embeddings are
+cached by normalized question text plus provider/model/dimensions.
+Two tiers: an in-process LRU with TTL, and an optional SQLite file
+(EMBEDDING_CACHE_DB) that survives restarts and is shared by all uvicorn workers.
+With SHARED_STATE_URL set, a shared tier after those serves workers on
+other nodes too (see shared_state.py).
+"""
+import asyncio
+import functools
+import hashlib
+import inspect
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from shared_state import async_twin, shared_state
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", str(7 * 24 * 3600)))
+EMBEDDING_CACHE_DB = os.getenv("EMBEDDING_CACHE_DB")  # e.g. /var/cache/clearmydoubts/embeddings.db
+EMBEDDING_CACHE_DB_MAX_ROWS = int(os.getenv("EMBEDDING_CACHE_DB_MAX_ROWS", "500000"))
+
+
+def normalize_text(text):
+    """
+    Normalize a question for cache lookups: case-fold and collapse whitespace.
+    """
+    return " ".join(str(text).split()).casefold()
+
+
+def make_key(text, provider, model, dimensions):
+    raw = f"{provider}\0{model}\0{dimensions}\0{normalize_text(text)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryEmbeddingCache:
+    """
+    In-process LRU with size and TTL eviction.
+    """
+
+    def __init__(self, max_size=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, vector = item
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return vector
+
+    def set(self, key, vector):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, vector)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SqliteEmbeddingCache:
+    """
+    On-disk tier in a SQLite file (WAL mode, so several processes can share it).
+    Vectors are stored as packed float32.
+    """
+
+    def __init__(self, path, ttl=EMBEDDING_CACHE_TTL, max_rows=EMBEDDING_CACHE_DB_MAX_ROWS):
+        self.path = path
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, vector BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_expires ON embeddings (expires_at)")
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector, expires_at FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        vector = array("f")
+        vector.frombytes(row[0])
+        return vector.tolist()
+
+    def set(self, key, vector):
+        blob = array("f", vector).tobytes()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector, expires_at) VALUES (?, ?, ?)",
+                (key, blob, time.time() + self.ttl)
+            )
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._evict()
+            self._conn.commit()
+
+    async def get_async(self, key):
+        return await asyncio.to_thread(self.get, key)
+
+    async def set_async(self, key, vector):
+        await asyncio.to_thread(self.set, key, vector)
+
+    def _evict(self):
+        self._conn.execute("DELETE FROM embeddings WHERE expires_at < ?", (time.time(),))
+        # Rows expiring soonest are the oldest writes
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN ("
+            " SELECT key FROM embeddings ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_rows,)
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+class SharedEmbeddingCache:
+    """
+    Tier in the shared state, vectors packed as float32.
+    """
+
+    def __init__(self, state, ttl=EMBEDDING_CACHE_TTL):
+        self.state = state
+        self.ttl = ttl
+
+    def get(self, key):
+        return self._unpack(self.state.get(f"embedding:{key}"))
+
+    async def get_async(self, key):
+        return self._unpack(await self.state.get_async(f"embedding:{key}"))
+
+    def set(self, key, vector):
+        self.state.set(f"embedding:{key}", array("f", vector).tobytes(), self.ttl)
+
+    async def set_async(self, key, vector):
+        await self.state.set_async(f"embedding:{key}", array("f", vector).tobytes(), self.ttl)
+
+    def _unpack(self, blob):
+        if blob is None:
+            return None
+        vector = array("f")
+        vector.frombytes(blob)
+        return vector.tolist()
+
+
+class EmbeddingCache:
+    """
+    Tiered cache: checks each backend in order and back-fills faster tiers on a hit.
+    Any object with get(key) / set(key, vector) can be used as a backend.
+    """
+
+    def __init__(self, backends):
+        self.backends = list(backends)
+        self.hits = [0] * len(self.backends)
+        self.misses = 0
+
+    def get(self, key):
+        for tier, backend in enumerate(self.backends):
+            vector = backend.get(key)
+            if vector is not None:
+                self.hits[tier] += 1
+                for faster in self.backends[:tier]:
+                    faster.set(key, vector)
+                return vector
+        self.misses += 1
+        return None
+
+    async def get_async(self, key):
+        """
+        Async version of get; shared-state tiers are awaited, not blocked on.
+        """
+        for tier, backend in enumerate(self.backends):
+            vector = await async_twin(backend, "get", key)
+            if vector is not None:
+                self.hits[tier] += 1
+                for faster in self.backends[:tier]:
+                    await async_twin(faster, "set", key, vector)
+                return vector
+        self.misses += 1
+        return None
+
+    def set(self, key, vector):
+        for backend in self.backends:
+            backend.set(key, vector)
+
+    async def set_async(self, key, vector):
+        for backend in self.backends:
+            await async_twin(backend, "set", key, vector)
+
+    def stats(self):
+        total_hits = sum(self.hits)
+        lookups = total_hits + self.misses
+        return {
+            "tiers": [type(backend).__name__ for backend in self.backends],
+            "hits_per_tier": list(self.hits),
+            "hits": total_hits,
+            "misses": self.misses,
+            "hit_rate": round(total_hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self.backends[0]) if self.backends else 0,
+        }
+
+
+def _build_default_cache():
+    backends = [MemoryEmbeddingCache()]
+    if EMBEDDING_CACHE_DB:
+        try:
+            backends.append(SqliteEmbeddingCache(EMBEDDING_CACHE_DB))
+        except sqlite3.Error as e:
+            print(f"Embedding cache: SQLite tier disabled ({str(e)})")
+    if shared_state.distributed:
+        backends.append(SharedEmbeddingCache(shared_state))
+    return EmbeddingCache(backends)
+
+
+embedding_cache = _build_default_cache()
+
+
+def cached_embedding(provider, model, dimensions, cache=None):
+    """
+    Decorator for create_embedding(text) functions (sync or async).
+    """
+    def decorator(func):
+        def lookup(text):
+            active = cache or embedding_cache
+            key = make_key(text, provider, model, dimensions)
+            return active, key, active.get(key)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(text):
+                active = cache or embedding_cache
+                key = make_key(text, provider, model, dimensions)
+                vector = await async_twin(active, "get", key)
+                if vector is None:
+                    vector = await func(text)
+                    await async_twin(active, "set", key, vector)
+                return vector
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(text):
+            active, key, vector = lookup(text)
+            if vector is None:
+                vector = func(text)
+                active.set(key, vector)
+            return vector
+        return wrapper
+
+    return decorator
+
+
+def cached_embeddings(provider, model, dimensions, cache=None):
+    """
+    Decorator for batch create_embeddings(texts) functions (sync or async).
+    Only texts missing from the cache are sent, each distinct text once;
+    results come back in input order.
+    """
+    def decorator(func):
+        def keyed(texts):
+            return cache or embedding_cache, [make_key(text, provider, model, dimensions) for text in texts]
+
+        def find_missing(texts, keys, vectors):
+            missing = {}
+            for text, key, vector in zip(texts, keys, vectors):
+                if vector is None and key not in missing:
+                    missing[key] = text
+            return missing
+
+        def merge(keys, vectors, missing, fetched):
+            fetched = dict(zip(missing, fetched))
+            return fetched, [vector if vector is not None else fetched[key] for key, vector in zip(keys, vectors)]
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(texts):
+                active, keys = keyed(texts)
+                vectors = await asyncio.gather(*(async_twin(active, "get", key) for key in keys))
+                missing = find_missing(texts, keys, vectors)
+                fetched = await func(list(missing.values())) if missing else []
+                fetched, result = merge(keys, vectors, missing, fetched)
+                await asyncio.gather(*(async_twin(active, "set", key, vector) for key, vector in fetched.items()))
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(texts):
+            active, keys = keyed(texts)
+            vectors = [active.get(key) for key in keys]
+            missing = find_missing(texts, keys, vectors)
+            fetched = func(list(missing.values())) if missing else []
+            fetched, result = merge(keys, vectors, missing, fetched)
+            for key, vector in fetched.items():
+                active.set(key, vector)
+            return result
+        return wrapper
+
+    return decorator
@@ -1,28 +1,223 @@
 import google.generativeai as genai
+from google.generativeai import caching
+import asyncio
+import datetime
 import os
-from prompts import ANSWER_PROMPT
+import threading
+import time
+from prompt_cache import answer_prompt_parts, gemini_usage, prompt_cache_key, record_usage
+from prompts import ANSWER_INSTRUCTIONS
+from context_assembly import count_tokens
+from embedding_cache import cached_embedding, cached_embeddings
+from image_cache import cached_extraction
+from embedding_batcher import EMBEDDING_BATCH_SIZE, EmbeddingBatcher, embed_in_chunks
+from resilience import call_async, call_sync, status_code
+from shared_state import shared_state
 
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
+EMBEDDING_MODEL = "models/text-embedding-004"
+EMBEDDING_DIMENSIONS = 768
+EMBEDDING_MAX_BATCH = 100  # Requests per batchEmbedContents call allowed by the API
+VISION_MODEL = "gemini-2.0-flash-vision-preview"
+ANSWER_MODEL = "gemini-2.0-flash"
+EXTRACT_PROMPT = "Extract the handwritten question from this image. Clean it up. Only return the question:"
+
+# Explicit context caching of the answer instructions (see prompt_cache.py)
+GEMINI_PROMPT_CACHE = os.getenv("GEMINI_PROMPT_CACHE", "1") == "1"
+GEMINI_PROMPT_CACHE_TTL = int(os.getenv("GEMINI_PROMPT_CACHE_TTL", "3600"))  # seconds
+# The model's minimum prompt size for explicit caching; shorter instructions are sent uncached
+GEMINI_PROMPT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_PROMPT_CACHE_MIN_TOKENS", "4096"))
+# Wait before asking again after the API refused to cache (e.g. a prefix below the model's minimum size)
+PROMPT_CACHE_RETRY_SECONDS = 600
+# Renew the cached content this long before it expires
+PROMPT_CACHE_RENEW_MARGIN = 60
+
+def _embed_batch(texts):
+    result = call_sync("gemini", genai.embed_content,
+        model=EMBEDDING_MODEL,
+        content=list(texts)
+    )
+    return result['embedding']
+
+async def _embed_batch_async(texts):
+    result = await call_async("gemini", genai.embed_content_async,
+        model=EMBEDDING_MODEL,
+        content=list(texts)
+    )
+    return result['embedding']
+
+# Concurrent single-question embeddings are merged into one request
+embedding_batcher = EmbeddingBatcher(_embed_batch_async, max_batch=min(EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_BATCH))
+
+@cached_embedding("gemini", EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
 def create_embedding(text):
-    result = genai.embed_content(
-        model="models/text-embedding-004",
+    result = call_sync("gemini", genai.embed_content,
+        model=EMBEDDING_MODEL,
         content=text
     )
     return result['embedding']
 
-# Extract handwritten question from image
+@cached_embedding("gemini", EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+async def create_embedding_async(text):
+    return await embedding_batcher.embed(text)
+
+# Embed several texts, up to EMBEDDING_MAX_BATCH per request (vectors come back in input order)
+@cached_embeddings("gemini", EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+def create_embeddings(texts):
+    texts = list(texts)
+    return [vector
+            for i in range(0, len(texts), EMBEDDING_MAX_BATCH)
+            for vector in _embed_batch(texts[i:i + EMBEDDING_MAX_BATCH])]
+
+@cached_embeddings("gemini", EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+async def create_embeddings_async(texts):
+    return await embed_in_chunks(_embed_batch_async, texts, EMBEDDING_MAX_BATCH)
+
+# Extract handwritten question from image (repeat photos come from the image cache)
+# The photo arrives downscaled and re-encoded as JPEG by cached_extraction, like for OpenAI
+@cached_extraction()
 def extract_question_from_image(img_bytes):
-    model = genai.GenerativeModel("gemini-2.0-flash-vision-preview")
-    response = model.generate_content(
-        ["Extract the handwritten question from this image. Clean it up. Only return the question:", img_bytes]
+    model = genai.GenerativeModel(VISION_MODEL)
+    image = {"mime_type": "image/jpeg", "data": img_bytes}
+    response = call_sync("gemini", model.generate_content,
+        [EXTRACT_PROMPT, image]
     )
     return response.text.strip()
 
+@cached_extraction()
+async def extract_question_from_image_async(img_bytes):
+    model = genai.GenerativeModel(VISION_MODEL)
+    image = {"mime_type": "image/jpeg", "data": img_bytes}
+    response = await call_async("gemini", model.generate_content_async,
+        [EXTRACT_PROMPT, image]
+    )
+    return response.text.strip()
+
+
+# Cached-content handle for the answer instructions, shared by all answer calls
+_instructions_cache = None
+_instructions_cache_expires = 0.0
+_instructions_cache_retry_at = 0.0
+_instructions_cache_lock = threading.Lock()
+_instructions_cacheable = None
+
+def _instructions_big_enough():
+    # Counted once; creating cached content for a shorter prompt always fails
+    global _instructions_cacheable
+    if _instructions_cacheable is None:
+        tokens = count_tokens(ANSWER_INSTRUCTIONS)
+        _instructions_cacheable = tokens >= GEMINI_PROMPT_CACHE_MIN_TOKENS
+        if not _instructions_cacheable:
+            print(f"Gemini answer instructions are about {tokens} tokens, below the "
+                  f"{GEMINI_PROMPT_CACHE_MIN_TOKENS}-token caching minimum; sending them uncached")
+    return _instructions_cacheable
+
+def _instructions_cache_stale():
+    if not GEMINI_PROMPT_CACHE or time.time() < _instructions_cache_retry_at or not _instructions_big_enough():
+        return False
+    return _instructions_cache is None or time.time() > _instructions_cache_expires - PROMPT_CACHE_RENEW_MARGIN
+
+def _shared_instructions_key():
+    return f"gemini:instructions:{prompt_cache_key(ANSWER_MODEL)}"
+
+def _refresh_instructions_cache():
+    global _instructions_cache, _instructions_cache_expires, _instructions_cache_retry_at
+    with _instructions_cache_lock:
+        if not _instructions_cache_stale():
+            return
+        try:
+            # Another worker may already have cached the instructions: "<name> <expires_at>"
+            shared = shared_state.get(_shared_instructions_key())
+            if shared is not None:
+                name, expires_at = shared.decode("utf-8").split()
+                _instructions_cache = call_sync("gemini", caching.CachedContent.get, name)
+                _instructions_cache_expires = float(expires_at)
+                print(f"Using Gemini answer instructions cached as {name}")
+                return
+            _instructions_cache = call_sync("gemini", caching.CachedContent.create,
+                model=f"models/{ANSWER_MODEL}",
+                display_name="clearmydoubts-answer-instructions",
+                system_instruction=ANSWER_INSTRUCTIONS,
+                ttl=datetime.timedelta(seconds=GEMINI_PROMPT_CACHE_TTL)
+            )
+            _instructions_cache_expires = time.time() + GEMINI_PROMPT_CACHE_TTL
+            shared_state.set(_shared_instructions_key(),
+                             f"{_instructions_cache.name} {_instructions_cache_expires}",
+                             ttl=max(1, GEMINI_PROMPT_CACHE_TTL - PROMPT_CACHE_RENEW_MARGIN))
+            print(f"Cached Gemini answer instructions as {_instructions_cache.name}")
+        except Exception as e:
+            print(f"Gemini context caching unavailable ({type(e).__name__}: {str(e)}), "
+                  f"sending the instructions uncached")
+            _instructions_cache = None
+            _instructions_cache_retry_at = time.time() + PROMPT_CACHE_RETRY_SECONDS
+
+def _drop_instructions_cache(error, forget_shared=True):
+    global _instructions_cache
+    # The cached content expired or was deleted on the server side
+    if _instructions_cache is not None and status_code(error) in (400, 403, 404):
+        print(f"Gemini cached content rejected ({status_code(error)}), recreating it")
+        _instructions_cache = None
+        if forget_shared:
+            shared_state.delete(_shared_instructions_key())
+        return True
+    return False
+
+def _answer_model():
+    # Static instructions first (cached when possible), the context and question after
+    if _instructions_cache is not None:
+        return genai.GenerativeModel.from_cached_content(_instructions_cache)
+    return genai.GenerativeModel(ANSWER_MODEL, system_instruction=ANSWER_INSTRUCTIONS)
 
 # Generate board-style answer using RAG + prompt
 def generate_answer(question, context):
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    filled_prompt = ANSWER_PROMPT.format(question=question, context=context)
-    response = model.generate_content(filled_prompt)
+    _, prompt_input = answer_prompt_parts(question, context)
+    if _instructions_cache_stale():
+        _refresh_instructions_cache()
+    start = time.perf_counter()
+    try:
+        response = call_sync("gemini", _answer_model().generate_content, prompt_input)
+    except Exception as e:
+        if not _drop_instructions_cache(e):
+            raise
+        response = call_sync("gemini", _answer_model().generate_content, prompt_input)
+    record_usage("gemini", *gemini_usage(response.usage_metadata), time.perf_counter() - start)
     return response.text.strip()
+
+async def generate_answer_async(question, context):
+    _, prompt_input = answer_prompt_parts(question, context)
+    if _instructions_cache_stale():
+        await asyncio.to_thread(_refresh_instructions_cache)
+    start = time.perf_counter()
+    try:
+        response = await call_async("gemini", _answer_model().generate_content_async, prompt_input)
+    except Exception as e:
+        if not _drop_instructions_cache(e, forget_shared=False):
+            raise
+        await shared_state.delete_async(_shared_instructions_key())
+        response = await call_async("gemini", _answer_model().generate_content_async, prompt_input)
+    record_usage("gemini", *gemini_usage(response.usage_metadata), time.perf_counter() - start)
+    return response.text.strip()
+
+async def generate_answer_stream(question, context):
+    _, prompt_input = answer_prompt_parts(question, context)
+    if _instructions_cache_stale():
+        await asyncio.to_thread(_refresh_instructions_cache)
+    start = time.perf_counter()
+    first_token = None
+    usage_metadata = None
+    try:
+        response = await call_async("gemini", _answer_model().generate_content_async, prompt_input, stream=True)
+    except Exception as e:
+        if not _drop_instructions_cache(e, forget_shared=False):
+            raise
+        await shared_state.delete_async(_shared_instructions_key())
+        response = await call_async("gemini", _answer_model().generate_content_async, prompt_input, stream=True)
+    async for chunk in response:
+        # Every chunk carries the usage so far; the last one has the totals
+        usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+        if chunk.text:
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            yield chunk.text
+    record_usage("gemini", *gemini_usage(usage_metadata), first_token)
@@ -0,0 +1,179 @@
+"""
+Managed HTTP clients for outbound calls (WhatsApp Cloud API, Twilio, Supabase).
+Each service gets one long-lived client with a keep-alive connection pool
+(HTTP/2 when the h2 package is installed), so a reply with several chunks
+or an image download does not pay a new TCP+TLS handshake every time.
+Pools are warmed up at app startup and report reused vs. new connections.
+"""
+import asyncio
+import os
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1"
+HTTP_WARMUP_CONNECTIONS = int(os.getenv("HTTP_WARMUP_CONNECTIONS", "1"))
+
+try:
+    import h2  # noqa: F401 - only needed for httpx HTTP/2 support
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_async_clients = {}
+_sessions = {}
+_pool_stats = {}
+_warmup_urls = {}
+
+
+def _stats_for(name):
+    if name not in _pool_stats:
+        _pool_stats[name] = {"requests": 0, "new_connections": 0}
+    return _pool_stats[name]
+
+
+def _make_tracer(stats):
+    # httpcore reports each new TCP connection through the "trace" extension
+    async def trace(event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            stats["new_connections"] += 1
+    return trace
+
+
+def get_async_client(name="default"):
+    """
+    Return the shared httpx.AsyncClient for a service, creating it on first use.
+    """
+    client = _async_clients.get(name)
+    if client is None or client.is_closed:
+        stats = _stats_for(name)
+        tracer = _make_tracer(stats)
+
+        async def on_request(request):
+            stats["requests"] += 1
+            request.extensions["trace"] = tracer
+
+        client = httpx.AsyncClient(
+            http2=HTTP2_ENABLED and HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            ),
+            # Twilio media URLs redirect to the storage bucket, so follow redirects
+            follow_redirects=True,
+            event_hooks={"request": [on_request]}
+        )
+        _async_clients[name] = client
+    return client
+
+
+def get_session(name="default"):
+    """
+    Return the shared requests.Session for a service (used by the sync helpers).
+    Pass timeout=HTTP_TIMEOUT on each call, requests has no session-level timeout.
+    """
+    session = _sessions.get(name)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_MAX_KEEPALIVE, pool_maxsize=HTTP_MAX_KEEPALIVE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _sessions[name] = session
+    return session
+
+
+def register_warmup_url(name, url, headers=None):
+    """
+    Register a URL whose host should be connected to at startup.
+    Any response (even 4xx) is fine, the point is to open the connection.
+    """
+    _warmup_urls[name] = (url, headers or {})
+
+
+async def warmup():
+    """
+    Open HTTP_WARMUP_CONNECTIONS connections to every registered host.
+    """
+    async def ping(name, url, headers):
+        try:
+            await get_async_client(name).get(url, headers=headers)
+        except Exception as e:
+            return e
+        return None
+
+    names = [name for name in _warmup_urls for _ in range(max(0, HTTP_WARMUP_CONNECTIONS))]
+    if not names:
+        return
+    results = await asyncio.gather(*(ping(name, *_warmup_urls[name]) for name in names))
+
+    # A service is warm if one of its connections opened; report it failed otherwise
+    errors = {}
+    warmed = []
+    for name, error in zip(names, results):
+        if error is None:
+            if name not in warmed:
+                warmed.append(name)
+        else:
+            errors.setdefault(name, error)
+    for name, error in errors.items():
+        if name not in warmed:
+            print(f"HTTP warm-up for {name} failed ({type(error).__name__}: {str(error)})")
+    if warmed:
+        print(f"HTTP pools warmed up: {', '.join(warmed)}")
+
+
+def _session_stats(session):
+    requests_count = 0
+    new_connections = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                requests_count += pool.num_requests
+                new_connections += pool.num_connections
+    return requests_count, new_connections
+
+
+def pool_stats():
+    """
+    Requests, new connections and reused connections per client.
+    """
+    result = {}
+    for name, stats in _pool_stats.items():
+        client = _async_clients.get(name)
+        result[name] = {
+            "http2_enabled": bool(client and not client.is_closed and HTTP2_ENABLED and HTTP2_AVAILABLE),
+            "requests": stats["requests"],
+            "new_connections": stats["new_connections"],
+            "reused_connections": max(0, stats["requests"] - stats["new_connections"]),
+        }
+    for name, session in _sessions.items():
+        requests_count, new_connections = _session_stats(session)
+        result[f"{name}_sync"] = {
+            "http2_enabled": False,
+            "requests": requests_count,
+            "new_connections": new_connections,
+            "reused_connections": max(0, requests_count - new_connections),
+        }
+    return result
+
+
+async def close_clients():
+    """
+    Close every shared client (called on app shutdown).
+    """
+    clients = list(_async_clients.values())
+    _async_clients.clear()
+    for client in clients:
+        await client.aclose()
+    for session in _sessions.values():
+        session.close()
+    _sessions.clear()
@@ -0,0 +1,216 @@
+"""
+Cache of questions extracted from images.
+Students forward the same worksheet photo again and again, and every copy
+used to cost a vision-model call. Extracted questions are stored under two
+keys: the SHA-256 of the image bytes (exact copies) and a perceptual
+difference hash (dHash) of the downscaled image, which survives
+WhatsApp re-compression and resizing. An image whose dHash is within
+IMAGE_CACHE_MAX_DISTANCE bits of a cached one reuses its question.
+Both keys come from image_preprocess.prepare_image, in the same decode as
+the preprocessing, so the size caps apply before anything is decoded.
+With SHARED_STATE_URL set, questions are also stored by SHA-256 in the
+shared state, so an image read by one worker is an exact hit on the others
+(near-duplicate matching stays per worker).
+"""
+import functools
+import inspect
+import os
+import threading
+import time
+import numpy as np
+from image_preprocess import prepare_image, prepare_image_async
+from shared_state import shared_state
+
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE_ENABLED", "1") == "1"
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "5000"))
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 3600)))
+# dHash of a HASH_SIZE x HASH_SIZE grid (256 bits by default)
+IMAGE_CACHE_HASH_SIZE = int(os.getenv("IMAGE_CACHE_HASH_SIZE", "16"))
+# Max differing bits for a near-duplicate; 0 disables perceptual matching.
+# A near hit is served without looking at the image again, and worksheet
+# pages with the same layout but other numbers differ by only a few bits
+# after the downscale: 3-4 on printed pages, where resized, re-compressed
+# copies of one page were 0-3 apart (mostly 1-2). A looser setting answers
+# the wrong question; a forwarded photo with unchanged bytes is an exact hit.
+IMAGE_CACHE_MAX_DISTANCE = int(os.getenv("IMAGE_CACHE_MAX_DISTANCE", "2"))
+
+
+def _popcount(words):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1)
+    return np.unpackbits(words.view(np.uint8), axis=-1).sum(axis=-1)
+
+
+class ImageQuestionCache:
+    """
+    Fixed-capacity store of (sha256, dHash, question). dHashes live in one
+    uint64 matrix, so a near-duplicate lookup is a single vectorized XOR +
+    popcount over all entries. When full, expired entries are replaced
+    first, then the least recently used one. `shared` is an optional
+    shared-state backend consulted by SHA-256 after a local miss.
+    """
+
+    def __init__(self, max_size=IMAGE_CACHE_SIZE, ttl=IMAGE_CACHE_TTL,
+                 max_distance=IMAGE_CACHE_MAX_DISTANCE, hash_size=IMAGE_CACHE_HASH_SIZE, shared=None):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.shared = shared
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        words = max(1, -(-hash_size * hash_size // 64))
+        self._hashes = np.zeros((self.max_size, words), dtype=np.uint64)
+        self._has_hash = np.zeros(self.max_size, dtype=bool)
+        self._last_used = np.zeros(self.max_size, dtype=np.float64)
+        self._expires = np.zeros(self.max_size, dtype=np.float64)
+        self._digests = [None] * self.max_size
+        self._questions = [None] * self.max_size
+        self._slots = {}  # sha256 -> slot
+        self._count = 0
+
+    def lookup(self, digest, phash=None):
+        """
+        Return the cached question for an identical or near-identical image, or None.
+        """
+        question = self._lookup_local(digest, phash)
+        if question is None and self.shared is not None:
+            question = self._shared_hit(digest, phash, self.shared.get(f"image:{digest}"))
+        if question is None:
+            self.misses += 1
+        return question
+
+    async def lookup_async(self, digest, phash=None):
+        """
+        Async version of lookup; the shared tier is awaited, not blocked on.
+        """
+        question = self._lookup_local(digest, phash)
+        if question is None and self.shared is not None:
+            question = self._shared_hit(digest, phash, await self.shared.get_async(f"image:{digest}"))
+        if question is None:
+            self.misses += 1
+        return question
+
+    def _lookup_local(self, digest, phash):
+        now = time.time()
+        with self._lock:
+            slot = self._slots.get(digest)
+            if slot is not None and self._expires[slot] >= now:
+                self.exact_hits += 1
+                self._last_used[slot] = now
+                return self._questions[slot]
+
+            if phash is not None and self.max_distance > 0 and self._count:
+                distances = _popcount(self._hashes[:self._count] ^ phash)
+                usable = self._has_hash[:self._count] & (self._expires[:self._count] >= now)
+                distances = np.where(usable, distances, self._hashes.shape[1] * 64 + 1)
+                best = int(np.argmin(distances))
+                if distances[best] <= self.max_distance:
+                    self.near_hits += 1
+                    self._last_used[best] = now
+                    return self._questions[best]
+        return None
+
+    def _shared_hit(self, digest, phash, value):
+        if value is None:
+            return None
+        self.shared_hits += 1
+        question = value.decode("utf-8")
+        self._store(digest, phash, question)
+        return question
+
+    def add(self, digest, phash, question):
+        self._store(digest, phash, question)
+        if self.shared is not None:
+            self.shared.set(f"image:{digest}", question, self.ttl)
+
+    async def add_async(self, digest, phash, question):
+        self._store(digest, phash, question)
+        if self.shared is not None:
+            await self.shared.set_async(f"image:{digest}", question, self.ttl)
+
+    def _store(self, digest, phash, question):
+        now = time.time()
+        with self._lock:
+            slot = self._slots.get(digest)
+            if slot is None:
+                if self._count < self.max_size:
+                    slot = self._count
+                    self._count += 1
+                else:
+                    last_used = np.where(self._expires < now, -1.0, self._last_used)
+                    slot = int(np.argmin(last_used))
+                    del self._slots[self._digests[slot]]
+                self._slots[digest] = slot
+            self._digests[slot] = digest
+            self._questions[slot] = question
+            self._has_hash[slot] = phash is not None
+            if phash is not None:
+                self._hashes[slot] = phash
+            self._last_used[slot] = now
+            self._expires[slot] = now + self.ttl
+
+    def stats(self):
+        hits = self.exact_hits + self.near_hits + self.shared_hits
+        lookups = hits + self.misses
+        return {
+            "enabled": IMAGE_CACHE_ENABLED,
+            "entries": self._count,
+            "max_size": self.max_size,
+            "max_distance": self.max_distance,
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# Shared by both AI providers: the extracted question doesn't depend on which model read it
+image_cache = ImageQuestionCache(shared=shared_state if shared_state.distributed else None)
+
+
+def cached_extraction(cache=None):
+    """
+    Decorator for extract_question_from_image(img_bytes) functions (sync or async).
+    The upload is preprocessed (and hashed) here, under the size caps, and
+    the wrapped function gets the preprocessed JPEG. The async version does
+    that in the image worker processes.
+    """
+    def decorator(func):
+        def hash_size():
+            return (cache or image_cache).hash_size if IMAGE_CACHE_ENABLED else 0
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(img_bytes):
+                data, digest, phash = await prepare_image_async(img_bytes, hash_size())
+                if not IMAGE_CACHE_ENABLED:
+                    return await func(data)
+                active = cache or image_cache
+                question = await active.lookup_async(digest, phash)
+                if question is None:
+                    question = await func(data)
+                    if question:
+                        await active.add_async(digest, phash, question)
+                return question
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(img_bytes):
+            data, digest, phash = prepare_image(img_bytes, hash_size())
+            if not IMAGE_CACHE_ENABLED:
+                return func(data)
+            active = cache or image_cache
+            question = active.lookup(digest, phash)
+            if question is None:
+                question = func(data)
+                if question:
+                    active.add(digest, phash, question)
+            return question
+        return wrapper
+
+    return decorator
@@ -0,0 +1,172 @@
+"""
+Image preprocessing shared by both AI providers before a vision call.
+Phone photos are 12 MP JPEGs, but question extraction only needs about
+1024 px. JPEG draft mode makes the decoder downscale by up to 8x while
+decoding, so a full-size bitmap is never built. The EXIF orientation is
+applied, colourless pages become grayscale, and the result is re-encoded
+as a plain JPEG. Work runs in a process pool so it never holds the event
+loop (or the GIL) while requests are being handled.
+prepare_image also returns the image cache keys, hashed from the same
+decode, so an upload is only decoded once and only after the size caps.
+"""
+import asyncio
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import numpy as np
+from PIL import Image, ImageOps, ImageStat
+
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(15 * 1024 * 1024)))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(50_000_000)))
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+# "auto" converts pages without meaningful colour to grayscale, "1" always, "0" never
+IMAGE_GRAYSCALE = os.getenv("IMAGE_GRAYSCALE", "auto").lower()
+# 0 runs preprocessing in a thread instead of a process pool
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", "2"))
+
+# Spread of the chroma channels below which a page counts as colourless
+GRAYSCALE_CHROMA_STDDEV = 6.0
+
+
+class ImageRejectedError(ValueError):
+    """
+    Raised for images over the configured byte or pixel limits.
+    """
+
+
+def _is_colourless(img):
+    # A uniform paper tint shifts the chroma mean but not its spread;
+    # coloured diagrams, highlights and dense coloured ink raise the spread
+    small = img.resize((64, 64), Image.Resampling.BILINEAR).convert("YCbCr")
+    _, cb, cr = ImageStat.Stat(small).stddev
+    return cb + cr < GRAYSCALE_CHROMA_STDDEV
+
+
+def dhash(img, hash_size):
+    """
+    Difference hash of a PIL image: one bit per pixel of a (hash_size+1) x
+    hash_size grayscale thumbnail, set when it is brighter than its right
+    neighbour. Returned as a uint64 array of hash_size * hash_size / 64 words.
+    """
+    pixels = np.asarray(img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR),
+                        dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    bits = np.concatenate([bits, np.zeros(-len(bits) % 64, dtype=bool)])
+    return np.packbits(bits).view(">u8").astype(np.uint64)
+
+
+def _preprocess(img_bytes, max_side, quality, grayscale):
+    # (JPEG bytes, the decoded image, or None when the original is passed through)
+    if len(img_bytes) > IMAGE_MAX_BYTES:
+        raise ImageRejectedError(f"Image is {len(img_bytes)} bytes, limit is {IMAGE_MAX_BYTES}")
+    try:
+        img = Image.open(BytesIO(img_bytes))
+    except Image.DecompressionBombError as e:
+        # Pillow's own guard, for sizes far over IMAGE_MAX_PIXELS
+        raise ImageRejectedError(str(e)) from e
+    except Exception as e:
+        print(f"Image preprocessing error: {e}, using original")
+        return img_bytes, None
+    width, height = img.size
+    if width * height > IMAGE_MAX_PIXELS:
+        raise ImageRejectedError(f"Image is {width}x{height}, limit is {IMAGE_MAX_PIXELS} pixels")
+
+    try:
+        # Decode JPEGs at the smallest 1/2, 1/4 or 1/8 scale that still covers the target size
+        scale = min(1.0, max_side / max(width, height))
+        img.draft("RGB", (int(width * scale), int(height * scale)))
+        if max(img.size) > max_side:
+            # Draft mode already did the heavy reduction; this is the last <2x step.
+            # The box is square, so resizing before the EXIF rotation gives the same size.
+            img.thumbnail((max_side, max_side), Image.Resampling.BILINEAR, reducing_gap=2.0)
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            if "A" in img.getbands() or img.info.get("transparency") is not None:
+                # Transparent areas become white, not black
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            else:
+                img = img.convert("RGB")
+        if img.mode == "RGB" and (grayscale == "1" or (grayscale == "auto" and _is_colourless(img))):
+            img = img.convert("L")
+
+        output = BytesIO()
+        img.save(output, format="JPEG", quality=quality)
+        return output.getvalue(), img
+    except Exception as e:
+        print(f"Image preprocessing error: {e}, using original")
+        return img_bytes, None
+
+
+def preprocess_image(img_bytes, max_side=IMAGE_MAX_SIDE, quality=IMAGE_JPEG_QUALITY, grayscale=IMAGE_GRAYSCALE):
+    """
+    Downscale, orient and re-encode an image as JPEG for a vision model.
+    Raises ImageRejectedError if it is over the size caps; images Pillow
+    can't read are returned unchanged, as compress_image used to do.
+    """
+    return _preprocess(img_bytes, max_side, quality, grayscale)[0]
+
+
+def prepare_image(img_bytes, hash_size=0):
+    """
+    preprocess_image plus the image cache keys: (JPEG bytes, SHA-256 of the
+    upload, dHash of the downscaled image or None). No dHash without
+    hash_size, or when the image can't be decoded.
+    """
+    data, img = _preprocess(img_bytes, IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY, IMAGE_GRAYSCALE)
+    digest = hashlib.sha256(img_bytes).hexdigest()
+    phash = None
+    if img is not None and hash_size:
+        try:
+            phash = dhash(img, hash_size)
+        except Exception as e:
+            print(f"Image cache: perceptual hash failed ({str(e)}), exact matches only")
+    return data, digest, phash
+
+
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # Spawned, not forked: the server process has threads (HTTP pools, job workers)
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS,
+                                    mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+async def _in_pool(func, *args):
+    if IMAGE_PREPROCESS_WORKERS <= 0:
+        return await asyncio.to_thread(func, *args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pool(), func, *args)
+
+
+async def preprocess_image_async(img_bytes):
+    """
+    Async version of preprocess_image, run in the worker process pool.
+    """
+    return await _in_pool(preprocess_image, img_bytes)
+
+
+async def prepare_image_async(img_bytes, hash_size=0):
+    """
+    Async version of prepare_image, run in the worker process pool.
+    """
+    return await _in_pool(prepare_image, img_bytes, hash_size)
+
+
+def shutdown_pool():
+    """
+    Stop the worker processes (called on app shutdown).
+    """
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
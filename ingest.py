@@ -0,0 +1,564 @@
+"""
+PDF ingestion for the RAG corpus (NCERT books, past papers).
+Pages are read with pypdf and split into overlapping chunks in a process
+pool, a few pages per task, so large PDFs are streamed rather than loaded
+whole. Chunks are embedded in batches with several requests in flight,
+then bulk-upserted into the Supabase table behind match_cbse_context, or
+written to a local vector index (see local_index.py).
+
+Every chunk is keyed by a hash of its text and the embedding model. The
+hashes already stored are kept in a SQLite state file (INGEST_STATE_DB),
+updated after every written batch, so an interrupted run picks up where it
+stopped and re-running over a changed corpus only embeds the new chunks.
+Files whose size and mtime haven't changed since they were completed are
+not parsed again.
+
+    python ingest.py books/ papers/2024.pdf
+    python ingest.py books/ --local-index rag_index
+
+Upserting needs a unique column for the hash (INGEST_HASH_COLUMN) on the
+table, e.g. `alter table vectors add column content_hash text unique;`.
+"""
+import argparse
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+INGEST_CHUNK_CHARS = int(os.getenv("INGEST_CHUNK_CHARS", "1200"))
+INGEST_CHUNK_OVERLAP = int(os.getenv("INGEST_CHUNK_OVERLAP", "200"))
+INGEST_PAGES_PER_TASK = int(os.getenv("INGEST_PAGES_PER_TASK", "8"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0"))  # 0 uses every CPU
+INGEST_EMBED_BATCH = int(os.getenv("INGEST_EMBED_BATCH", "256"))  # texts per embeddings call
+INGEST_EMBED_CONCURRENCY = int(os.getenv("INGEST_EMBED_CONCURRENCY", "4"))  # embeddings calls in flight
+INGEST_UPSERT_BATCH = int(os.getenv("INGEST_UPSERT_BATCH", "1000"))  # rows per upsert
+INGEST_STATE_DB = os.getenv("INGEST_STATE_DB", "ingest_state.db")
+INGEST_HASH_COLUMN = os.getenv("INGEST_HASH_COLUMN", "content_hash")
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 5.0
+
+
+def clean_page_text(text):
+    """
+    Undo line-end hyphenation and collapse whitespace in extracted page text.
+    """
+    text = re.sub(r"(\w)-\n(\w)", r"\1\2", text or "")
+    return " ".join(text.split())
+
+
+def split_text(text, size=INGEST_CHUNK_CHARS, overlap=INGEST_CHUNK_OVERLAP):
+    """
+    Split text into chunks of at most `size` characters, each starting
+    `overlap` characters before the previous one ended. Cuts are moved
+    back to a sentence end or space where one is near. Returns
+    (start offset, chunk) pairs.
+    """
+    overlap = max(0, min(overlap, size // 2))
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            window = text[start + size // 2:end]
+            cut = max(window.rfind(". "), window.rfind("? "), window.rfind("! "))
+            if cut >= 0:
+                end = start + size // 2 + cut + 1
+            else:
+                cut = window.rfind(" ")
+                if cut >= 0:
+                    end = start + size // 2 + cut
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append((start, chunk))
+        if end >= len(text):
+            break
+        next_start = end - overlap
+        space = text.find(" ", next_start, end)
+        start = space + 1 if space >= 0 else end
+    return chunks
+
+
+def chunk_hash(text, model):
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+# One open PdfReader per worker process; pypdf parses pages lazily
+_reader = None
+_reader_path = None
+
+
+def _get_reader(path):
+    global _reader, _reader_path
+    if _reader_path != path:
+        from pypdf import PdfReader
+        _reader = PdfReader(path)
+        _reader_path = path
+    return _reader
+
+
+def extract_chunks(path, first_page, last_page, model, size=INGEST_CHUNK_CHARS, overlap=INGEST_CHUNK_OVERLAP):
+    """
+    Read pages [first_page, last_page) of a PDF and chunk their text.
+    Runs in the worker pool. Returns (page number from 1, hash, text) tuples.
+    """
+    reader = _get_reader(path)
+    texts = []
+    offsets = []  # start offset of each page in the joined text
+    length = 0
+    for number in range(first_page, last_page):
+        try:
+            text = clean_page_text(reader.pages[number].extract_text())
+        except Exception as e:
+            print(f"Could not read page {number + 1} of {path}: {e}")
+            text = ""
+        offsets.append(length)
+        texts.append(text)
+        length += len(text) + 1
+
+    chunks = []
+    for start, text in split_text(" ".join(texts), size, overlap):
+        page = first_page + int(np.searchsorted(offsets, start, side="right"))
+        chunks.append((page, chunk_hash(text, model), text))
+    return chunks
+
+
+class IngestState:
+    """
+    SQLite record of ingested chunk hashes and completed files. For a local
+    index target it also keeps each chunk's text and embedding, so the index
+    can be rebuilt without embedding anything again.
+    """
+
+    def __init__(self, path=INGEST_STATE_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "hash TEXT NOT NULL, target TEXT NOT NULL, source TEXT, page INTEGER, "
+            "content TEXT, embedding BLOB, ingested_at REAL NOT NULL, PRIMARY KEY (target, hash))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT NOT NULL, target TEXT NOT NULL, size INTEGER, mtime REAL, pages INTEGER, "
+            "completed_at REAL, PRIMARY KEY (path, target))"
+        )
+        self._conn.commit()
+
+    def is_file_done(self, path, target):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime FROM files WHERE path = ? AND target = ? AND completed_at IS NOT NULL",
+                (os.path.abspath(path), target)
+            ).fetchone()
+        stat = os.stat(path)
+        return row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime
+
+    def mark_file_done(self, path, target, pages):
+        stat = os.stat(path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, target, size, mtime, pages, completed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(path), target, stat.st_size, stat.st_mtime, pages, time.time())
+            )
+            self._conn.commit()
+
+    def known_hashes(self, hashes, target):
+        """
+        The subset of `hashes` already written to `target`.
+        """
+        known = set()
+        hashes = list(hashes)
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i:i + 500]
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT hash FROM chunks WHERE target = ? AND hash IN ({','.join('?' * len(batch))})",
+                    (target, *batch)
+                ).fetchall()
+            known.update(row[0] for row in rows)
+        return known
+
+    def add_chunks(self, target, rows, keep_vectors=False):
+        """
+        Record written chunks: rows of (hash, source, page, text, vector).
+        """
+        now = time.time()
+        values = [(h, target, source, page,
+                   text if keep_vectors else None,
+                   np.asarray(vector, dtype=np.float32).tobytes() if keep_vectors else None,
+                   now)
+                  for h, source, page, text, vector in rows]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (hash, target, source, page, content, embedding, ingested_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", values
+            )
+            self._conn.commit()
+
+    def iter_vectors(self, target, page_size=4096):
+        """
+        Yield (contents, vectors) batches of every chunk stored for `target`.
+        """
+        last = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT hash, content, embedding FROM chunks "
+                    "WHERE target = ? AND embedding IS NOT NULL AND hash > ? ORDER BY hash LIMIT ?",
+                    (target, last, page_size)
+                ).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield [row[1] for row in rows], np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+
+    def close(self):
+        self._conn.close()
+
+
+def find_pdfs(paths):
+    """
+    Expand files and directories (searched recursively) into PDF paths.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                found.extend(os.path.join(root, name) for name in sorted(names) if name.lower().endswith(".pdf"))
+        else:
+            found.append(path)
+    return sorted(dict.fromkeys(found))
+
+
+def _page_count(path):
+    from pypdf import PdfReader
+    return len(PdfReader(path).pages)
+
+
+def _embedding_functions(provider):
+    if provider == "gemini":
+        import gemini_utils as module
+    else:
+        import openai_utils as module
+    # Bypass the question-embedding cache: corpus chunks would only evict questions from it
+    embed = getattr(module.create_embeddings_async, "__wrapped__", module.create_embeddings_async)
+    return embed, module.EMBEDDING_MODEL, module.EMBEDDING_DIMENSIONS
+
+
+def _upsert_supabase(table, rows, content_column, embedding_column, hash_column, metadata_column):
+    from postgrest.types import ReturnMethod
+    from resilience import call_sync
+    from supabase_utils import supabase
+
+    records = []
+    for h, source, page, text, vector in rows:
+        record = {content_column: text, embedding_column: list(vector), hash_column: h}
+        if metadata_column:
+            record[metadata_column] = {"source": os.path.basename(source), "page": page}
+        records.append(record)
+    # returning=minimal: don't send every vector back in the response
+    request = supabase.table(table).upsert(records, on_conflict=hash_column, returning=ReturnMethod.minimal)
+    call_sync("supabase", request.execute)
+
+
+class Ingestor:
+    """
+    Runs the parse -> embed -> write pipeline. `write(rows)` stores a batch
+    of (hash, source, page, text, vector) rows; with `local_index` set the
+    rows only go into the state file and the index is built at the end.
+    """
+
+    def __init__(self, state, target, write=None, provider="gpt", workers=INGEST_WORKERS,
+                 pages_per_task=INGEST_PAGES_PER_TASK, chunk_chars=INGEST_CHUNK_CHARS,
+                 chunk_overlap=INGEST_CHUNK_OVERLAP, embed_batch=INGEST_EMBED_BATCH,
+                 embed_concurrency=INGEST_EMBED_CONCURRENCY, upsert_batch=INGEST_UPSERT_BATCH,
+                 keep_vectors=False):
+        self.state = state
+        self.write = write
+        self.embed, self.model, self.dimensions = _embedding_functions(provider)
+        self.model_key = f"{self.model}:{self.dimensions}"
+        # Hashes include the model, so switching model re-embeds everything
+        self.target = f"{target}:{self.model_key}"
+        self.workers = workers or os.cpu_count() or 1
+        self.pages_per_task = max(1, pages_per_task)
+        self.chunk_chars = chunk_chars
+        self.chunk_overlap = chunk_overlap
+        self.embed_batch = max(1, embed_batch)
+        self.embed_concurrency = max(1, embed_concurrency)
+        self.upsert_batch = max(1, upsert_batch)
+        self.keep_vectors = keep_vectors
+
+        # Counters
+        self.files = 0
+        self.files_skipped = 0
+        self.pages = 0
+        self.chunks = 0
+        self.chunks_skipped = 0
+        self.chunks_embedded = 0
+        self.chunks_written = 0
+        self._started = None
+        self._last_progress = 0.0
+
+    def _progress(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self._last_progress < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        elapsed = max(now - self._started, 1e-9)
+        print(f"{self.pages} pages ({self.pages / elapsed:.1f}/s), {self.chunks} chunks "
+              f"({self.chunks / elapsed:.1f}/s), {self.chunks_skipped} unchanged, "
+              f"{self.chunks_embedded} embedded, {self.chunks_written} written")
+
+    async def _produce(self, pool, paths, embed_queue):
+        loop = asyncio.get_running_loop()
+        seen = set()  # hashes queued in this run, so repeated text is embedded once
+        pending = []
+
+        async def flush(force=False):
+            while len(pending) >= self.embed_batch or (force and pending):
+                batch = pending[:self.embed_batch]
+                del pending[:self.embed_batch]
+                await embed_queue.put(batch)
+
+        for path in paths:
+            if self.state.is_file_done(path, self.target):
+                self.files_skipped += 1
+                print(f"Skipping {path}: unchanged since it was ingested")
+                continue
+            page_count = await loop.run_in_executor(None, _page_count, path)
+            tasks = [(first, min(first + self.pages_per_task, page_count))
+                     for first in range(0, page_count, self.pages_per_task)]
+            # Keep a couple of tasks per worker queued, not the whole file
+            futures = []
+            for first, last in tasks:
+                futures.append((path, last - first, loop.run_in_executor(
+                    pool, extract_chunks, path, first, last, self.model_key, self.chunk_chars, self.chunk_overlap)))
+                if len(futures) < 2 * self.workers:
+                    continue
+                await self._collect(futures.pop(0), seen, pending)
+                await flush()
+            for task in futures:
+                await self._collect(task, seen, pending)
+                await flush()
+            await flush(force=True)
+            # The file is done once its last chunks are written, see _write_loop
+            await embed_queue.put(("file", path, page_count))
+            self.files += 1
+
+    async def _collect(self, task, seen, pending):
+        path, pages, future = task
+        chunks = await future
+        self.pages += pages
+        self.chunks += len(chunks)
+        known = self.state.known_hashes((h for _, h, _ in chunks), self.target)
+        for page, h, text in chunks:
+            if h in known or h in seen:
+                self.chunks_skipped += 1
+                continue
+            seen.add(h)
+            pending.append((h, path, page, text))
+        self._progress()
+
+    async def _embed_loop(self, embed_queue, write_queue, semaphore):
+        # Batches are embedded concurrently but handed to the writer in order,
+        # so a file's completion marker never overtakes its chunks
+        in_flight = []
+
+        async def embed(batch):
+            async with semaphore:
+                vectors = await self.embed([text for _, _, _, text in batch])
+            self.chunks_embedded += len(batch)
+            return [(h, source, page, text, vector) for (h, source, page, text), vector in zip(batch, vectors)]
+
+        try:
+            while True:
+                item = await embed_queue.get()
+                if item is None:
+                    break
+                if isinstance(item, tuple):
+                    in_flight.append(item)
+                else:
+                    in_flight.append(asyncio.create_task(embed(item)))
+                while len(in_flight) > self.embed_concurrency or (in_flight and isinstance(in_flight[0], tuple)):
+                    head = in_flight.pop(0)
+                    await write_queue.put(head if isinstance(head, tuple) else await head)
+            while in_flight:
+                head = in_flight.pop(0)
+                await write_queue.put(head if isinstance(head, tuple) else await head)
+            await write_queue.put(None)
+        finally:
+            # After a failed batch, don't leave the others running
+            for task in in_flight:
+                if not isinstance(task, tuple):
+                    task.cancel()
+
+    async def _write_rows(self, rows):
+        if self.write is not None:
+            await asyncio.to_thread(self.write, rows)
+        await asyncio.to_thread(self.state.add_chunks, self.target, rows, self.keep_vectors)
+        self.chunks_written += len(rows)
+        self._progress()
+
+    async def _write_loop(self, write_queue):
+        rows = []
+        while True:
+            item = await write_queue.get()
+            if item is None:
+                break
+            if isinstance(item, tuple):
+                _, path, page_count = item
+                if rows:
+                    await self._write_rows(rows)
+                    rows = []
+                self.state.mark_file_done(path, self.target, page_count)
+                continue
+            rows.extend(item)
+            while len(rows) >= self.upsert_batch:
+                await self._write_rows(rows[:self.upsert_batch])
+                rows = rows[self.upsert_batch:]
+        if rows:
+            await self._write_rows(rows)
+
+    async def run(self, paths):
+        self._started = time.perf_counter()
+        embed_queue = asyncio.Queue(maxsize=2 * self.embed_concurrency)
+        write_queue = asyncio.Queue(maxsize=2 * self.embed_concurrency)
+        semaphore = asyncio.Semaphore(self.embed_concurrency)
+        # Spawned, not forked, like the image preprocessing pool
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        async def produce():
+            await self._produce(pool, paths, embed_queue)
+            await embed_queue.put(None)
+
+        try:
+            # The queues are bounded, so if one stage fails the others would
+            # block on them forever: the first error cancels the rest and
+            # fails the run. Files are only marked done once written, so a
+            # rerun resumes from there.
+            tasks = [
+                asyncio.create_task(produce()),
+                asyncio.create_task(self._embed_loop(embed_queue, write_queue, semaphore)),
+                asyncio.create_task(self._write_loop(write_queue)),
+            ]
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            for task in tasks:
+                if task in done and task.exception() is not None:
+                    raise task.exception()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        self._progress(force=True)
+        return self.summary()
+
+    def summary(self):
+        elapsed = time.perf_counter() - self._started
+        return {
+            "files": self.files,
+            "files_skipped": self.files_skipped,
+            "pages": self.pages,
+            "chunks": self.chunks,
+            "chunks_skipped": self.chunks_skipped,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_written": self.chunks_written,
+            "seconds": round(elapsed, 2),
+            "pages_per_second": round(self.pages / elapsed, 2) if elapsed else 0.0,
+            "chunks_per_second": round(self.chunks / elapsed, 2) if elapsed else 0.0,
+        }
+
+
+def ingest(paths, table=None, local_index=None, provider="gpt", state_path=INGEST_STATE_DB,
+           content_column="content", embedding_column="embedding", hash_column=INGEST_HASH_COLUMN,
+           metadata_column=None, ivf=None, **options):
+    """
+    Ingest PDFs into a Supabase table, or into a local index directory when
+    `local_index` is given. Returns the run summary.
+    """
+    paths = find_pdfs(paths)
+    if not paths:
+        raise ValueError("No PDF files found")
+    state = IngestState(state_path)
+    try:
+        if local_index:
+            ingestor = Ingestor(state, f"local:{os.path.abspath(local_index)}", provider=provider,
+                                keep_vectors=True, **options)
+        else:
+            def write(rows):
+                _upsert_supabase(table, rows, content_column, embedding_column, hash_column, metadata_column)
+            ingestor = Ingestor(state, f"supabase:{table}", write=write, provider=provider, **options)
+
+        print(f"Ingesting {len(paths)} PDF files into {ingestor.target} with {ingestor.workers} workers")
+        try:
+            summary = asyncio.run(ingestor.run(paths))
+        except Exception as e:
+            print(f"Ingestion stopped ({type(e).__name__}: {str(e)}) after {ingestor.chunks_written} chunks "
+                  f"written; run it again to resume")
+            raise
+
+        if local_index:
+            from local_index import LocalIndexWriter
+            writer = LocalIndexWriter(local_index, meta={"source": "ingest", "model": ingestor.model})
+            for contents, vectors in state.iter_vectors(ingestor.target):
+                writer.add(contents, vectors)
+            meta = writer.close(ivf=ivf)
+            print(f"Wrote {meta['count']} chunks ({meta['dimensions']} dims, ivf={meta['ivf']}) to {local_index}")
+    finally:
+        state.close()
+
+    print(f"Ingested {summary['pages']} pages in {summary['seconds']:.1f}s: "
+          f"{summary['pages_per_second']:.1f} pages/s, {summary['chunks_per_second']:.1f} chunks/s, "
+          f"{summary['chunks_embedded']} chunks embedded, {summary['chunks_skipped']} unchanged")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest PDFs into the RAG corpus")
+    parser.add_argument("paths", nargs="+", help="PDF files or directories")
+    parser.add_argument("--table", default=os.getenv("SUPABASE_TABLE", "vectors"))
+    parser.add_argument("--local-index", help="Write a local index directory instead of upserting to Supabase")
+    parser.add_argument("--provider", choices=("gpt", "gemini"), default="gpt",
+                        help="Embedding provider; must match the index (see RAG_EMBEDDING_DIMENSIONS)")
+    parser.add_argument("--state", default=INGEST_STATE_DB)
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS)
+    parser.add_argument("--pages-per-task", type=int, default=INGEST_PAGES_PER_TASK)
+    parser.add_argument("--chunk-chars", type=int, default=INGEST_CHUNK_CHARS)
+    parser.add_argument("--chunk-overlap", type=int, default=INGEST_CHUNK_OVERLAP)
+    parser.add_argument("--embed-batch", type=int, default=INGEST_EMBED_BATCH)
+    parser.add_argument("--embed-concurrency", type=int, default=INGEST_EMBED_CONCURRENCY)
+    parser.add_argument("--upsert-batch", type=int, default=INGEST_UPSERT_BATCH)
+    parser.add_argument("--content-column", default="content")
+    parser.add_argument("--embedding-column", default="embedding")
+    parser.add_argument("--hash-column", default=INGEST_HASH_COLUMN)
+    parser.add_argument("--metadata-column", help="jsonb column to store the source file and page in")
+    parser.add_argument("--ivf", choices=("auto", "on", "off"), default="auto")
+
+    args = parser.parse_args()
+    ingest(
+        args.paths, table=args.table, local_index=args.local_index, provider=args.provider,
+        state_path=args.state, content_column=args.content_column, embedding_column=args.embedding_column,
+        hash_column=args.hash_column, metadata_column=args.metadata_column,
+        ivf={"auto": None, "on": True, "off": False}[args.ivf],
+        workers=args.workers, pages_per_task=args.pages_per_task, chunk_chars=args.chunk_chars,
+        chunk_overlap=args.chunk_overlap, embed_batch=args.embed_batch,
+        embed_concurrency=args.embed_concurrency, upsert_batch=args.upsert_batch,
+    )
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    main()
@@ -0,0 +1,172 @@
+"""
+Background job queue for webhook processing.
+Webhooks only parse and enqueue; a pool of workers runs the slow pipeline
+(OCR, embeddings, RAG, LLM, send). Jobs for the same sender run one at a
+time in arrival order, jobs for different senders run concurrently.
+Lanes are per process; with several uvicorn workers, a `key_lock` (see
+shared_state.sender_lock) keeps one sender's jobs from overlapping across them.
+"""
+import asyncio
+import inspect
+import os
+import time
+import traceback
+from collections import deque
+
+JOB_QUEUE_WORKERS = int(os.getenv("JOB_QUEUE_WORKERS", "4"))
+JOB_QUEUE_MAX_SIZE = int(os.getenv("JOB_QUEUE_MAX_SIZE", "1000"))
+
+
+class QueueFullError(Exception):
+    """
+    Raised when the queue already holds max_size pending jobs.
+    Callers should reject the request so the provider retries later.
+    """
+
+
+class JobQueue:
+    """
+    Worker pool with per-key (per-sender) ordering and bounded backpressure.
+
+    Each key has its own lane (a deque of pending jobs). A key sits in the
+    ready queue at most once, so a sender never occupies more than one
+    worker and a busy sender cannot block the others.
+
+    `key_lock(key)`, if given, returns an async context manager held while
+    a job for that key runs.
+    """
+
+    def __init__(self, workers=JOB_QUEUE_WORKERS, max_size=JOB_QUEUE_MAX_SIZE, key_lock=None):
+        self.workers = max(1, workers)
+        self.max_size = max(1, max_size)
+        self.key_lock = key_lock
+        self._lanes = {}
+        self._ready = None
+        self._tasks = []
+        self._pending = 0
+        self._in_flight = 0
+
+        # Counters
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    @property
+    def running(self):
+        return bool(self._tasks)
+
+    def start(self):
+        """
+        Start the worker tasks. Must be called from inside the event loop.
+        """
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._worker(i), name=f"job-worker-{i}")
+            for i in range(self.workers)
+        ]
+        print(f"Job queue started with {self.workers} workers (max {self.max_size} pending jobs)")
+
+    async def stop(self, timeout=10.0):
+        """
+        Wait up to `timeout` seconds for queued jobs to finish, then cancel the workers.
+        """
+        if not self._tasks:
+            return
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        print(f"Job queue stopped ({self._pending} jobs dropped)")
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Enqueue func(*args, **kwargs) on the lane for `key`.
+        `func` may be a coroutine function or a plain (blocking) function;
+        plain functions are run in a thread so they never block the loop.
+        Raises QueueFullError when the queue is at capacity.
+        """
+        if not self._tasks:
+            raise RuntimeError("Job queue is not running")
+        if self._pending >= self.max_size:
+            self.rejected += 1
+            raise QueueFullError(f"Job queue full ({self._pending} pending jobs)")
+
+        job = (func, args, kwargs, time.monotonic())
+        lane = self._lanes.get(key)
+        if lane is None:
+            # No pending or running job for this key: schedule it
+            lane = deque()
+            self._lanes[key] = lane
+            lane.append(job)
+            self._ready.put_nowait(key)
+        else:
+            # The worker that owns this key re-schedules it when done
+            lane.append(job)
+
+        self._pending += 1
+        self.submitted += 1
+
+    async def _run(self, func, args, kwargs):
+        if inspect.iscoroutinefunction(func):
+            await func(*args, **kwargs)
+        else:
+            await asyncio.to_thread(func, *args, **kwargs)
+
+    async def _worker(self, worker_id):
+        while True:
+            key = await self._ready.get()
+            lane = self._lanes[key]
+            func, args, kwargs, enqueued_at = lane.popleft()
+            self._pending -= 1
+            self._in_flight += 1
+
+            waited = time.monotonic() - enqueued_at
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+            try:
+                if self.key_lock is None:
+                    await self._run(func, args, kwargs)
+                else:
+                    async with self.key_lock(key):
+                        await self._run(func, args, kwargs)
+                self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                print(f"Job for {key} failed on worker {worker_id}: {str(e)}")
+                traceback.print_exc()
+            finally:
+                self._in_flight -= 1
+                if lane:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._lanes[key]
+
+    def stats(self):
+        """
+        Queue depth, throughput counters and time spent waiting in the queue.
+        """
+        started = self.completed + self.failed + self._in_flight
+        return {
+            "workers": self.workers,
+            "max_size": self.max_size,
+            "depth": self._pending,
+            "in_flight": self._in_flight,
+            "active_senders": len(self._lanes),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_time_avg_ms": round(1000 * self.wait_time_total / started, 2) if started else 0.0,
+            "wait_time_max_ms": round(1000 * self.wait_time_max, 2),
+        }
@@ -1,9 +1,318 @@
 """
 Convert LaTeX to plain ASCII text for WhatsApp/Twilio compatibility.
 WhatsApp and Twilio don't support LaTeX rendering, so we convert to readable text.
+
+The converter is compiled once at import time: a tokenizer walks the string
+and dispatches each LaTeX command / brace group through the tables below, then
+one combined cleanup regex handles sqrt, inverse trig, spaces and redundant
+parentheses. The tables keep the order the old rule-by-rule version applied
+its patterns in, because that order decides the output for runs like
+\\cdot\\alpha or \\leftarrow (benchmarks/bench_latex_converter.py checks
+both versions agree).
 """
 import re
 
+# Commands replaced only when followed by a non-word character
+WORD_COMMANDS = [
+    # Functions (must come before other replacements that might match)
+    ('sin', 'sin'), ('cos', 'cos'), ('tan', 'tan'), ('cot', 'cot'), ('sec', 'sec'), ('csc', 'csc'),
+    ('log', 'log'), ('ln', 'ln'), ('exp', 'exp'),
+    ('arcsin', 'sin^-1'), ('arccos', 'cos^-1'), ('arctan', 'tan^-1'),
+
+    # Integrals and derivatives
+    ('int', '∫'), ('sum', 'Σ'), ('prod', 'Π'), ('partial', '∂'), ('nabla', '∇'),
+
+    # Greek letters (common ones)
+    ('alpha', 'alpha'), ('beta', 'beta'), ('gamma', 'gamma'), ('delta', 'delta'),
+    ('epsilon', 'epsilon'), ('theta', 'theta'), ('lambda', 'lambda'), ('mu', 'mu'),
+    ('pi', 'pi'), ('sigma', 'sigma'), ('phi', 'phi'), ('omega', 'omega'),
+
+    # Operators
+    ('times', '×'), ('cdot', '·'), ('div', '÷'), ('pm', '±'), ('mp', '∓'),
+    ('leq', '≤'), ('geq', '≥'), ('neq', '≠'), ('approx', '≈'), ('equiv', '≡'),
+
+    # Sets and logic
+    ('notin', '∉'), ('subset', '⊂'), ('supset', '⊃'), ('cup', '∪'), ('cap', '∩'),
+    ('emptyset', '∅'), ('in', '∈'),
+]
+
+# Commands replaced wherever they start a command name, so \leftarrow reads as \left + "arrow"
+PREFIX_COMMANDS = [
+    ('to', '->'),
+    ('left', ''),
+    ('right', ''),
+    ('quad', ' '),
+    ('qquad', '  '),
+    ('Rightarrow', '=>'),
+    ('Leftarrow', '<='),
+    ('infty', '∞'),
+    ('partial', '∂'),
+    ('nabla', '∇'),
+    ('sum', 'Σ'),
+    ('prod', 'Π'),
+]
+
+SPACING_COMMANDS = {',': ' ', ';': ' ', '!': ''}
+
+# Order brace constructs are resolved in. Earlier ones are already gone when the
+# closing brace of a later one is looked for: \frac{..}{..}, x^{..}, x_{..},
+# \text{..} and friends (replaced by their content), \sqrt{..}
+BRACE_ORDER = {'frac': 0, '^': 1, '_': 2, 'text': 3, 'mathrm': 4, 'mathbf': 5, 'mathit': 6, 'sqrt': 7}
+_BRACE_COMMANDS = ('frac', 'text', 'sqrt', 'mathrm', 'mathbf', 'mathit')
+
+_WORD_RULES = {name: (index, replacement) for index, (name, replacement) in enumerate(WORD_COMMANDS)}
+
+# \command, \, \; \!, or ^{ / _{
+_TOKEN = re.compile(r'\\(?:([A-Za-z]+)|([,;!]))|([\^_])\{')
+_COMMAND = re.compile(r'\\([A-Za-z]+)')
+_BRACE = re.compile(r'[{}]')
+_WORD_CHAR = re.compile(r'\w')
+_SQRT_COMMAND = re.compile(r'\\sqrt\s+[a-zA-Z0-9]')
+
+# Everything that runs on the converted text, in one alternation
+_CLEANUP = re.compile(
+    r'\\sqrt\s+([a-zA-Z0-9]+)'            # \sqrt a -> √(a)
+    r'|\bsqrt(?=\([^)])'                  # plain sqrt(...) -> √(...)
+    r'|\bsqrt\s+([a-zA-Z0-9]+)'           # plain sqrt x -> √(x)
+    r'|(sin|cos|tan)\^\(-?1\)'            # sin^(-1) -> sin^-1
+    r'|(?i:\b(sin|cos|tan)\s+inverse\b)'  # "sin inverse x" -> "sin^-1 x"
+    r'|(\s\s+|(?! )\s)'                    # collapse whitespace (a lone space stays as is)
+    r'|\(([a-zA-Z0-9])\)'                 # (x) -> x
+)
+
+
+def _opener(text, pos):
+    """
+    Order of the brace construct whose '{' is at text[pos], or None for a bare brace.
+    """
+    if pos and text[pos - 1] in '^_':
+        return BRACE_ORDER[text[pos - 1]]
+    for name in _BRACE_COMMANDS:
+        if text.endswith('\\' + name, 0, pos):
+            return BRACE_ORDER[name]
+    return None
+
+
+def _closing(text, start, order):
+    """
+    Find the '}' closing the group opened at text[start], the way the old
+    rule-by-rule converter did: constructs resolved before this one are
+    skipped whole, anything else runs up to the first free '}'.
+    Returns (index or None, spans) where spans means the content opens a
+    later construct that will only be closed after this group.
+    """
+    later = same = False
+    pos = start + 1
+    while True:
+        match = _BRACE.search(text, pos)
+        if match is None:
+            return None, False
+        pos = match.end()
+        if match.group() == '}':
+            return match.start(), later and not same
+        inner = _opener(text, match.start())
+        if inner is None:
+            continue
+        if inner < order:
+            end = _construct_end(text, match.start(), inner)
+            if end:
+                pos = end
+        elif inner > order:
+            later = True
+        else:
+            same = True
+
+
+def _construct_end(text, start, order):
+    """
+    End index of the brace construct opened at text[start], or None if it does not match.
+    """
+    if order == BRACE_ORDER['frac']:
+        close = text.find('}', start + 1)
+        if close <= start + 1 or text[close + 1:close + 2] != '{':
+            return None
+        start = close + 1
+    close = _closing(text, start, order)[0]
+    if close is None or close == start + 1:
+        return None
+    return close + 1
+
+
+def _group(text, start, order):
+    """
+    (content, end index, spans) of the {...} group at text[start], or None.
+    """
+    if text[start:start + 1] != '{':
+        return None
+    close, spans = _closing(text, start, order)
+    if close is None or close == start + 1:
+        return None
+    return text[start + 1:close], close + 1, spans
+
+
+def _word_boundary(text, pos, index):
+    """
+    True if a word command ending at pos is followed by a non-word character,
+    as seen after the word commands listed before it were already replaced.
+    """
+    if pos >= len(text):
+        return True
+    char = text[pos]
+    if char == '\\':
+        match = _COMMAND.match(text, pos)
+        rule = match and _WORD_RULES.get(match.group(1))
+        if rule and rule[0] < index and _word_boundary(text, match.end(), rule[0]):
+            char = rule[1][0]
+    return not _WORD_CHAR.match(char)
+
+
+def _command(text, match, out, braces=True):
+    """
+    Convert the \\command at match.
+    Returns the position to continue from, or (new text, 0) when the replacement
+    has to be scanned again together with what follows it.
+    """
+    name = match.group(1)
+    end = match.end()
+
+    if braces and name == 'frac':
+        # The numerator stops at the first '}', so \\frac{x^{2}}{2} is left as is
+        close = text.find('}', end + 1)
+        if text[end:end + 1] == '{' and close > end + 1:
+            numerator = text[end + 1:close]
+            denominator = _group(text, close + 1, BRACE_ORDER['frac'])
+            if denominator:
+                content, after, spans = denominator
+                if spans or _opener_in(numerator):
+                    return f'({numerator})/({content})' + text[after:], 0
+                out.append(f'({_convert(numerator)})/({_convert(content)})')
+                return after
+    elif braces and name in BRACE_ORDER:
+        group = _group(text, end, BRACE_ORDER[name])
+        if group and group[2]:
+            if name == 'sqrt':
+                out.append('√(')
+                return group[0] + ')' + text[group[1]:], 0
+            # Replace word commands first, they were matched while the '}' was still there
+            return _convert(group[0], braces=False) + text[group[1]:], 0
+        content = group and _convert(group[0])
+        # \\text{\\!} is empty by the time these are matched, and left alone
+        if content:
+            out.append(f'√({content})' if name == 'sqrt' else content)
+            return group[1]
+
+    rule = _WORD_RULES.get(name)
+    if rule and _word_boundary(text, end, rule[0]):
+        out.append(rule[1])
+        return end
+    for prefix, replacement in PREFIX_COMMANDS:
+        if name.startswith(prefix):
+            out.append(replacement)
+            # The rest of the name is plain text
+            return match.start() + 1 + len(prefix)
+
+    out.append('\\')
+    return match.start() + 1
+
+
+def _opener_in(text):
+    # Any brace construct opened (and not closed) in text
+    return any(_opener(text, match.start()) is not None for match in _BRACE.finditer(text) if match.group() == '{')
+
+
+def _convert(text, braces=True):
+    """
+    Tokenizer pass: commands, fractions, superscripts/subscripts and brace groups.
+    A group whose content opens a construct that is only closed after it (e.g.
+    \\frac{1}{\\text{mol} L}) is replaced in place and scanned again, so the
+    inner construct spans the replacement like it did with the old converter.
+    """
+    out = []
+    pos = 0
+    while True:
+        match = _TOKEN.search(text, pos)
+        if match is None:
+            out.append(text[pos:])
+            return ''.join(out)
+        out.append(text[pos:match.start()])
+        if match.group(1):
+            pos = _command(text, match, out, braces)
+            if isinstance(pos, tuple):
+                text, pos = pos
+        elif match.group(2):
+            out.append(SPACING_COMMANDS[match.group(2)])
+            pos = match.end()
+        elif not braces:
+            out.append(match.group())
+            pos = match.end()
+        else:
+            # x^{n} -> x^(n), x_{n} -> x_(n)
+            mark = match.group(3)
+            group = _group(text, match.end() - 1, BRACE_ORDER[mark])
+            if group and group[2]:
+                out.append(mark + '(')
+                text, pos = group[0] + ')' + text[group[1]:], 0
+            elif group:
+                out.append(f'{mark}({_convert(group[0])})')
+                pos = group[1]
+            else:
+                out.append(match.group())
+                pos = match.end()
+
+
+def _argument_end(text, pos):
+    """
+    End of a plain sqrt(...) argument starting at pos: the first ')', or a
+    \\sqrt x before it (that one is closed by the '(x)' it turns into).
+    """
+    close = text.find(')', pos)
+    command = _SQRT_COMMAND.search(text, pos, close if close >= 0 else len(text))
+    if command:
+        return command.start()
+    return close if close >= 0 else None
+
+
+def _cleanup(text):
+    """
+    Single pass over the converted text: sqrt, inverse trig, spaces, (x) -> x.
+    """
+    out = []
+    pos = 0
+    root_until = 0  # plain sqrt( is not converted again inside the argument of the previous one
+    trig_end = -1  # sin^(-1) -> sin^-1 ends in a word character
+    while True:
+        match = _CLEANUP.search(text, pos)
+        if match is None:
+            out.append(text[pos:])
+            return ''.join(out)
+        out.append(text[pos:match.start()])
+        pos = match.end()
+        kind = match.lastindex
+        if kind == 5:
+            out.append(' ')
+        elif kind == 6:
+            out.append(match.group(6))
+        elif kind == 1 or kind == 2:
+            root = match.group(kind)
+            out.append(f'√{root}' if len(root) == 1 else f'√({root})')
+        elif kind == 3:
+            out.append(match.group(3) + '^-1')
+            trig_end = pos
+        elif kind == 4:
+            if match.start() == trig_end:
+                out.append(text[match.start()])
+                pos = match.start() + 1
+            else:
+                out.append(match.group(4) + '^-1')
+        else:
+            # sqrt( becomes √( when the parenthesis is closed, the argument itself is scanned as usual
+            argument_end = _argument_end(text, pos) if match.start() >= root_until else None
+            if argument_end:
+                out.append('√')
+                root_until = argument_end
+            else:
+                out.append('sqrt')
+
 
 def latex_to_text(text):
     """
@@ -12,163 +321,16 @@ def latex_to_text(text):
     """
     if not text:
         return text
-    
+
     # Remove LaTeX display math delimiters
-    text = re.sub(r'\\\[', '', text)
-    text = re.sub(r'\\\]', '', text)
-    text = re.sub(r'\$\$', '', text)
-    text = re.sub(r'\$', '', text)
-    
-    # Common mathematical symbols (order matters - do specific ones first)
-    replacements = {
-        # Functions (must come before other replacements that might match)
-        r'\\sin\b': 'sin',
-        r'\\cos\b': 'cos',
-        r'\\tan\b': 'tan',
-        r'\\cot\b': 'cot',
-        r'\\sec\b': 'sec',
-        r'\\csc\b': 'csc',
-        r'\\log\b': 'log',
-        r'\\ln\b': 'ln',
-        r'\\exp\b': 'exp',
-        r'\\arcsin\b': 'sin^-1',
-        r'\\arccos\b': 'cos^-1',
-        r'\\arctan\b': 'tan^-1',
-        
-        # Integrals and derivatives (must come before \\in)
-        r'\\int\b': '∫',
-        r'\\sum\b': 'Σ',
-        r'\\prod\b': 'Π',
-        r'\\partial\b': '∂',
-        r'\\nabla\b': '∇',
-        
-        # Greek letters (common ones)
-        r'\\alpha\b': 'alpha',
-        r'\\beta\b': 'beta',
-        r'\\gamma\b': 'gamma',
-        r'\\delta\b': 'delta',
-        r'\\epsilon\b': 'epsilon',
-        r'\\theta\b': 'theta',
-        r'\\lambda\b': 'lambda',
-        r'\\mu\b': 'mu',
-        r'\\pi\b': 'pi',
-        r'\\sigma\b': 'sigma',
-        r'\\phi\b': 'phi',
-        r'\\omega\b': 'omega',
-        
-        # Operators
-        r'\\times\b': '×',
-        r'\\cdot\b': '·',
-        r'\\div\b': '÷',
-        r'\\pm\b': '±',
-        r'\\mp\b': '∓',
-        r'\\leq\b': '≤',
-        r'\\geq\b': '≥',
-        r'\\neq\b': '≠',
-        r'\\approx\b': '≈',
-        r'\\equiv\b': '≡',
-        
-        # Sets and logic (\\in must come after \\sin, \\int, etc.)
-        r'\\notin\b': '∉',
-        r'\\subset\b': '⊂',
-        r'\\supset\b': '⊃',
-        r'\\cup\b': '∪',
-        r'\\cap\b': '∩',
-        r'\\emptyset\b': '∅',
-        r'\\in\b': '∈',  # Must be last among similar patterns
-        
-        # Fractions: \frac{a}{b} -> (a)/(b) or a/b
-        r'\\frac\{([^}]+)\}\{([^}]+)\}': r'(\1)/(\2)',
-        
-        # Superscripts: x^{n} -> x^(n) or x^n
-        r'\^\{([^}]+)\}': r'^(\1)',
-        r'\^([a-zA-Z0-9])': r'^\1',
-        
-        # Subscripts: x_{n} -> x_(n) or x_n
-        r'_\{([^}]+)\}': r'_(\1)',
-        r'_([a-zA-Z0-9])': r'_\1',
-        
-        # Limits: \lim_{x \to a} -> lim(x->a)
-        r'\\lim_\{([^}]+)\}': r'lim(\1)',
-        r'\\to': '->',
-        
-        # Common commands
-        r'\\left': '',
-        r'\\right': '',
-        r'\\,': ' ',  # thin space
-        r'\\;': ' ',  # medium space
-        r'\\!': '',   # negative space
-        r'\\quad': ' ',
-        r'\\qquad': '  ',
-        r'\\text\{([^}]+)\}': r'\1',  # text mode
-        r'\\mathrm\{([^}]+)\}': r'\1',
-        r'\\mathbf\{([^}]+)\}': r'\1',
-        r'\\mathit\{([^}]+)\}': r'\1',
-        
-        # Brackets and delimiters
-        r'\\left\(': '(',
-        r'\\right\)': ')',
-        r'\\left\[': '[',
-        r'\\right\]': ']',
-        r'\\left\{': '{',
-        r'\\right\}': '}',
-        r'\\left\|': '|',
-        r'\\right\|': '|',
-        
-        # Arrows
-        r'\\rightarrow': '->',
-        r'\\leftarrow': '<-',
-        r'\\Rightarrow': '=>',
-        r'\\Leftarrow': '<=',
-        r'\\leftrightarrow': '<->',
-        
-        # Infinity and other symbols
-        r'\\infty': '∞',
-        r'\\partial': '∂',
-        r'\\nabla': '∇',
-        r'\\sum': 'Σ',
-        r'\\prod': 'Π',
-    }
-    
-    # Apply replacements
-    for pattern, replacement in replacements.items():
-        text = re.sub(pattern, replacement, text)
-
-    # Square root with braces: \sqrt{a} -> √(a)
-    text = re.sub(r'\\sqrt\{([^}]+)\}', r'√(\1)', text)
-    # Square root without braces: \sqrt a -> √(a)
-    text = re.sub(r'\\sqrt\s+([a-zA-Z0-9]+)', r'√(\1)', text)
-    # Plain sqrt(...) -> √(...)
-    text = re.sub(r'\bsqrt\(([^)]+)\)', r'√(\1)', text)
-    # Plain sqrt x -> √(x)
-    text = re.sub(r'\bsqrt\s+([a-zA-Z0-9]+)', r'√(\1)', text)
-
-    # Inverse trig forms: \sin^{-1} x -> sin^-1 x
-    text = re.sub(r'sin\^\{-?1\}', r'sin^-1', text)
-    text = re.sub(r'cos\^\{-?1\}', r'cos^-1', text)
-    text = re.sub(r'tan\^\{-?1\}', r'tan^-1', text)
-    text = re.sub(r'sin\^\(-?1\)', r'sin^-1', text)
-    text = re.sub(r'cos\^\(-?1\)', r'cos^-1', text)
-    text = re.sub(r'tan\^\(-?1\)', r'tan^-1', text)
-
-    # Plain English inverse phrases: "sin inverse x" -> "sin^-1 x"
-    text = re.sub(r'\b(sin|cos|tan)\s+inverse\b', r'\1^-1', text, flags=re.IGNORECASE)
-    
-    # Clean up multiple spaces
-    text = re.sub(r'\s+', ' ', text)
-    
-    # Clean up extra parentheses around single characters
-    text = re.sub(r'\(([a-zA-Z0-9])\)', r'\1', text)
-    
-    # Remove trailing/leading whitespace from each line
-    lines = text.split('\n')
-    lines = [line.strip() for line in lines]
-    text = '\n'.join(lines)
-    
-    # Remove empty lines (but keep structure)
-    text = re.sub(r'\n\s*\n\s*\n', '\n\n', text)
-    
-    return text.strip()
+    text = text.replace('\\[', '').replace('\\]', '').replace('$', '')
+
+    return _cleanup(_convert(text)).strip()
+
+
+_DISPLAY_MATH = re.compile(r'\\\[(.*?)\\\]', re.DOTALL)
+_DOLLAR_MATH = re.compile(r'\$\$(.*?)\$\$', re.DOTALL)
+_INLINE_MATH = re.compile(r'\$(.*?)\$')
 
 
 def convert_math_expressions(text):
@@ -178,42 +340,16 @@ def convert_math_expressions(text):
     """
     if not text:
         return text
-    
-    # First, handle display math blocks \[ ... \] - preserve line breaks
+
     def process_math_block(match):
-        content = match.group(1)
-        # Convert LaTeX to text
-        converted = latex_to_text(content)
-        # Preserve line breaks for readability
-        return converted
-    
-    text = re.sub(
-        r'\\\[(.*?)\\\]',
-        process_math_block,
-        text,
-        flags=re.DOTALL
-    )
-    
-    # Handle $$ ... $$ blocks
-    text = re.sub(
-        r'\$\$(.*?)\$\$',
-        process_math_block,
-        text,
-        flags=re.DOTALL
-    )
-    
-    # Handle inline math $ ... $ (single line)
-    text = re.sub(
-        r'\$(.*?)\$',
-        lambda m: latex_to_text(m.group(1)),
-        text
-    )
-    
-    # Handle any remaining LaTeX commands in the text
-    text = latex_to_text(text)
-    
-    # Clean up excessive line breaks but preserve structure
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    
-    return text
+        return latex_to_text(match.group(1))
+
+    # Display math \[ ... \] and $$ ... $$ first, then inline $ ... $ (single line)
+    if '\\[' in text:
+        text = _DISPLAY_MATH.sub(process_math_block, text)
+    if '$' in text:
+        text = _DOLLAR_MATH.sub(process_math_block, text)
+        text = _INLINE_MATH.sub(process_math_block, text)
 
+    # Handle any remaining LaTeX commands in the text
+    return latex_to_text(text)
@@ -0,0 +1,428 @@
+"""
+Local in-process vector index for RAG retrieval.
+An alternative to the Supabase match_cbse_context RPC: the chunk corpus and
+its embeddings are loaded from LOCAL_INDEX_DIR, with the embedding matrix
+memory-mapped so several uvicorn workers share the same pages.
+Small corpora are searched exactly with one matrix-vector product; large
+ones use an IVF (inverted file) index built at export time.
+
+Vectors can be held as float32, float16 (2x smaller) or int8 with a
+per-vector scale (4x smaller), chosen with LOCAL_INDEX_DTYPE. With a compact
+dtype the top LOCAL_INDEX_RERANK candidates are re-scored against the
+full-precision file, which stays on disk and is only paged in for those rows.
+float16 trades latency for memory: numpy widens float16 to float32 without
+SIMD on most CPUs, so a query is several times slower than with float32
+(about 7x at 50k x 1536). int8 + re-rank is smaller still, about as fast as
+float32 and had recall 1.0 in the benchmark; prefer it to save memory.
+See benchmarks/bench_quantization.py for recall, memory and latency.
+
+Enable with RAG_BACKEND=local. Build or refresh the index from Supabase with:
+    python local_index.py export --out rag_index
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "rag_index")
+LOCAL_INDEX_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", "8"))
+LOCAL_INDEX_IVF_MIN = int(os.getenv("LOCAL_INDEX_IVF_MIN", "20000"))
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "float32").lower()  # float32, float16 or int8
+LOCAL_INDEX_RERANK = int(os.getenv("LOCAL_INDEX_RERANK", "50"))  # 0 disables the float32 re-rank
+
+DTYPES = ("float32", "float16", "int8")
+SCORE_BLOCK_ROWS = 256
+
+EMBEDDINGS_FILE = "embeddings.npy"
+EMBEDDINGS_F16_FILE = "embeddings.f16.npy"
+EMBEDDINGS_I8_FILE = "embeddings.i8.npy"
+I8_SCALES_FILE = "embeddings.i8.scales.npy"
+CHUNKS_FILE = "chunks.json"
+META_FILE = "meta.json"
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_ORDER_FILE = "ivf_order.npy"
+IVF_OFFSETS_FILE = "ivf_offsets.npy"
+
+CONTENT_KEYS = ("content", "text", "body", "doc", "chunk", "context")
+
+
+def normalize_rows(matrix):
+    """
+    Scale each row to unit length so dot products are cosine similarities.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k(scores, k):
+    """
+    Indices of the k largest scores, best first, in O(n + k log k).
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+def quantize_int8(matrix):
+    """
+    Symmetric int8 scalar quantization with one float32 scale per vector.
+    matrix ~= codes * scales[:, None]
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def build_ivf(embeddings, nlist=None, iterations=10, seed=0):
+    """
+    Spherical k-means over a sample of the (unit-norm) embeddings.
+    Returns (centroids, order, offsets): vectors in list i are order[offsets[i]:offsets[i + 1]].
+    """
+    n = len(embeddings)
+    nlist = min(n, nlist or max(1, int(4 * np.sqrt(n))))
+    rng = np.random.default_rng(seed)
+    sample_size = min(n, nlist * 64)
+    sample = np.asarray(embeddings[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.bincount(assign, minlength=nlist) == 0
+        # Re-seed empty lists with random sample points
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        centroids = normalize_rows(sums)
+
+    # Assign the full corpus in blocks to bound memory
+    assign = np.empty(n, dtype=np.int32)
+    for start in range(0, n, 65536):
+        block = np.asarray(embeddings[start:start + 65536], dtype=np.float32)
+        assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+    order = np.argsort(assign, kind="stable").astype(np.int64)
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assign, minlength=nlist), out=offsets[1:])
+    return centroids, order, offsets
+
+
+class LocalVectorIndex:
+    """
+    Read-only view of an index directory written by LocalIndexWriter.
+    """
+
+    def __init__(self, path=LOCAL_INDEX_DIR, nprobe=LOCAL_INDEX_NPROBE,
+                 dtype=LOCAL_INDEX_DTYPE, rerank=LOCAL_INDEX_RERANK):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown index dtype {dtype!r}, expected one of {DTYPES}")
+        self.path = path
+        self.nprobe = nprobe
+        self.dtype = dtype
+        self.rerank = rerank
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        # Full precision vectors: scored directly for float32, otherwise only read for re-ranking
+        self.embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode="r")
+        self.scales = None
+        if dtype == "float16":
+            self.vectors = np.load(os.path.join(path, EMBEDDINGS_F16_FILE), mmap_mode="r")
+        elif dtype == "int8":
+            self.vectors = np.load(os.path.join(path, EMBEDDINGS_I8_FILE), mmap_mode="r")
+            self.scales = np.load(os.path.join(path, I8_SCALES_FILE))
+        else:
+            self.vectors = self.embeddings
+        with open(os.path.join(path, CHUNKS_FILE)) as f:
+            self.chunks = json.load(f)
+        self.dimensions = self.embeddings.shape[1]
+
+        self.centroids = None
+        if os.path.exists(os.path.join(path, IVF_CENTROIDS_FILE)):
+            self.centroids = np.load(os.path.join(path, IVF_CENTROIDS_FILE))
+            self.ivf_order = np.load(os.path.join(path, IVF_ORDER_FILE), mmap_mode="r")
+            self.ivf_offsets = np.load(os.path.join(path, IVF_OFFSETS_FILE))
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def vector_bytes(self):
+        """
+        Bytes of vector data scored on every query (what has to stay in RAM).
+        """
+        scales = self.scales.nbytes if self.scales is not None else 0
+        return self.vectors.size * self.vectors.itemsize + scales
+
+    def _score(self, query, ids=None):
+        """
+        Approximate scores for all vectors (or `ids`), block by block so
+        float16/int8 rows are never widened to float32 all at once.
+        The float16 -> float32 widening dominates a float16 query; the
+        dot product itself is float32 either way.
+        """
+        n = len(self.vectors) if ids is None else len(ids)
+        if self.vectors.dtype == np.float32:
+            rows = self.vectors if ids is None else self.vectors[ids]
+            return np.asarray(rows @ query, dtype=np.float32)
+
+        # Small blocks widened into one reused buffer stay in CPU cache
+        scores = np.empty(n, dtype=np.float32)
+        buffer = np.empty((SCORE_BLOCK_ROWS, self.dimensions), dtype=np.float32)
+        for start in range(0, n, SCORE_BLOCK_ROWS):
+            end = min(n, start + SCORE_BLOCK_ROWS)
+            rows = slice(start, end) if ids is None else ids[start:end]
+            block = buffer[:end - start]
+            np.copyto(block, self.vectors[rows], casting="unsafe")
+            np.dot(block, query, out=scores[start:end])
+            if self.scales is not None:
+                scores[start:end] *= self.scales[rows]
+        return scores
+
+    def _candidates(self, query):
+        # Vector ids in the nprobe lists whose centroids are closest to the query
+        lists = top_k(self.centroids @ query, self.nprobe)
+        return np.concatenate([
+            self.ivf_order[self.ivf_offsets[i]:self.ivf_offsets[i + 1]] for i in lists
+        ])
+
+    def search(self, query_embedding, k=3):
+        """
+        Return [(chunk_id, cosine_similarity)] for the k nearest chunks, best first.
+        """
+        if len(query_embedding) != self.dimensions:
+            raise ValueError(
+                f"Query has {len(query_embedding)} dimensions, local index has {self.dimensions}"
+            )
+        query = normalize_rows(query_embedding)
+
+        candidates = None if self.centroids is None else np.sort(self._candidates(query))
+        scores = self._score(query, candidates)
+
+        if self.vectors is not self.embeddings and self.rerank > 0:
+            # Exact float32 re-rank of the best approximate candidates
+            pool = top_k(scores, max(k, self.rerank))
+            ids = pool if candidates is None else candidates[pool]
+            ids = np.sort(ids)
+            exact = np.asarray(self.embeddings[ids], dtype=np.float32) @ query
+            best = top_k(exact, k)
+            return [(int(ids[i]), float(exact[i])) for i in best]
+
+        best = top_k(scores, k)
+        ids = best if candidates is None else candidates[best]
+        return [(int(i), float(scores[j])) for i, j in zip(ids, best)]
+
+    def match(self, query_embedding, match_count=3):
+        """
+        Same row shape as the match_cbse_context RPC.
+        """
+        return [
+            {"id": chunk_id, "content": self.chunks[chunk_id], "similarity": score}
+            for chunk_id, score in self.search(query_embedding, match_count)
+        ]
+
+
+def _save_npy(path, array):
+    # np.save(path) would append ".npy" to our ".tmp" names
+    with open(path, "wb") as f:
+        np.save(f, array)
+
+
+class LocalIndexWriter:
+    """
+    Streams (content, embedding) pairs to disk and writes an index directory.
+    Embeddings are spooled to a raw file so the corpus never has to fit in RAM.
+    """
+
+    def __init__(self, path=LOCAL_INDEX_DIR, meta=None):
+        self.path = path
+        self.meta = dict(meta or {})
+        self.dimensions = None
+        self.chunks = []
+        os.makedirs(path, exist_ok=True)
+        self._spool_path = os.path.join(path, "embeddings.f32.tmp")
+        self._spool = open(self._spool_path, "wb")
+
+    def add(self, contents, vectors):
+        vectors = normalize_rows(vectors)
+        if vectors.ndim != 2 or len(vectors) != len(contents):
+            raise ValueError("contents and vectors must have the same length")
+        if self.dimensions is None:
+            self.dimensions = vectors.shape[1]
+        elif vectors.shape[1] != self.dimensions:
+            raise ValueError(f"Expected {self.dimensions} dimensions, got {vectors.shape[1]}")
+        self._spool.write(vectors.tobytes())
+        self.chunks.extend(contents)
+
+    def _replace(self, name, write):
+        tmp = os.path.join(self.path, name + ".tmp")
+        write(tmp)
+        os.replace(tmp, os.path.join(self.path, name))
+
+    def close(self, ivf=None):
+        """
+        Finalize the index. IVF is built when ivf=True, or automatically for
+        corpora with at least LOCAL_INDEX_IVF_MIN chunks when ivf is None.
+        """
+        self._spool.close()
+        n = len(self.chunks)
+        if not n:
+            os.remove(self._spool_path)
+            raise ValueError("No chunks to index")
+
+        spool = np.memmap(self._spool_path, dtype=np.float32, mode="r", shape=(n, self.dimensions))
+
+        def write_embeddings(tmp):
+            out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(n, self.dimensions))
+            for start in range(0, n, 65536):
+                out[start:start + 65536] = spool[start:start + 65536]
+            out.flush()
+            del out
+
+        self._replace(EMBEDDINGS_FILE, write_embeddings)
+
+        # Compact copies, so LOCAL_INDEX_DTYPE can be switched without re-exporting
+        def write_f16(tmp):
+            out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float16, shape=(n, self.dimensions))
+            for start in range(0, n, 65536):
+                out[start:start + 65536] = spool[start:start + 65536]
+            out.flush()
+            del out
+
+        self._replace(EMBEDDINGS_F16_FILE, write_f16)
+
+        scales = np.empty(n, dtype=np.float32)
+
+        def write_i8(tmp):
+            out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.int8, shape=(n, self.dimensions))
+            for start in range(0, n, 65536):
+                codes, block_scales = quantize_int8(spool[start:start + 65536])
+                out[start:start + len(codes)] = codes
+                scales[start:start + len(codes)] = block_scales
+            out.flush()
+            del out
+
+        self._replace(EMBEDDINGS_I8_FILE, write_i8)
+        self._replace(I8_SCALES_FILE, lambda tmp: _save_npy(tmp, scales))
+
+        def write_chunks(tmp):
+            with open(tmp, "w") as f:
+                json.dump(self.chunks, f)
+
+        self._replace(CHUNKS_FILE, write_chunks)
+
+        if ivf is None:
+            ivf = n >= LOCAL_INDEX_IVF_MIN
+        if ivf:
+            centroids, order, offsets = build_ivf(spool)
+            for name, array in ((IVF_CENTROIDS_FILE, centroids), (IVF_ORDER_FILE, order), (IVF_OFFSETS_FILE, offsets)):
+                self._replace(name, lambda tmp, array=array: _save_npy(tmp, array))
+        else:
+            for name in (IVF_CENTROIDS_FILE, IVF_ORDER_FILE, IVF_OFFSETS_FILE):
+                if os.path.exists(os.path.join(self.path, name)):
+                    os.remove(os.path.join(self.path, name))
+
+        del spool
+        os.remove(self._spool_path)
+
+        # Lexical index over the same chunks, for RAG_HYBRID=1 (see bm25.py)
+        from bm25 import BM25Index
+        BM25Index.build(self.chunks).save(self.path)
+
+        meta = {**self.meta, "count": n, "dimensions": self.dimensions, "ivf": bool(ivf), "created_at": time.time()}
+
+        def write_meta(tmp):
+            with open(tmp, "w") as f:
+                json.dump(meta, f, indent=2)
+
+        # Written last: a complete meta.json marks a complete index
+        self._replace(META_FILE, write_meta)
+        return meta
+
+
+_local_index = None
+
+
+def get_local_index():
+    """
+    Load LOCAL_INDEX_DIR once per process.
+    """
+    global _local_index
+    if _local_index is None:
+        _local_index = LocalVectorIndex(LOCAL_INDEX_DIR)
+        print(f"Loaded local vector index: {len(_local_index)} chunks, {_local_index.dimensions} dimensions, "
+              f"{_local_index.dtype} ({_local_index.vector_bytes() / 1e6:.1f} MB)")
+    return _local_index
+
+
+def _parse_embedding(value):
+    # pgvector columns come back from PostgREST as "[0.1,0.2,...]" strings
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+
+def export_from_supabase(out_dir, table, page_size=1000, embedding_column="embedding", ivf=None,
+                         order_column="id"):
+    """
+    Pull every chunk and embedding from a Supabase table into a local index.
+    Pages are ordered by `order_column` (a unique key): PostgREST doesn't
+    keep row order between requests, so unordered pages could skip or
+    repeat rows.
+    """
+    from supabase_utils import supabase
+
+    writer = LocalIndexWriter(out_dir, meta={"source": f"supabase:{table}"})
+    start_time = time.time()
+    start = 0
+    while True:
+        rows = (supabase.table(table).select("*").order(order_column)
+                .range(start, start + page_size - 1).execute().data or [])
+        contents = []
+        vectors = []
+        for row in rows:
+            content = next((row[key] for key in CONTENT_KEYS if key in row), None)
+            if content is None or row.get(embedding_column) is None:
+                continue
+            contents.append(content)
+            vectors.append(_parse_embedding(row[embedding_column]))
+        if contents:
+            writer.add(contents, np.asarray(vectors, dtype=np.float32))
+        print(f"Exported {start + len(rows)} rows...")
+        if len(rows) < page_size:
+            break
+        start += page_size
+
+    meta = writer.close(ivf=ivf)
+    print(f"Wrote {meta['count']} chunks ({meta['dimensions']} dims, ivf={meta['ivf']}) "
+          f"to {out_dir} in {time.time() - start_time:.1f}s")
+    return meta
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the local RAG vector index")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export = sub.add_parser("export", help="Sync the chunk table from Supabase into a local index")
+    export.add_argument("--out", default=os.getenv("LOCAL_INDEX_DIR", LOCAL_INDEX_DIR))
+    export.add_argument("--table", default=os.getenv("SUPABASE_TABLE", "vectors"))
+    export.add_argument("--page-size", type=int, default=1000)
+    export.add_argument("--embedding-column", default="embedding")
+    export.add_argument("--ivf", choices=("auto", "on", "off"), default="auto")
+    export.add_argument("--order-column", default="id", help="unique column to page by")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        ivf = {"auto": None, "on": True, "off": False}[args.ivf]
+        export_from_supabase(args.out, args.table, args.page_size, args.embedding_column, ivf,
+                             args.order_column)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    main()
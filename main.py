@@ -1,33 +1,86 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
-from fastapi.responses import Response
-import requests
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 import os
 from dotenv import load_dotenv
 load_dotenv()
-from supabase_utils import fetch_rag_context
+from supabase_utils import RAG_BACKEND, fetch_rag_context_async
 from latex_converter import convert_math_expressions
 from markdown_formatter import format_answer_for_whatsapp
 import json
 
-# Import both AI providers
+# Import both AI providers (async versions, so handlers never block the event loop)
 from gemini_utils import (
-    extract_question_from_image as extract_question_gemini,
-    generate_answer as generate_answer_gemini,
-    create_embedding as create_embedding_gemini
+    extract_question_from_image_async as extract_question_gemini,
+    generate_answer_async as generate_answer_gemini,
+    generate_answer_stream as generate_answer_stream_gemini,
+    create_embedding_async as create_embedding_gemini,
+    create_embeddings_async as create_embeddings_gemini,
+    ANSWER_MODEL as answer_model_gemini,
+    EMBEDDING_DIMENSIONS as embedding_dimensions_gemini,
+    embedding_batcher as embedding_batcher_gemini
 )
 from openai_utils import (
-    extract_question_from_image as extract_question_openai,
-    generate_answer as generate_answer_openai,
-    create_embedding as create_embedding_openai
+    extract_question_from_image_async as extract_question_openai,
+    generate_answer_async as generate_answer_openai,
+    generate_answer_stream as generate_answer_stream_openai,
+    create_embedding_async as create_embedding_openai,
+    create_embeddings_async as create_embeddings_openai,
+    ANSWER_MODEL as answer_model_openai,
+    EMBEDDING_DIMENSIONS as embedding_dimensions_openai,
+    embedding_batcher as embedding_batcher_openai
 )
 
 # Import both WhatsApp providers
-from whatsapp_cloud_api import send_whatsapp_message as send_whatsapp_cloud, get_media_url, download_media as download_media_cloud
-from twilio_whatsapp import send_whatsapp_message as send_whatsapp_twilio, download_media_from_twilio
-
-app = FastAPI()
-
-# AI Provider selection: "gpt" or "gemini" (defaults to "gpt")
+from whatsapp_cloud_api import (
+    send_whatsapp_message_async as send_whatsapp_cloud,
+    get_media_url_async as get_media_url,
+    download_media_async as download_media_cloud
+)
+from twilio_whatsapp import (
+    send_whatsapp_message_async as send_whatsapp_twilio,
+    download_media_from_twilio_async as download_media_from_twilio
+)
+from http_clients import close_clients, pool_stats, warmup
+from embedding_cache import embedding_cache
+from image_cache import image_cache
+from image_preprocess import ImageRejectedError, shutdown_pool
+from answer_cache import answer_cache_stats, get_answer_cache
+from answer_streaming import ANSWER_STREAMING, stream_answer, streaming_stats
+from context_assembly import context_stats
+from prompt_cache import prompt_cache_stats
+from job_queue import JobQueue, QueueFullError
+from message_dedup import message_dedup
+from metrics import metrics, span, timed
+from provider_router import ProviderRouter
+from resilience import breaker_stats, with_deadline
+from send_scheduler import send_scheduler
+from shared_state import sender_lock, shared_state
+
+# Background workers that run the answer pipeline after the webhook has returned.
+# With shared state, a sender's jobs also don't overlap across uvicorn workers.
+job_queue = JobQueue(key_lock=sender_lock if shared_state.distributed else None)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    job_queue.start()
+    await warmup()
+    yield
+    await job_queue.stop()
+    await close_clients()
+    await shared_state.close_async()
+    shutdown_pool()
+
+
+app = FastAPI(lifespan=lifespan)
+
+TWIML_EMPTY_RESPONSE = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
+IMAGE_REJECTED_MESSAGE = "Sorry, this image is too large to read. Please send a smaller photo of the question."
+
+# AI Provider selection: "gpt", "gemini" or "auto" (defaults to "gpt")
+# "auto" routes each call to the faster healthy provider (see provider_router.py)
 AI_PROVIDER = os.getenv("AI_PROVIDER", "gpt").lower()
 
 # WhatsApp Provider selection: "twilio" or "whatsapp_cloud" (defaults to whatsapp_cloud for backward compatibility)
@@ -38,24 +91,59 @@ WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 PHONE_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
 
 
-def send_message(to, message, provider=None):
+async def send_message(to, message, provider=None, formatted=False):
     """
     Unified function to send WhatsApp messages via the configured provider.
     Falls back to provider selection if not specified.
-    Formats markdown and converts LaTeX to plain text before sending.
+    Formats markdown and converts LaTeX to plain text before sending,
+    unless the message is already formatted.
     WhatsApp/Twilio don't support Markdown or LaTeX rendering.
     """
     provider = provider or WHATSAPP_PROVIDER
     
     # Format markdown and convert LaTeX to plain text before sending
     # WhatsApp and Twilio don't support Markdown or LaTeX rendering
-    if message:
-        message = format_answer_for_whatsapp(str(message))
+    if message and not formatted:
+        with span("format"):
+            message = format_answer_for_whatsapp(str(message))
     
-    if provider == "twilio":
-        send_whatsapp_twilio(to, message)
-    else:  # whatsapp_cloud (default)
-        send_whatsapp_cloud(to, message)
+    with span("send", provider):
+        if provider == "twilio":
+            await send_whatsapp_twilio(to, message)
+        else:  # whatsapp_cloud (default)
+            await send_whatsapp_cloud(to, message)
+
+
+AI_FUNCTIONS = {
+    "gemini": {
+        "extract_question": extract_question_gemini,
+        "generate_answer": generate_answer_gemini,
+        "generate_answer_stream": generate_answer_stream_gemini,
+        "create_embedding": create_embedding_gemini,
+        "create_embeddings": create_embeddings_gemini,
+        "answer_model": answer_model_gemini,
+        "embedding_dimensions": embedding_dimensions_gemini
+    },
+    "gpt": {
+        "extract_question": extract_question_openai,
+        "generate_answer": generate_answer_openai,
+        "generate_answer_stream": generate_answer_stream_openai,
+        "create_embedding": create_embedding_openai,
+        "create_embeddings": create_embeddings_openai,
+        "answer_model": answer_model_openai,
+        "embedding_dimensions": embedding_dimensions_openai
+    }
+}
+
+# Only providers with credentials take part in routing
+provider_router = ProviderRouter({
+    name: funcs for name, funcs in AI_FUNCTIONS.items()
+    if os.getenv({"gpt": "OPENAI_API_KEY", "gemini": "GEMINI_API_KEY"}[name])
+})
+# Answers from any routed model share one answer cache
+AUTO_AI_FUNCTIONS = provider_router.ai_functions(
+    answer_model="/".join(funcs["answer_model"] for funcs in provider_router.providers.values())
+)
 
 
 def get_ai_functions(ai_provider=None):
@@ -64,23 +152,48 @@ def get_ai_functions(ai_provider=None):
     """
     ai_provider = ai_provider or AI_PROVIDER
     
+    if ai_provider == "auto":
+        return AUTO_AI_FUNCTIONS
     if ai_provider == "gemini":
-        return {
-            "extract_question": extract_question_gemini,
-            "generate_answer": generate_answer_gemini,
-            "create_embedding": create_embedding_gemini
-        }
-    else:  # gpt (default)
-        return {
-            "extract_question": extract_question_openai,
-            "generate_answer": generate_answer_openai,
-            "create_embedding": create_embedding_openai
-        }
+        return AI_FUNCTIONS["gemini"]
+    return AI_FUNCTIONS["gpt"]  # gpt (default)
+
 
+# Keeps fire-and-forget tasks alive until they finish
+_background_tasks = set()
 
-def process_question_and_respond(sender, question, whatsapp_provider=None, ai_provider=None):
+
+def prefetch_embeddings(questions, ai_provider=None):
+    """
+    Start one batched embedding request for several questions.
+    Returns a future per question that resolves to its vector, or to None
+    if the batch failed (the job then embeds its question on its own).
+    """
+    ai_funcs = get_ai_functions(ai_provider)
+    loop = asyncio.get_running_loop()
+    futures = [loop.create_future() for _ in questions]
+
+    async def run():
+        try:
+            vectors = await ai_funcs["create_embeddings"](questions)
+        except Exception as e:
+            print(f"Batched embedding failed ({str(e)}), embedding questions one by one")
+            vectors = [None] * len(questions)
+        for future, vector in zip(futures, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+    task = asyncio.create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return futures
+
+
+async def process_question_and_respond(sender, question, whatsapp_provider=None, ai_provider=None,
+                                       embedding=None):
     """
     Process a question using RAG and send the answer via the configured providers.
+    `embedding` is an optional awaitable with the question's precomputed embedding.
     """
     whatsapp_provider = whatsapp_provider or WHATSAPP_PROVIDER
     ai_provider = ai_provider or AI_PROVIDER
@@ -93,22 +206,130 @@ def process_question_and_respond(sender, question, whatsapp_provider=None, ai_pr
     
     # # RAG context
     print("Fetching RAG context...")
-    q_embed = ai_funcs["create_embedding"](question)
-    context = fetch_rag_context(q_embed)
+    with span("embedding", ai_provider):
+        q_embed = await embedding if embedding is not None else None
+        if q_embed is None:
+            q_embed = await ai_funcs["create_embedding"](question)
+
+    # Near-duplicate of a question we already answered: skip RAG and the LLM
+    answer_cache = get_answer_cache(ai_provider, ai_funcs["answer_model"])
+    if answer_cache is not None:
+        cached_answer = answer_cache.lookup(q_embed, question)
+        if cached_answer is not None:
+            print("Answer cache hit, sending cached answer")
+            await send_message(sender, cached_answer, whatsapp_provider, formatted=True)
+            return
+
+    try:
+        with span("rag", RAG_BACKEND):
+            context = await fetch_rag_context_async(q_embed, question)
+    except Exception as e:
+        # Retrieval is down (or its circuit is open): answer without context instead of not at all
+        print(f"RAG context unavailable ({type(e).__name__}: {str(e)}), answering without it")
+        context = ""
     
-    # generate answer
-    print("Generating answer...")
-    answer = ai_funcs["generate_answer"](question, context)
-    print(f"Generated answer: {answer[:100]}...")
-    # answer = "This is a test answer"
-    send_message(sender, answer, whatsapp_provider)
+    if ANSWER_STREAMING and "generate_answer_stream" in ai_funcs:
+        # Send each finished section while the model is still writing
+        print("Streaming answer...")
+
+        async def send_section(text):
+            await send_message(sender, text, whatsapp_provider, formatted=True)
+
+        # Covers generation, incremental formatting and the section sends
+        with span("llm_stream", ai_provider):
+            answer, sections = await stream_answer(
+                ai_funcs["generate_answer_stream"](question, context), send_section
+            )
+        formatted_answer = "\n\n".join(sections)
+    else:
+        # generate answer
+        print("Generating answer...")
+        with span("llm", ai_provider):
+            answer = await ai_funcs["generate_answer"](question, context)
+        print(f"Generated answer: {answer[:100]}...")
+        # answer = "This is a test answer"
+        with span("format"):
+            formatted_answer = format_answer_for_whatsapp(answer) if answer else answer
+        await send_message(sender, formatted_answer, whatsapp_provider, formatted=True)
+    if answer_cache is not None and formatted_answer:
+        answer_cache.add(q_embed, formatted_answer, question)
+
+
+@timed("job", "whatsapp_cloud")
+@with_deadline()
+async def handle_whatsapp_cloud_message(sender, message, embedding=None):
+    """
+    Background job for one WhatsApp Cloud API message.
+    Downloads and OCRs images, then runs the RAG pipeline and replies.
+    """
+    if "image" in message:
+        print("Processing image message")
+        media_id = message["image"]["id"]
+
+        # get media URL and download
+        with span("download", "whatsapp_cloud"):
+            file_url = await get_media_url(media_id)
+            img_bytes = await download_media_cloud(file_url)
+
+        # extract question using selected AI provider
+        print(f"Extracting question from image using {AI_PROVIDER}...")
+        ai_funcs = get_ai_functions()
+        try:
+            with span("ocr", AI_PROVIDER):
+                question = await ai_funcs["extract_question"](img_bytes)
+        except ImageRejectedError as e:
+            print(f"Image rejected: {str(e)}")
+            await send_message(sender, IMAGE_REJECTED_MESSAGE, "whatsapp_cloud", formatted=True)
+            return
+        print(f"Extracted question: {question}")
+    else:
+        print("Processing text message")
+        question = message["text"]["body"]
+
+    await process_question_and_respond(sender, question, whatsapp_provider="whatsapp_cloud",
+                                       embedding=embedding)
+
+
+@timed("job", "twilio")
+@with_deadline()
+async def handle_twilio_message(sender, message_body, media_url=None):
+    """
+    Background job for one Twilio WhatsApp message.
+    Images take precedence over the text body, as before.
+    """
+    if media_url:
+        print("Processing image message from Twilio")
+        # Download image from Twilio
+        with span("download", "twilio"):
+            img_bytes = await download_media_from_twilio(media_url)
+
+        # extract question using selected AI provider
+        print(f"Extracting question from image using {AI_PROVIDER}...")
+        ai_funcs = get_ai_functions()
+        try:
+            with span("ocr", AI_PROVIDER):
+                question = await ai_funcs["extract_question"](img_bytes)
+        except ImageRejectedError as e:
+            print(f"Image rejected: {str(e)}")
+            await send_message(sender, IMAGE_REJECTED_MESSAGE, "twilio", formatted=True)
+            return
+        print(f"Extracted question: {question}")
+    else:
+        print("Processing text message from Twilio")
+        question = message_body
+
+    await process_question_and_respond(sender, question, whatsapp_provider="twilio")
+
 
 @app.post("/webhook")
 @app.post("/whatsapp_webhook")
+@timed("webhook", "whatsapp_cloud")
 async def whatsapp_cloud_webhook(request: Request):
     """
     WhatsApp Cloud API webhook endpoint (original implementation).
     Handles Meta/Facebook WhatsApp Business API webhooks.
+    Only parses the payload and enqueues a background job per message, so
+    Meta gets its 200 right away and does not resend the webhook.
     """
     try:
         data = await request.json()
@@ -123,69 +344,82 @@ async def whatsapp_cloud_webhook(request: Request):
         if "hub" in data and "challenge" in data.get("hub", {}):
             return {"status": "verification"}
 
-        entry = data.get("entry", [])
-        if not entry:
+        entries = data.get("entry", [])
+        if not entries:
             print("No entry found in payload")
             return {"status": "ignored", "reason": "no_entry"}
 
-        changes = entry[0].get("changes", [])
+        changes = [change for entry in entries for change in entry.get("changes", [])]
         if not changes:
             print("No changes found in entry")
             return {"status": "ignored", "reason": "no_changes"}
 
-        value = changes[0].get("value", {})
-        messages = value.get("messages", [])
-        
+        # During bursts Meta batches several entries/changes/messages into one POST
+        messages = [message for change in changes for message in change.get("value", {}).get("messages", [])]
         if not messages:
             print("No messages found in value")
             return {"status": "ignored", "reason": "no_messages"}
 
-        message = messages[0]
-        sender = message.get("from")
-        
-        if not sender:
-            print("No sender found in message")
-            return {"status": "ignored", "reason": "no_sender"}
-
-        print(f"Processing message from sender: {sender}")
-
-        # If image
-        if "image" in message:
-            print("Processing image message")
-            media_id = message["image"]["id"]
-
-            # get media URL and download
-            file_url = get_media_url(media_id)
-            img_bytes = download_media_cloud(file_url)
-
-            # extract question using selected AI provider
-            print(f"Extracting question from image using {AI_PROVIDER}...")
-            ai_funcs = get_ai_functions()
-            question = ai_funcs["extract_question"](img_bytes)
-            print(f"Extracted question: {question}")
-
-            process_question_and_respond(sender, question, whatsapp_provider="whatsapp_cloud")
-            return {"status": "processed", "type": "image"}
-
-        # If text message
-        if "text" in message:
-            print("Processing text message")
-            question = message["text"]["body"]
-            process_question_and_respond(sender, question, whatsapp_provider="whatsapp_cloud")
-            return {"status": "processed", "type": "text"}
-
-        print("Message type not supported")
-        return {"status": "ignored", "reason": "unsupported_message_type"}
-
+        accepted = []
+        reason = None
+        for message in messages:
+            sender = message.get("from")
+            if not sender:
+                print("No sender found in message")
+                reason = "no_sender"
+                continue
+
+            if "image" in message:
+                message_type = "image"
+            elif "text" in message:
+                message_type = "text"
+            else:
+                print("Message type not supported")
+                reason = "unsupported_message_type"
+                continue
+
+            # Meta resends webhooks it thinks were not handled; answer each message once
+            message_id = message.get("id")
+            if not await message_dedup.claim_async("whatsapp_cloud", message_id):
+                print(f"Duplicate message {message_id} from {sender}, ignoring")
+                reason = "duplicate"
+                continue
+            accepted.append((sender, message, message_type))
+
+        if not accepted:
+            return {"status": "ignored", "reason": reason}
+
+        # All text questions of the payload share one embeddings request
+        text_messages = [message for _, message, message_type in accepted if message_type == "text"]
+        embeddings = {}
+        if len(text_messages) > 1:
+            futures = prefetch_embeddings([message["text"]["body"] for message in text_messages])
+            embeddings = {id(message): future for message, future in zip(text_messages, futures)}
+
+        # Each message is its own job: different senders are answered in parallel,
+        # messages from the same sender in order
+        for number, (sender, message, message_type) in enumerate(accepted):
+            print(f"Queueing {message_type} message from sender: {sender}")
+            try:
+                job_queue.submit(sender, handle_whatsapp_cloud_message, sender, message,
+                                 embeddings.get(id(message)))
+            except QueueFullError:
+                # Not processed, so Meta's retry of this payload must not count them as duplicates
+                for _, unqueued, _ in accepted[number:]:
+                    await message_dedup.release_async("whatsapp_cloud", unqueued.get("id"))
+                raise
+        return {"status": "queued", "queued": len(accepted),
+                "types": [message_type for _, _, message_type in accepted]}
+
+    except QueueFullError as e:
+        # Ask Meta to retry later instead of piling up unbounded work
+        print(f"Error: {str(e)}")
+        return JSONResponse(status_code=503, content={"status": "busy", "message": str(e)})
     except KeyError as e:
         error_msg = f"Missing key in payload: {str(e)}"
         print(f"Error: {error_msg}")
         print(f"Payload keys: {list(data.keys()) if 'data' in locals() else 'N/A'}")
         return {"status": "error", "message": error_msg}
-    except requests.RequestException as e:
-        error_msg = f"Request error: {str(e)}"
-        print(f"Error: {error_msg}")
-        return {"status": "error", "message": error_msg}
     except Exception as e:
         error_msg = f"Unexpected error: {str(e)}"
         print(f"Error: {error_msg}")
@@ -195,10 +429,12 @@ async def whatsapp_cloud_webhook(request: Request):
 
 
 @app.post("/twilio_webhook")
+@timed("webhook", "twilio")
 async def twilio_webhook(request: Request):
     """
     Twilio WhatsApp webhook endpoint.
     Handles incoming messages from Twilio WhatsApp API.
+    Only parses the form data and enqueues a background job.
     """
     try:
         # Twilio sends form data, not JSON
@@ -215,55 +451,40 @@ async def twilio_webhook(request: Request):
         sender = form_data.get("From", "").replace("whatsapp:", "")  # Remove whatsapp: prefix
         message_body = form_data.get("Body", "")
         num_media = int(form_data.get("NumMedia", "0"))
+        media_url = form_data.get("MediaUrl0") if num_media > 0 else None
         
         if not sender:
             print("No sender found in Twilio payload")
-            return Response(content='<?xml version="1.0" encoding="UTF-8"?><Response></Response>', 
-                          media_type="application/xml")
-
-        print(f"Processing Twilio message from sender: {sender}")
-
-        # Handle image messages
-        if num_media > 0:
-            print("Processing image message from Twilio")
-            media_url = form_data.get("MediaUrl0")
-            if media_url:
-                try:
-                    # Download image from Twilio
-                    img_bytes = download_media_from_twilio(media_url)
-                    
-                    # extract question using selected AI provider
-                    print(f"Extracting question from image using {AI_PROVIDER}...")
-                    ai_funcs = get_ai_functions()
-                    question = ai_funcs["extract_question"](img_bytes)
-                    print(f"Extracted question: {question}")
-                    
-                    process_question_and_respond(sender, question, whatsapp_provider="twilio")
-                    return Response(content='<?xml version="1.0" encoding="UTF-8"?><Response></Response>', 
-                                  media_type="application/xml")
-                except Exception as e:
-                    print(f"Error processing Twilio image: {str(e)}")
-                    return Response(content='<?xml version="1.0" encoding="UTF-8"?><Response></Response>', 
-                                  media_type="application/xml")
-
-        # Handle text messages
-        if message_body:
-            print("Processing text message from Twilio")
-            process_question_and_respond(sender, message_body, whatsapp_provider="twilio")
-            return Response(content='<?xml version="1.0" encoding="UTF-8"?><Response></Response>', 
-                          media_type="application/xml")
-
-        print("No message content found in Twilio payload")
-        return Response(content='<?xml version="1.0" encoding="UTF-8"?><Response></Response>', 
-                      media_type="application/xml")
-
+            return Response(content=TWIML_EMPTY_RESPONSE, media_type="application/xml")
+
+        if not media_url and not message_body:
+            print("No message content found in Twilio payload")
+            return Response(content=TWIML_EMPTY_RESPONSE, media_type="application/xml")
+
+        # Twilio retries with the same MessageSid; answer each message once
+        message_sid = form_data.get("MessageSid")
+        if not await message_dedup.claim_async("twilio", message_sid):
+            print(f"Duplicate Twilio message {message_sid} from {sender}, ignoring")
+            return Response(content=TWIML_EMPTY_RESPONSE, media_type="application/xml")
+
+        print(f"Queueing Twilio message from sender: {sender}")
+        try:
+            job_queue.submit(sender, handle_twilio_message, sender, message_body, media_url)
+        except QueueFullError:
+            await message_dedup.release_async("twilio", message_sid)
+            raise
+        return Response(content=TWIML_EMPTY_RESPONSE, media_type="application/xml")
+
+    except QueueFullError as e:
+        # A 503 makes Twilio retry the webhook later
+        print(f"Error: {str(e)}")
+        return Response(content=TWIML_EMPTY_RESPONSE, status_code=503, media_type="application/xml")
     except Exception as e:
         error_msg = f"Unexpected error in Twilio webhook: {str(e)}"
         print(f"Error: {error_msg}")
         import traceback
         traceback.print_exc()
-        return Response(content='<?xml version="1.0" encoding="UTF-8"?><Response></Response>', 
-                      media_type="application/xml")
+        return Response(content=TWIML_EMPTY_RESPONSE, media_type="application/xml")
 
 # For webhook verification
 @app.get("/webhook")
@@ -282,7 +503,8 @@ def root():
         "endpoints": {
             "whatsapp_cloud": ["/webhook", "/whatsapp_webhook"],
             "twilio": ["/twilio_webhook"],
-            "health": "/health"
+            "health": "/health",
+            "metrics": "/metrics"
         }
     }
 
@@ -297,7 +519,8 @@ def health():
             "whatsapp_cloud_webhook": "/webhook",
             "whatsapp_cloud_webhook_alt": "/whatsapp_webhook",
             "twilio_webhook": "/twilio_webhook",
-            "health": "/health"
+            "health": "/health",
+            "metrics": "/metrics"
         },
         "providers_configured": {
             "ai": {
@@ -308,5 +531,51 @@ def health():
                 "whatsapp_cloud": bool(WHATSAPP_TOKEN and PHONE_ID),
                 "twilio": bool(os.getenv("TWILIO_ACCOUNT_SID") and os.getenv("TWILIO_AUTH_TOKEN") and os.getenv("TWILIO_WHATSAPP_FROM"))
             }
-        }
+        },
+        "job_queue": job_queue.stats(),
+        "http_pools": pool_stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "embedding_batching": {
+            "gpt": embedding_batcher_openai.stats(),
+            "gemini": embedding_batcher_gemini.stats()
+        },
+        "answer_cache": answer_cache_stats(),
+        "image_cache": image_cache.stats(),
+        "streaming": streaming_stats(),
+        "message_dedup": message_dedup.stats(),
+        "provider_router": provider_router.stats(),
+        "circuit_breakers": breaker_stats(),
+        "send_scheduler": send_scheduler.stats(),
+        "context": context_stats(),
+        "prompt_cache": prompt_cache_stats(),
+        "shared_state": shared_state.stats(),
+        "latency": metrics.latency_summary()
     }
+
+
+# Stats the modules already keep, exported as gauges next to the stage latencies
+metrics.register_collector("job_queue", job_queue.stats)
+metrics.register_collector("http_pools", pool_stats)
+metrics.register_collector("embedding_cache", embedding_cache.stats)
+metrics.register_collector("embedding_batching", lambda: {
+    "gpt": embedding_batcher_openai.stats(),
+    "gemini": embedding_batcher_gemini.stats()
+})
+metrics.register_collector("answer_cache", answer_cache_stats)
+metrics.register_collector("image_cache", image_cache.stats)
+metrics.register_collector("streaming", streaming_stats)
+metrics.register_collector("message_dedup", message_dedup.stats)
+metrics.register_collector("provider_router", provider_router.stats)
+metrics.register_collector("circuit_breakers", breaker_stats)
+metrics.register_collector("send_scheduler", send_scheduler.stats)
+metrics.register_collector("context", context_stats)
+metrics.register_collector("prompt_cache", prompt_cache_stats)
+metrics.register_collector("shared_state", shared_state.stats)
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """
+    Stage latencies, error/retry counters and service stats in Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
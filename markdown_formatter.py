@@ -5,6 +5,16 @@ WhatsApp doesn't support Markdown rendering, so we format it as readable plain t
 import re
 from latex_converter import convert_math_expressions
 
+SECTION_RULE = '━━━━━━━━━━━━━━━━━━━━'
+
+_UNDERSCORE_BOLD = re.compile(r'__(.+?)__')
+_NUMBERED_ITEM = re.compile(r'^(\d+)\.\s+(.+)$')
+_NUMBERED_START = re.compile(r'^\d+\.\s+')
+_BULLET_START = re.compile(r'^[-*+]\s+')
+_LIST_LIKE_START = re.compile(r'^[-*+\d]')
+_INLINE_CODE = re.compile(r'`([^`]+)`')
+_MULTIPLE_SPACES = re.compile(r' {2,}')
+
 
 def convert_bold_markdown(text):
     """
@@ -19,155 +29,222 @@ def convert_bold_markdown(text):
     text = re.sub(r'\*\*([^*]+?)\*\*', r'*\1*', text)
     
     # Convert __text__ to *text* (alternative markdown bold)
-    text = re.sub(r'__(.+?)__', r'*\1*', text)
+    text = _UNDERSCORE_BOLD.sub(r'*\1*', text)
     
     return text
 
 
-def format_markdown_to_whatsapp(text):
+class StreamingFormatter:
     """
-    Convert Markdown to nicely formatted plain text suitable for WhatsApp.
-    Preserves structure and readability without markdown syntax.
+    Incremental Markdown -> WhatsApp formatter.
+    feed() takes text fragments in any size (e.g. LLM stream deltas) and returns
+    the formatted lines they completed; close() returns the rest. Joined with
+    '\n', the lines equal format_answer_for_whatsapp() of the whole text (or
+    format_markdown_to_whatsapp() with for_answer=False).
+    Only the unfinished line is buffered, plus the span after an unclosed '**'
+    and any trailing blank lines, which can't be finalized until later text shows
+    whether they are kept.
     """
-    if not text:
-        return text
-    
-    # First, convert all markdown bold to WhatsApp bold format
-    # This must be done before LaTeX conversion
-    text = convert_bold_markdown(text)
-    
-    # Split into lines for better processing
-    lines = text.split('\n')
-    formatted_lines = []
-    prev_was_header = False
-    prev_was_list = False
-    
-    for line in lines:
-        stripped = line.strip()
-        
+
+    def __init__(self, for_answer=True):
+        self.for_answer = for_answer
+        self._unresolved = ''    # raw text not yet checked for **bold** pairs
+        self._partial = ''       # bold-converted text of the unfinished line
+        self._prev_was_header = False
+        self._prev_was_list = False
+        self._last_line = None   # last line produced by the line formatter
+        self._held = []          # blank/whitespace lines that may turn out to be trailing
+        self._held_content = None  # last content line, if it has trailing whitespace
+        self._started = False    # a content line has been emitted
+        self._last_emitted = None
+
+    def feed(self, text):
+        """
+        Add a fragment of Markdown, return the list of lines it completed.
+        """
+        out = []
+        if text:
+            self._unresolved += text
+            self._lines(self._resolve_bold(final=False), out)
+        return out
+
+    def close(self):
+        """
+        Finish the answer and return its remaining lines.
+        """
+        out = []
+        self._lines(self._resolve_bold(final=True), out)
+        if self._partial:
+            self._format_line(self._partial, out)
+            self._partial = ''
+        # Whatever is still held is trailing whitespace, which strip() removes
+        if self._held_content is not None:
+            self._emit(self._held_content.rstrip(), out)
+            self._held_content = None
+        self._held = []
+        return out
+
+    def _resolve_bold(self, final):
+        # Same pairing as re.sub(r'\*\*([^*]+?)\*\*') over the whole text: an
+        # opening ** is decided by the next '*' after it, which may not have arrived yet
+        buf = self._unresolved
+        parts = []
+        i = 0
+        while True:
+            p = buf.find('**', i)
+            if p < 0:
+                # A trailing '*' may become '**' with the next fragment
+                end = len(buf) - 1 if not final and buf.endswith('*') and len(buf) > i else len(buf)
+                parts.append(buf[i:end])
+                i = end
+                break
+            q = buf.find('*', p + 2)
+            if q < 0 or q + 1 >= len(buf):
+                if not final:
+                    parts.append(buf[i:p])
+                    i = p
+                    break
+                end = len(buf) if q < 0 else q + 1
+                parts.append(buf[i:end])
+                i = end
+                continue
+            if q == p + 2:
+                parts.append(buf[i:p + 1])
+                i = p + 1
+            elif buf[q + 1] == '*':
+                parts.append(buf[i:p] + '*' + buf[p + 2:q] + '*')
+                i = q + 2
+            else:
+                parts.append(buf[i:q + 1])
+                i = q + 1
+        self._unresolved = buf[i:]
+        return ''.join(parts)
+
+    def _lines(self, text, out):
+        if '\n' not in text:
+            self._partial += text
+            return
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._format_line(line, out)
+
+    def _format_line(self, line, out):
+        stripped = _UNDERSCORE_BOLD.sub(r'*\1*', line).strip()
+
         # Skip empty lines (we'll add them back strategically)
         if not stripped:
-            if formatted_lines and formatted_lines[-1] != '':
-                formatted_lines.append('')
-            prev_was_header = False
-            prev_was_list = False
-            continue
-        
+            self._blank(out)
+            self._prev_was_header = False
+            self._prev_was_list = False
+            return
+
         # Headers - format with proper spacing
         if stripped.startswith('#### '):
             # Sub-subsection (Step 1, Step 2, etc.)
-            header_text = stripped[5:].strip()
-            # Bold is already converted, just convert LaTeX
-            header_text = convert_math_expressions(header_text)
-            if formatted_lines and formatted_lines[-1] != '':
-                formatted_lines.append('')
-            # Check if header already contains bold formatting (has * characters)
-            # If it does, don't wrap the whole thing, just add the emoji
-            if '*' in header_text:
-                formatted_lines.append(f'🔹 {header_text}')
-            else:
-                formatted_lines.append(f'🔹 *{header_text}*')
-            prev_was_header = True
-            prev_was_list = False
-        elif stripped.startswith('### '):
-            # Subsection
-            header_text = stripped[4:].strip()
+            header_text = convert_math_expressions(stripped[5:].strip())
+            self._blank(out)
+            # If the header already has bold parts, don't wrap the whole thing
+            self._add(f'🔹 {header_text}' if '*' in header_text else f'🔹 *{header_text}*', out)
+            self._prev_was_header = True
+            self._prev_was_list = False
+        elif stripped.startswith(('### ', '## ', '# ')):
+            # Subsection, section or main title
+            header_text = stripped[stripped.index(' ') + 1:].strip()
             header_text = convert_math_expressions(header_text)
-            if formatted_lines and formatted_lines[-1] != '':
-                formatted_lines.append('')
-            formatted_lines.append('━━━━━━━━━━━━━━━━━━━━')
-            # Check if header already contains bold formatting
-            if '*' in header_text:
-                formatted_lines.append(header_text)
-            else:
-                formatted_lines.append(f'*{header_text}*')
-            formatted_lines.append('━━━━━━━━━━━━━━━━━━━━')
-            prev_was_header = True
-            prev_was_list = False
-        elif stripped.startswith('## '):
-            # Section
-            header_text = stripped[3:].strip()
-            header_text = convert_math_expressions(header_text)
-            if formatted_lines and formatted_lines[-1] != '':
-                formatted_lines.append('')
-            formatted_lines.append('━━━━━━━━━━━━━━━━━━━━')
-            # Check if header already contains bold formatting
-            if '*' in header_text:
-                formatted_lines.append(header_text)
-            else:
-                formatted_lines.append(f'*{header_text}*')
-            formatted_lines.append('━━━━━━━━━━━━━━━━━━━━')
-            prev_was_header = True
-            prev_was_list = False
-        elif stripped.startswith('# '):
-            # Main title
-            header_text = stripped[2:].strip()
-            header_text = convert_math_expressions(header_text)
-            if formatted_lines and formatted_lines[-1] != '':
-                formatted_lines.append('')
-            formatted_lines.append('━━━━━━━━━━━━━━━━━━━━')
-            # Check if header already contains bold formatting
-            if '*' in header_text:
-                formatted_lines.append(header_text)
-            else:
-                formatted_lines.append(f'*{header_text}*')
-            formatted_lines.append('━━━━━━━━━━━━━━━━━━━━')
-            prev_was_header = True
-            prev_was_list = False
-        
+            self._blank(out)
+            self._add(SECTION_RULE, out)
+            self._add(header_text if '*' in header_text else f'*{header_text}*', out)
+            self._add(SECTION_RULE, out)
+            self._prev_was_header = True
+            self._prev_was_list = False
+
         # Numbered lists
-        elif re.match(r'^\d+\.\s+', stripped):
-            match = re.match(r'^(\d+)\.\s+(.+)$', stripped)
+        elif _NUMBERED_START.match(stripped):
+            match = _NUMBERED_ITEM.match(stripped)
             if match:
-                list_num = match.group(1)
-                list_item = match.group(2)
-                list_item = convert_math_expressions(list_item)  # Convert LaTeX in list item
-                if not prev_was_list and formatted_lines and formatted_lines[-1] != '':
-                    formatted_lines.append('')
-                formatted_lines.append(f'  {list_num}. {list_item}')
-            prev_was_header = False
-            prev_was_list = True
-        
+                list_item = convert_math_expressions(match.group(2))
+                if not self._prev_was_list:
+                    self._blank(out)
+                self._add(f'  {match.group(1)}. {list_item}', out)
+            self._prev_was_header = False
+            self._prev_was_list = True
+
         # Bullet points
-        elif re.match(r'^[-*+]\s+', stripped):
-            list_item = re.sub(r'^[-*+]\s+', '', stripped)
-            list_item = convert_math_expressions(list_item)  # Convert LaTeX in list item
-            if not prev_was_list and formatted_lines and formatted_lines[-1] != '':
-                formatted_lines.append('')
-            formatted_lines.append(f'  • {list_item}')
-            prev_was_header = False
-            prev_was_list = True
-        
+        elif _BULLET_START.match(stripped):
+            list_item = convert_math_expressions(_BULLET_START.sub('', stripped))
+            if not self._prev_was_list:
+                self._blank(out)
+            self._add(f'  • {list_item}', out)
+            self._prev_was_header = False
+            self._prev_was_list = True
+
         # Regular text
         else:
             # Add spacing before new paragraphs if previous was header or list ended
-            if prev_was_header or (prev_was_list and not re.match(r'^[-*+\d]', stripped)):
-                if formatted_lines and formatted_lines[-1] != '':
-                    formatted_lines.append('')
-            
-            # Convert LaTeX in this line
+            if self._prev_was_header or (self._prev_was_list and not _LIST_LIKE_START.match(stripped)):
+                self._blank(out)
             formatted_line = convert_math_expressions(stripped)
-            
-            # Format inline code
-            formatted_line = re.sub(r'`([^`]+)`', r'[\1]', formatted_line)
-            
-            formatted_lines.append(formatted_line)
-            prev_was_header = False
-            prev_was_list = False
-    
-    # Join lines and clean up
-    text = '\n'.join(formatted_lines)
-    
-    # Remove any remaining ** markers (safety cleanup)
-    text = re.sub(r'\*\*', '', text)
-    
-    # Clean up excessive blank lines (max 2 consecutive)
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    
-    # Clean up leading/trailing whitespace
-    text = text.strip()
-    
-    return text
+            formatted_line = _INLINE_CODE.sub(r'[\1]', formatted_line)
+            self._add(formatted_line, out)
+            self._prev_was_header = False
+            self._prev_was_list = False
+
+    def _blank(self, out):
+        # A single separating blank line, never two in a row or at the start
+        if self._last_line is not None and self._last_line != '':
+            self._add('', out)
+
+    def _add(self, line, out):
+        self._last_line = line
+        # Remove any remaining ** markers (safety cleanup)
+        line = line.replace('**', '')
+        if not line.strip():
+            # Dropped if nothing follows; at the start strip() removes it anyway
+            if self._started:
+                self._held.append(line)
+            return
+        if self._held_content is not None:
+            self._emit(self._held_content, out)
+            self._held_content = None
+        blank_run = False
+        for held in self._held:
+            # Runs of blank lines collapse to one (the '\n{3,}' cleanup)
+            if held:
+                self._emit(held, out)
+                blank_run = False
+            elif not blank_run:
+                self._emit(held, out)
+                blank_run = True
+        self._held = []
+        if not self._started:
+            line = line.lstrip()
+            self._started = True
+        if line[-1].isspace():
+            # Would lose its trailing whitespace if it turns out to be the last line
+            self._held_content = line
+        else:
+            self._emit(line, out)
+
+    def _emit(self, line, out):
+        if self.for_answer:
+            if line.startswith(('📌', '•')) and self._last_emitted is not None and self._last_emitted != '':
+                # Ensure proper spacing between sections
+                out.append('')
+            line = _MULTIPLE_SPACES.sub(' ', line)
+        self._last_emitted = line
+        out.append(line)
+
+
+def format_markdown_to_whatsapp(text):
+    """
+    Convert Markdown to nicely formatted plain text suitable for WhatsApp.
+    Preserves structure and readability without markdown syntax.
+    """
+    if not text:
+        return text
+    formatter = StreamingFormatter(for_answer=False)
+    return '\n'.join(formatter.feed(text) + formatter.close())
 
 
 def format_answer_for_whatsapp(text):
@@ -177,19 +254,5 @@ def format_answer_for_whatsapp(text):
     """
     if not text:
         return text
-    
-    # Convert markdown to WhatsApp-friendly format
-    formatted = format_markdown_to_whatsapp(text)
-    
-    # Ensure proper spacing between sections
-    formatted = re.sub(r'\n([📌•])', r'\n\n\1', formatted)
-    formatted = re.sub(r'([📌•])\n', r'\1\n', formatted)
-    
-    # Clean up multiple spaces
-    formatted = re.sub(r' {2,}', ' ', formatted)
-    
-    # Ensure consistent line breaks
-    formatted = re.sub(r'\n{3,}', '\n\n', formatted)
-    
-    return formatted.strip()
-
+    formatter = StreamingFormatter()
+    return '\n'.join(formatter.feed(text) + formatter.close())
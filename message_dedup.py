@@ -0,0 +1,220 @@
+"""
+Webhook deduplication by provider message ID.
+Meta resends a webhook when our reply is slow and Twilio retries on the same
+MessageSid, so every incoming message ID is claimed before a job is queued.
+A second claim of the same ID within MESSAGE_DEDUP_TTL is a duplicate and is
+dropped without any OCR/LLM work.
+Two tiers: an in-process set with TTL, and an optional SQLite file
+(MESSAGE_DEDUP_DB) so duplicates are caught across uvicorn workers too.
+With SHARED_STATE_URL set, IDs are also claimed in the shared state, which
+covers workers on other nodes (see shared_state.py).
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from shared_state import async_twin, shared_state
+
+MESSAGE_DEDUP_ENABLED = os.getenv("MESSAGE_DEDUP_ENABLED", "1") == "1"
+MESSAGE_DEDUP_TTL = float(os.getenv("MESSAGE_DEDUP_TTL", str(24 * 3600)))
+MESSAGE_DEDUP_SIZE = int(os.getenv("MESSAGE_DEDUP_SIZE", "100000"))
+MESSAGE_DEDUP_DB = os.getenv("MESSAGE_DEDUP_DB")  # e.g. /var/cache/clearmydoubts/dedup.db
+
+
+class MemoryDedupStore:
+    """
+    In-process set of recently seen IDs, oldest first.
+    The TTL is the same for every entry, so expired IDs are always at the
+    front and are trimmed there; each claim is O(1) amortized.
+    """
+
+    def __init__(self, ttl=MESSAGE_DEDUP_TTL, max_size=MESSAGE_DEDUP_SIZE):
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """
+        Record key, return False if it was already seen within the TTL.
+        """
+        now = time.time()
+        with self._lock:
+            while self._seen:
+                oldest, expires_at = next(iter(self._seen.items()))
+                if expires_at >= now:
+                    break
+                del self._seen[oldest]
+            if key in self._seen:
+                return False
+            self._seen[key] = now + self.ttl
+            if len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def __len__(self):
+        return len(self._seen)
+
+
+class SqliteDedupStore:
+    """
+    Shared tier in a SQLite file (WAL mode). A claim is a single upsert on
+    the primary key, so two workers racing on the same ID cannot both win.
+    """
+
+    def __init__(self, path, ttl=MESSAGE_DEDUP_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen_messages ("
+            " key TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS seen_messages_expires ON seen_messages (expires_at)")
+        self._conn.commit()
+
+    def claim(self, key):
+        now = time.time()
+        with self._lock:
+            # Inserts a new ID, or takes over an expired one; otherwise changes nothing
+            cursor = self._conn.execute(
+                "INSERT INTO seen_messages (key, expires_at) VALUES (?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at"
+                " WHERE seen_messages.expires_at < ?",
+                (key, now + self.ttl, now)
+            )
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._conn.execute("DELETE FROM seen_messages WHERE expires_at < ?", (now,))
+            self._conn.commit()
+            return cursor.rowcount == 1
+
+    def release(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM seen_messages WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM seen_messages").fetchone()[0]
+
+
+class SharedDedupStore:
+    """
+    Tier in the shared state: a claim is a SET NX with the TTL.
+    """
+
+    def __init__(self, state, ttl=MESSAGE_DEDUP_TTL):
+        self.state = state
+        self.ttl = ttl
+
+    def claim(self, key):
+        return self.state.claim(f"dedup:{key}", self.ttl)
+
+    async def claim_async(self, key):
+        return await self.state.claim_async(f"dedup:{key}", self.ttl)
+
+    def release(self, key):
+        self.state.delete(f"dedup:{key}")
+
+    async def release_async(self, key):
+        await self.state.delete_async(f"dedup:{key}")
+
+
+class MessageDeduplicator:
+    """
+    Claims message IDs against each backend in order. The in-process tier
+    answers repeats seen by this worker without touching SQLite; the shared
+    tier decides for IDs first seen here.
+    """
+
+    def __init__(self, backends):
+        self.backends = list(backends)
+        self.accepted = 0
+        self.duplicates = {}
+
+    def claim(self, provider, message_id):
+        """
+        Return True if this message should be processed, False for a duplicate.
+        Messages without an ID can't be deduplicated and are always processed.
+        """
+        if not message_id:
+            return True
+        key = f"{provider}:{message_id}"
+        for backend in self.backends:
+            if not backend.claim(key):
+                self.duplicates[provider] = self.duplicates.get(provider, 0) + 1
+                return False
+        self.accepted += 1
+        return True
+
+    def release(self, provider, message_id):
+        """
+        Forget a claimed ID, e.g. when the job could not be queued and the
+        provider is asked to retry.
+        """
+        if not message_id:
+            return
+        key = f"{provider}:{message_id}"
+        for backend in self.backends:
+            backend.release(key)
+        self.accepted -= 1
+
+    async def claim_async(self, provider, message_id):
+        """
+        Async version of claim, for the webhook handlers: the shared tier
+        doesn't block the event loop.
+        """
+        if not message_id:
+            return True
+        key = f"{provider}:{message_id}"
+        for backend in self.backends:
+            if not await async_twin(backend, "claim", key):
+                self.duplicates[provider] = self.duplicates.get(provider, 0) + 1
+                return False
+        self.accepted += 1
+        return True
+
+    async def release_async(self, provider, message_id):
+        if not message_id:
+            return
+        key = f"{provider}:{message_id}"
+        for backend in self.backends:
+            await async_twin(backend, "release", key)
+        self.accepted -= 1
+
+    def stats(self):
+        return {
+            "enabled": MESSAGE_DEDUP_ENABLED,
+            "tiers": [type(backend).__name__ for backend in self.backends],
+            "accepted": self.accepted,
+            "duplicates_suppressed": sum(self.duplicates.values()),
+            "duplicates_by_provider": dict(self.duplicates),
+            "memory_entries": len(self.backends[0]) if self.backends else 0,
+        }
+
+
+def _build_default_deduplicator():
+    if not MESSAGE_DEDUP_ENABLED:
+        return MessageDeduplicator([])
+    backends = [MemoryDedupStore()]
+    if MESSAGE_DEDUP_DB:
+        try:
+            backends.append(SqliteDedupStore(MESSAGE_DEDUP_DB))
+        except sqlite3.Error as e:
+            print(f"Message dedup: SQLite tier disabled ({str(e)})")
+    if shared_state.distributed:
+        backends.append(SharedDedupStore(shared_state))
+    return MessageDeduplicator(backends)
+
+
+message_dedup = _build_default_deduplicator()
@@ -0,0 +1,209 @@
+"""
+Lightweight latency and error metrics for the answer pipeline.
+Each stage (download, OCR, embedding, RAG, LLM, formatting, send) is timed
+with `with span("stage", provider):`. Durations go into a sliding window per
+(stage, provider) for p50/p95/p99; errors and retries are counted. Everything
+is exported in Prometheus text format on /metrics, together with the
+counters the other modules already keep (job queue, caches, pools...).
+Recording is two perf_counter calls and a deque append, about a
+microsecond per span, which is noise next to any network call.
+"""
+import functools
+import inspect
+import os
+import re
+import time
+from collections import deque
+
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "2048"))  # samples kept per series for percentiles
+METRICS_PREFIX = "clearmydoubts"
+QUANTILES = (0.5, 0.95, 0.99)
+
+_NAME_UNSAFE = re.compile(r'[^a-zA-Z0-9_]')
+
+
+class _Series:
+    __slots__ = ("window", "count", "total", "max")
+
+    def __init__(self, window):
+        self.window = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.window.append(seconds)
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantiles(self):
+        values = sorted(self.window)
+        if not values:
+            return {q: 0.0 for q in QUANTILES}
+        return {q: values[min(len(values) - 1, int(q * len(values)))] for q in QUANTILES}
+
+
+class _Span:
+    # A plain class instead of @contextmanager: about 3x cheaper per use
+    __slots__ = ("metrics", "stage", "provider", "start")
+
+    def __init__(self, metrics, stage, provider):
+        self.metrics = metrics
+        self.stage = stage
+        self.provider = provider
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start, self.provider)
+        if exc is not None:
+            self.metrics.count_error(self.stage, self.provider, exc)
+        return False
+
+
+class Metrics:
+    """
+    Registry of stage latencies, error/retry counters and stats collectors.
+    """
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = max(1, window)
+        self.started = time.time()
+        self._latency = {}  # (stage, provider) -> _Series
+        self._errors = {}   # (stage, provider, error type) -> count
+        self._retries = {}  # (stage, provider) -> count
+        self._collectors = {}
+
+    def observe(self, stage, seconds, provider=""):
+        key = (stage, provider or "")
+        series = self._latency.get(key)
+        if series is None:
+            series = self._latency.setdefault(key, _Series(self.window))
+        series.add(seconds)
+
+    def count_error(self, stage, provider="", error=None):
+        key = (stage, provider or "", type(error).__name__ if error is not None else "error")
+        self._errors[key] = self._errors.get(key, 0) + 1
+
+    def count_retry(self, stage, provider=""):
+        key = (stage, provider or "")
+        self._retries[key] = self._retries.get(key, 0) + 1
+
+    def span(self, stage, provider=""):
+        """
+        Time a block. Exceptions are counted as errors of the stage and re-raised.
+        """
+        return _Span(self, stage, provider)
+
+    def register_collector(self, name, func):
+        """
+        Export the numeric values of func() (a possibly nested dict) as gauges
+        named <prefix>_<name>_<key path>.
+        """
+        self._collectors[name] = func
+
+    def latency_summary(self):
+        """
+        p50/p95/p99/max latency in ms per stage and provider, for /health.
+        """
+        summary = {}
+        for (stage, provider), series in sorted(self._latency.items()):
+            quantiles = series.quantiles()
+            summary.setdefault(stage, {})[provider or "all"] = {
+                "count": series.count,
+                "p50_ms": round(quantiles[0.5] * 1000, 1),
+                "p95_ms": round(quantiles[0.95] * 1000, 1),
+                "p99_ms": round(quantiles[0.99] * 1000, 1),
+                "max_ms": round(series.max * 1000, 1),
+            }
+        return summary
+
+    def render_prometheus(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        name = f"{METRICS_PREFIX}_stage_duration_seconds"
+        lines.append(f"# HELP {name} Latency of each pipeline stage (quantiles over the last {self.window} samples).")
+        lines.append(f"# TYPE {name} summary")
+        for (stage, provider), series in sorted(self._latency.items()):
+            labels = _labels(stage=stage, provider=provider)
+            for q, value in series.quantiles().items():
+                lines.append(f'{name}{{{labels},quantile="{q}"}} {value:.6f}')
+            lines.append(f"{name}_sum{{{labels}}} {series.total:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {series.count}")
+
+        name = f"{METRICS_PREFIX}_stage_errors_total"
+        lines.append(f"# HELP {name} Exceptions raised by each pipeline stage.")
+        lines.append(f"# TYPE {name} counter")
+        for (stage, provider, error), count in sorted(self._errors.items()):
+            lines.append(f"{name}{{{_labels(stage=stage, provider=provider, error=error)}}} {count}")
+
+        name = f"{METRICS_PREFIX}_retries_total"
+        lines.append(f"# HELP {name} Retried calls per stage.")
+        lines.append(f"# TYPE {name} counter")
+        for (stage, provider), count in sorted(self._retries.items()):
+            lines.append(f"{name}{{{_labels(stage=stage, provider=provider)}}} {count}")
+
+        lines.append(f"# TYPE {METRICS_PREFIX}_uptime_seconds gauge")
+        lines.append(f"{METRICS_PREFIX}_uptime_seconds {time.time() - self.started:.0f}")
+
+        for collector, func in sorted(self._collectors.items()):
+            try:
+                values = func()
+            except Exception as e:
+                print(f"Metrics collector {collector} failed: {str(e)}")
+                continue
+            for path, value in _flatten(values, [collector]):
+                gauge = f"{METRICS_PREFIX}_{'_'.join(path)}"
+                lines.append(f"# TYPE {gauge} gauge")
+                lines.append(f"{gauge} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(**labels):
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _flatten(values, path):
+    # Only numbers become gauges; booleans as 0/1, strings and lists are skipped
+    if isinstance(values, bool):
+        yield path, int(values)
+    elif isinstance(values, (int, float)):
+        yield path, values
+    elif isinstance(values, dict):
+        for key, value in values.items():
+            yield from _flatten(value, path + [_NAME_UNSAFE.sub("_", str(key)).strip("_").lower()])
+
+
+metrics = Metrics()
+span = metrics.span
+
+
+def timed(stage, provider=""):
+    """
+    Decorator recording every call of a function (sync or async) as a span.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with metrics.span(stage, provider):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.span(stage, provider):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
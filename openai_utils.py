@@ -4,111 +4,230 @@ Optimized for cost efficiency
 """
 import os
 import base64
-from io import BytesIO
-from PIL import Image
-from openai import OpenAI
-from prompts import ANSWER_PROMPT
-
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-
-def compress_image(img_bytes, max_size=(1024, 1024), quality=85):
-    """
-    Compress and resize image to reduce token usage.
-    Reduces image size before sending to OpenAI API.
-    """
-    try:
-        img = Image.open(BytesIO(img_bytes))
-        # Convert RGBA to RGB if needed
-        if img.mode == 'RGBA':
-            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-            rgb_img.paste(img, mask=img.split()[3])
-            img = rgb_img
-        # Resize if too large
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        # Compress
-        output = BytesIO()
-        img.save(output, format='JPEG', quality=quality, optimize=True)
-        return output.getvalue()
-    except Exception as e:
-        print(f"Image compression error: {e}, using original")
-        return img_bytes
+import time
+from openai import AsyncOpenAI, OpenAI
+from prompt_cache import answer_prompt_parts, openai_usage, prompt_cache_key, record_usage
+from embedding_cache import cached_embedding, cached_embeddings
+from image_cache import cached_extraction
+from embedding_batcher import EMBEDDING_BATCH_SIZE, EmbeddingBatcher, embed_in_chunks
+from resilience import call_async, call_sync
 
+# Initialize OpenAI clients (the async one is used by the FastAPI handlers)
+# Retries are done by resilience.py (with the circuit breaker), not by the SDK
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
+EMBEDDING_MODEL = "text-embedding-3-small"  # Cheaper than large, still high quality
+EMBEDDING_DIMENSIONS = 1536  # Match the Supabase vector column
+EMBEDDING_MAX_BATCH = 2048  # Inputs per embeddings request allowed by the API
+VISION_MODEL = "gpt-4o"  # GPT-4 Omni supports vision (best for OCR)
+ANSWER_MODEL = "gpt-4o-mini"  # Much cheaper than gpt-4o, still excellent quality
+EXTRACT_PROMPT = "Extract the handwritten question from this image. Clean it up. Only return the question:"
+
+
+def _embed_batch(texts):
+    response = call_sync(
+        "openai", client.embeddings.create,
+        model=EMBEDDING_MODEL,
+        input=list(texts),
+        dimensions=EMBEDDING_DIMENSIONS
+    )
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+async def _embed_batch_async(texts):
+    response = await call_async(
+        "openai", async_client.embeddings.create,
+        model=EMBEDDING_MODEL,
+        input=list(texts),
+        dimensions=EMBEDDING_DIMENSIONS
+    )
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+# Concurrent single-question embeddings are merged into one request
+embedding_batcher = EmbeddingBatcher(_embed_batch_async, max_batch=min(EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_BATCH))
+
+
+@cached_embedding("openai", EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
 def create_embedding(text):
     """
     Generate OpenAI embedding for the input text.
     Uses text-embedding-3-small with 1536 dimensions.
     This ensures compatibility with Supabase vector tables.
     """
-    response = client.embeddings.create(
-        model="text-embedding-3-small",  # Cheaper than large, still high quality
+    response = call_sync(
+        "openai", client.embeddings.create,
+        model=EMBEDDING_MODEL,
         input=text,
-        dimensions=1536  # Match Gemini's embedding dimension
+        dimensions=EMBEDDING_DIMENSIONS
     )
     return response.data[0].embedding
 
 
-def extract_question_from_image(img_bytes):
+@cached_embedding("openai", EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+async def create_embedding_async(text):
     """
-    Extract handwritten question from image using GPT-4 Vision.
-    Optimized: Compresses image before sending to reduce token usage.
+    Async version of create_embedding.
+    Concurrent calls are micro-batched into a single embeddings request.
+    """
+    return await embedding_batcher.embed(text)
+
+
+@cached_embeddings("openai", EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+def create_embeddings(texts):
+    """
+    Embed several texts, up to EMBEDDING_MAX_BATCH per request.
+    Returns vectors in input order.
+    """
+    texts = list(texts)
+    return [vector
+            for i in range(0, len(texts), EMBEDDING_MAX_BATCH)
+            for vector in _embed_batch(texts[i:i + EMBEDDING_MAX_BATCH])]
+
+
+@cached_embeddings("openai", EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+async def create_embeddings_async(texts):
+    """
+    Async version of create_embeddings.
+    """
+    return await embed_in_chunks(_embed_batch_async, texts, EMBEDDING_MAX_BATCH)
+
+
+def _extract_question_messages(compressed_img):
+    """
+    Build the vision request for a (compressed) image.
     """
-    # Compress image to reduce token usage
-    compressed_img = compress_image(img_bytes, max_size=(1024, 1024), quality=85)
-    
     # Convert image bytes to base64
     base64_image = base64.b64encode(compressed_img).decode('utf-8')
-    
-    response = client.chat.completions.create(
-        model="gpt-4o",  # GPT-4 Omni supports vision (best for OCR)
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Extract the handwritten question from this image. Clean it up. Only return the question:"
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}",
-                            "detail": "low"  # Use low detail to reduce tokens (sufficient for text extraction)
-                        }
+
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": EXTRACT_PROMPT
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{base64_image}",
+                        "detail": "low"  # Use low detail to reduce tokens (sufficient for text extraction)
                     }
-                ]
-            }
-        ],
+                }
+            ]
+        }
+    ]
+
+
+@cached_extraction()
+def extract_question_from_image(img_bytes):
+    """
+    Extract handwritten question from image using GPT-4 Vision.
+    Optimized: cached_extraction downscales and re-encodes the image first
+    to reduce token usage.
+    """
+    response = call_sync(
+        "openai", client.chat.completions.create,
+        model=VISION_MODEL,
+        messages=_extract_question_messages(img_bytes),
         max_tokens=300  # Reduced from 500 - questions are usually short
     )
     
     return response.choices[0].message.content.strip()
 
 
+@cached_extraction()
+async def extract_question_from_image_async(img_bytes):
+    """
+    Async version of extract_question_from_image.
+    Preprocessing is CPU-bound, so cached_extraction runs it in the image
+    worker processes.
+    """
+    response = await call_async(
+        "openai", async_client.chat.completions.create,
+        model=VISION_MODEL,
+        messages=_extract_question_messages(img_bytes),
+        max_tokens=300
+    )
+
+    return response.choices[0].message.content.strip()
+
+
+def _answer_messages(question, context):
+    # Static instructions first so the prompt prefix can be served from OpenAI's cache
+    instructions, prompt_input = answer_prompt_parts(question, context)
+    return [
+        {
+            "role": "system",
+            "content": instructions
+        },
+        {
+            "role": "user",
+            "content": prompt_input
+        }
+    ]
+
+
 def generate_answer(question, context):
     """
     Generate board-style answer using GPT-4o-mini (cheaper) with RAG context.
     GPT-4o-mini provides excellent quality at much lower cost.
     """
-    filled_prompt = ANSWER_PROMPT.format(question=question, context=context)
-    
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",  # Much cheaper than gpt-4o, still excellent quality
-        messages=[
-            {
-                "role": "system",
-                "content": "You are an expert CBSE board examiner for Class 10/12."
-            },
-            {
-                "role": "user",
-                "content": filled_prompt
-            }
-        ],
+    start = time.perf_counter()
+    response = call_sync(
+        "openai", client.chat.completions.create,
+        model=ANSWER_MODEL,
+        messages=_answer_messages(question, context),
         temperature=0.7,
-        max_tokens=1500  # Reduced from 2000 - sufficient for most answers
+        max_tokens=1500,  # Reduced from 2000 - sufficient for most answers
+        prompt_cache_key=prompt_cache_key(ANSWER_MODEL)
     )
+    record_usage("openai", *openai_usage(response.usage), time.perf_counter() - start)
     
     return response.choices[0].message.content.strip()
 
+
+async def generate_answer_async(question, context):
+    """
+    Async version of generate_answer.
+    """
+    start = time.perf_counter()
+    response = await call_async(
+        "openai", async_client.chat.completions.create,
+        model=ANSWER_MODEL,
+        messages=_answer_messages(question, context),
+        temperature=0.7,
+        max_tokens=1500,
+        prompt_cache_key=prompt_cache_key(ANSWER_MODEL)
+    )
+    record_usage("openai", *openai_usage(response.usage), time.perf_counter() - start)
+
+    return response.choices[0].message.content.strip()
+
+
+async def generate_answer_stream(question, context):
+    """
+    Streaming version of generate_answer: yields text deltas as they arrive.
+    """
+    start = time.perf_counter()
+    first_token = None
+    stream = await call_async(
+        "openai", async_client.chat.completions.create,
+        model=ANSWER_MODEL,
+        messages=_answer_messages(question, context),
+        temperature=0.7,
+        max_tokens=1500,
+        prompt_cache_key=prompt_cache_key(ANSWER_MODEL),
+        stream=True,
+        stream_options={"include_usage": True}  # usage arrives in a last chunk without choices
+    )
+
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            yield chunk.choices[0].delta.content
+        if getattr(chunk, "usage", None) is not None:
+            record_usage("openai", *openai_usage(chunk.usage), first_token)
@@ -0,0 +1,100 @@
+"""
+Prefix-cache-friendly answer prompts, and prompt-cache accounting.
+Providers reuse the work done on a prompt prefix they have seen recently,
+which cuts time-to-first-token and input cost, but only for an identical
+prefix. Answer prompts are therefore laid out static to dynamic: the
+instructions (the same for every request) first, as the system
+instruction, then the retrieved context, then the question.
+
+OpenAI caches prompt prefixes of 1024 tokens or more by itself; requests
+carry a prompt_cache_key so they are routed to machines holding the prefix.
+Gemini needs an explicit cached-content handle, created in gemini_utils
+when the instructions reach the model's minimum cacheable size.
+Both report how many prompt tokens came from the cache, which is recorded
+here per provider, with the answer latency of hits and misses.
+"""
+import hashlib
+import threading
+from prompts import ANSWER_INPUT_TEMPLATE, ANSWER_INSTRUCTIONS
+
+_stats = {}  # provider -> counters
+_lock = threading.Lock()
+
+
+def answer_prompt_parts(question, context):
+    """
+    (static instructions, dynamic input) for an answer prompt.
+    """
+    return ANSWER_INSTRUCTIONS, ANSWER_INPUT_TEMPLATE.format(context=context, question=question)
+
+
+def prompt_cache_key(model):
+    """
+    Stable key for requests sharing the answer instructions.
+    """
+    digest = hashlib.sha256(f"{model}\0{ANSWER_INSTRUCTIONS}".encode("utf-8")).hexdigest()
+    return f"answer-{digest[:16]}"
+
+
+def openai_usage(usage):
+    """
+    (prompt tokens, cached prompt tokens) from an OpenAI usage object.
+    """
+    if usage is None:
+        return None, None
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(usage, "prompt_tokens", None), getattr(details, "cached_tokens", None) or 0
+
+
+def gemini_usage(usage_metadata):
+    """
+    (prompt tokens, cached prompt tokens) from a Gemini usage_metadata.
+    """
+    if usage_metadata is None:
+        return None, None
+    return (getattr(usage_metadata, "prompt_token_count", None),
+            getattr(usage_metadata, "cached_content_token_count", None) or 0)
+
+
+def record_usage(provider, prompt_tokens, cached_tokens, seconds=None):
+    """
+    Count one answer request. `seconds` is the time to the first token
+    (the whole response when not streaming).
+    """
+    if prompt_tokens is None:
+        return
+    cached_tokens = cached_tokens or 0
+    hit = cached_tokens > 0
+    with _lock:
+        stats = _stats.setdefault(provider, {
+            "requests": 0, "cache_hits": 0, "prompt_tokens": 0, "cached_tokens": 0,
+            "hit_seconds": 0.0, "hit_timed": 0, "miss_seconds": 0.0, "miss_timed": 0,
+        })
+        stats["requests"] += 1
+        stats["cache_hits"] += hit
+        stats["prompt_tokens"] += prompt_tokens
+        stats["cached_tokens"] += cached_tokens
+        if seconds is not None:
+            kind = "hit" if hit else "miss"
+            stats[f"{kind}_seconds"] += seconds
+            stats[f"{kind}_timed"] += 1
+    print(f"{provider} prompt: {prompt_tokens} tokens, {cached_tokens} from cache"
+          + (f", first token after {seconds:.2f}s" if seconds is not None else ""))
+
+
+def prompt_cache_stats():
+    result = {}
+    with _lock:
+        for provider, stats in _stats.items():
+            result[provider] = {
+                "requests": stats["requests"],
+                "cache_hits": stats["cache_hits"],
+                "prompt_tokens": stats["prompt_tokens"],
+                "cached_tokens": stats["cached_tokens"],
+                "cached_token_share": round(stats["cached_tokens"] / max(1, stats["prompt_tokens"]), 4),
+                "latency_avg_s_cache_hit": round(stats["hit_seconds"] / stats["hit_timed"], 3)
+                if stats["hit_timed"] else None,
+                "latency_avg_s_cache_miss": round(stats["miss_seconds"] / stats["miss_timed"], 3)
+                if stats["miss_timed"] else None,
+            }
+    return result
@@ -0,0 +1,262 @@
+"""
+Latency-based routing between AI providers (AI_PROVIDER=auto).
+Every call is timed per (function, provider) over a rolling window. Each
+request goes to the healthy provider with the lowest expected latency
+(p50 scaled up by its recent error rate). If that call is still running
+after its p95, a hedged request goes to the next provider and the first
+answer wins; a failed call fails over to the next provider. Embeddings
+only go to providers whose vectors have the dimension of the RAG index,
+since a vector from another model can't be matched against it.
+"""
+import asyncio
+import os
+import random
+import time
+from collections import deque
+
+AI_ROUTER_DEFAULT = os.getenv("AI_ROUTER_DEFAULT", "gpt").lower()  # preferred until there are samples
+AI_ROUTER_WINDOW = int(os.getenv("AI_ROUTER_WINDOW", "200"))  # calls kept per function and provider
+AI_ROUTER_MIN_SAMPLES = int(os.getenv("AI_ROUTER_MIN_SAMPLES", "20"))
+AI_ROUTER_MAX_ERROR_RATE = float(os.getenv("AI_ROUTER_MAX_ERROR_RATE", "0.5"))  # above this a provider is unhealthy
+AI_ROUTER_EXPLORE = float(os.getenv("AI_ROUTER_EXPLORE", "0.05"))  # share of calls sent to another provider
+AI_HEDGE = os.getenv("AI_HEDGE", "1") == "1"
+# Vector size of the RAG index (the Supabase vector column, or the local index)
+RAG_EMBEDDING_DIMENSIONS = int(os.getenv("RAG_EMBEDDING_DIMENSIONS", "1536"))
+
+EMBEDDING_FUNCTIONS = ("create_embedding", "create_embeddings")
+
+
+class _CallStats:
+    __slots__ = ("latencies", "outcomes")
+
+    def __init__(self, window):
+        self.latencies = deque(maxlen=window)  # seconds of successful calls
+        self.outcomes = deque(maxlen=window)   # True for success
+
+    def record(self, seconds, ok):
+        if ok:
+            self.latencies.append(seconds)
+        self.outcomes.append(ok)
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def quantile(self, q):
+        values = sorted(self.latencies)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class ProviderRouter:
+    """
+    Routes calls to one of several providers. `providers` maps a provider
+    name to its functions dict (as returned by get_ai_functions) plus an
+    "embedding_dimensions" entry.
+    """
+
+    def __init__(self, providers, index_dimensions=RAG_EMBEDDING_DIMENSIONS, preferred=AI_ROUTER_DEFAULT,
+                 hedge=AI_HEDGE, window=AI_ROUTER_WINDOW, min_samples=AI_ROUTER_MIN_SAMPLES,
+                 max_error_rate=AI_ROUTER_MAX_ERROR_RATE, explore=AI_ROUTER_EXPLORE):
+        self.providers = providers
+        self.index_dimensions = index_dimensions
+        self.preferred = preferred
+        self.hedge = hedge
+        self.window = window
+        self.min_samples = max(1, min_samples)
+        self.max_error_rate = max_error_rate
+        self.explore = explore
+        self._stats = {}  # (function, provider) -> _CallStats
+        self._rng = random.Random()
+
+        # Counters
+        self.routed = {}  # (function, provider) -> calls sent there first
+        self.hedges = 0
+        self.hedges_won = 0
+        self.failovers = 0
+
+    def _stats_for(self, function, provider):
+        key = (function, provider)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = _CallStats(self.window)
+        return stats
+
+    def eligible(self, function):
+        """
+        Providers that can serve a function.
+        """
+        names = [name for name, funcs in self.providers.items() if function in funcs]
+        if function in EMBEDDING_FUNCTIONS:
+            names = [name for name in names
+                     if self.providers[name].get("embedding_dimensions") == self.index_dimensions]
+        return names
+
+    def _is_warm(self, stats):
+        return len(stats.outcomes) >= self.min_samples
+
+    def rank(self, function):
+        """
+        Eligible providers, best first: healthy before unhealthy, then by
+        expected latency. Providers without enough samples yet rank after
+        measured ones, except the preferred provider.
+        """
+        def key(name):
+            stats = self._stats_for(function, name)
+            warm = self._is_warm(stats)
+            error_rate = stats.error_rate()
+            healthy = not warm or error_rate <= self.max_error_rate
+            p50 = stats.quantile(0.5)
+            if not warm or p50 is None:
+                return (not healthy, name != self.preferred, 0.0)
+            return (not healthy, False, p50 / max(0.1, 1 - error_rate))
+
+        ranked = sorted(self.eligible(function), key=key)
+        if len(ranked) > 1 and self._rng.random() < self.explore:
+            # Keep the other providers' numbers fresh, so a recovered one gets traffic back
+            ranked.insert(0, ranked.pop(self._rng.randrange(1, len(ranked))))
+        return ranked
+
+    def _hedge_delay(self, function, provider):
+        stats = self._stats_for(function, provider)
+        if not self.hedge or not self._is_warm(stats):
+            return None
+        return stats.quantile(0.95)
+
+    async def _timed(self, function, provider, args, kwargs):
+        start = time.perf_counter()
+        try:
+            result = await self.providers[provider][function](*args, **kwargs)
+        except asyncio.CancelledError:
+            # The losing side of a hedge took at least this long
+            self._stats_for(function, provider).record(time.perf_counter() - start, True)
+            raise
+        except Exception:
+            self._stats_for(function, provider).record(time.perf_counter() - start, False)
+            raise
+        self._stats_for(function, provider).record(time.perf_counter() - start, True)
+        return result
+
+    async def call(self, function, *args, **kwargs):
+        """
+        Run an async provider function on the best provider, hedging and
+        failing over as configured. Raises the last error if all fail.
+        """
+        ranked = self.rank(function)
+        if not ranked:
+            raise RuntimeError(f"No provider available for {function}")
+        self.routed[(function, ranked[0])] = self.routed.get((function, ranked[0]), 0) + 1
+
+        pending = {}  # task -> provider
+        candidates = list(ranked)
+        error = None
+
+        def launch():
+            provider = candidates.pop(0)
+            task = asyncio.create_task(self._timed(function, provider, args, kwargs))
+            pending[task] = provider
+            return provider
+
+        primary = launch()
+        hedge_delay = self._hedge_delay(function, primary) if candidates else None
+        hedged = False
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Primary is slower than its p95: race the next provider
+                    hedge_delay = None
+                    hedged = True
+                    self.hedges += 1
+                    provider = launch()
+                    print(f"Hedging {function}: {primary} is slow, also asking {provider}")
+                    continue
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is None:
+                        if hedged and provider != primary:
+                            self.hedges_won += 1
+                        return task.result()
+                    error = task.exception()
+                    print(f"{function} failed on {provider}: {str(error)}")
+                if not pending and candidates:
+                    self.failovers += 1
+                    hedge_delay = None
+                    launch()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, function, *args, stats_function="generate_answer", **kwargs):
+        """
+        Route an async generator function. Streams aren't hedged (their text
+        can't be merged); a provider failing before its first chunk is
+        failed over. Timings count towards stats_function.
+        """
+        ranked = [name for name in self.rank(stats_function) if function in self.providers[name]]
+        error = None
+        for provider in ranked:
+            start = time.perf_counter()
+            started = False
+            try:
+                async for chunk in self.providers[provider][function](*args, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                self._stats_for(stats_function, provider).record(time.perf_counter() - start, False)
+                if started:
+                    raise
+                print(f"{function} failed on {provider}: {str(e)}")
+                error = e
+                self.failovers += 1
+                continue
+            self._stats_for(stats_function, provider).record(time.perf_counter() - start, True)
+            return
+        raise error or RuntimeError(f"No provider available for {function}")
+
+    def ai_functions(self, answer_model="auto"):
+        """
+        A functions dict shaped like get_ai_functions(), routed through this router.
+        """
+        def routed(function):
+            async def call(*args, **kwargs):
+                return await self.call(function, *args, **kwargs)
+            call.__name__ = function
+            return call
+
+        def streamed(function):
+            def stream(*args, **kwargs):
+                return self.stream(function, *args, **kwargs)
+            stream.__name__ = function
+            return stream
+
+        functions = {name: routed(name) for name in
+                     ("extract_question", "generate_answer", "create_embedding", "create_embeddings")}
+        functions["generate_answer_stream"] = streamed("generate_answer_stream")
+        functions["answer_model"] = answer_model
+        return functions
+
+    def stats(self):
+        functions = {}
+        for (function, provider), stats in sorted(self._stats.items()):
+            p50, p95 = stats.quantile(0.5), stats.quantile(0.95)
+            functions.setdefault(function, {})[provider] = {
+                "samples": len(stats.outcomes),
+                "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+                "error_rate": round(stats.error_rate(), 4),
+                "routed": self.routed.get((function, provider), 0),
+            }
+        return {
+            "providers": list(self.providers),
+            "index_dimensions": self.index_dimensions,
+            "hedge": self.hedge,
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "failovers": self.failovers,
+            "functions": functions,
+        }
@@ -0,0 +1,368 @@
+"""
+Retries, circuit breakers and deadlines for outbound calls.
+Every dependency (openai, gemini, supabase, graph, twilio) has a circuit
+breaker: after CIRCUIT_FAILURE_THRESHOLD consecutive failures it opens and
+calls fail fast with CircuitOpenError for CIRCUIT_RESET_SECONDS, then one
+probe call is let through (half-open) to see if it has recovered.
+Transient failures (connection errors, timeouts, 408/429/5xx) are retried
+with jittered exponential backoff, waiting at least as long as the
+server's Retry-After. A 429 or a call cut short by the request's own
+deadline doesn't count as a failure. A per-request deadline, set with deadline(), bounds
+the attempts and the backoff of every call made under it.
+"""
+import asyncio
+import contextvars
+import email.utils
+import functools
+import inspect
+import os
+import random
+import threading
+import time
+import httpx
+import openai
+import requests
+from metrics import metrics
+
+RESILIENCE_RETRIES = int(os.getenv("RESILIENCE_RETRIES", "3"))  # retries after the first attempt
+RESILIENCE_BACKOFF_BASE = float(os.getenv("RESILIENCE_BACKOFF_BASE", "0.25"))  # seconds
+RESILIENCE_BACKOFF_MAX = float(os.getenv("RESILIENCE_BACKOFF_MAX", "8"))
+RESILIENCE_RETRY_AFTER_MAX = float(os.getenv("RESILIENCE_RETRY_AFTER_MAX", "30"))  # longer waits are not worth it
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "120"))
+
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+TRANSIENT_ERRORS = (
+    httpx.TransportError,
+    openai.APIConnectionError,  # includes APITimeoutError
+    requests.ConnectionError,
+    requests.Timeout,
+    ConnectionError,
+    TimeoutError,
+)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised instead of calling a dependency whose circuit breaker is open.
+    """
+
+
+class DeadlineExceededError(TimeoutError):
+    """
+    Raised when the request deadline leaves no time for another attempt.
+    """
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after `failure_threshold` consecutive failures; open ->
+    half-open after `reset_seconds`; half-open lets one probe through and
+    closes on its success or reopens on its failure.
+    """
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+        # Counters
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        """
+        Whether a call may go ahead now.
+        """
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                print(f"Circuit {self.name} closed")
+            self.state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def release(self):
+        """
+        Give up a half-open probe that was cancelled before it finished.
+        """
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                if self.state == CLOSED:
+                    print(f"Circuit {self.name} opened after {self._failures} failures")
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self.opened += 1
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "open": self.state != CLOSED,
+            "consecutive_failures": self._failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(dependency):
+    breaker = _breakers.get(dependency)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(dependency, CircuitBreaker(dependency))
+    return breaker
+
+
+def breaker_stats():
+    return {name: breaker.stats() for name, breaker in sorted(_breakers.items())}
+
+
+# Absolute time.monotonic() deadline of the current request, inherited by tasks it starts
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+class deadline:
+    """
+    Context manager bounding every resilient call inside it to `seconds`
+    from now (or less, when nested in a shorter deadline).
+    """
+
+    def __init__(self, seconds=REQUEST_DEADLINE_SECONDS):
+        self.seconds = seconds
+
+    def __enter__(self):
+        expires = time.monotonic() + self.seconds
+        current = _deadline.get()
+        self._token = _deadline.set(expires if current is None else min(current, expires))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _deadline.reset(self._token)
+        return False
+
+
+def with_deadline(seconds=REQUEST_DEADLINE_SECONDS):
+    """
+    Decorator running an async function under deadline(seconds).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with deadline(seconds):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def time_left():
+    """
+    Seconds until the current deadline, or None without one.
+    """
+    expires = _deadline.get()
+    return None if expires is None else expires - time.monotonic()
+
+
+def status_code(error):
+    """
+    The HTTP status behind an exception, or None.
+    """
+    # httpx/requests errors carry the response; openai has status_code, Twilio's
+    # TwilioRestException an int status (and its own error code, e.g. 20429, as
+    # code), google api_core exceptions the HTTP status as code
+    for attr in ("status_code", "status", "code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int) and not isinstance(value, bool) and (attr != "code" or 100 <= value <= 599):
+            return value
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def is_retryable(error):
+    """
+    Transient errors worth retrying: connection problems, timeouts, 408/429/5xx.
+    """
+    if isinstance(error, (CircuitOpenError, DeadlineExceededError)):
+        return False
+    status = status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def retry_after(error):
+    """
+    The Retry-After of an error's response in seconds, or None.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, error=None):
+    """
+    Full-jitter exponential backoff, never shorter than the server's Retry-After.
+    """
+    delay = random.uniform(0, min(RESILIENCE_BACKOFF_MAX, RESILIENCE_BACKOFF_BASE * 2 ** attempt))
+    wait = retry_after(error) if error is not None else None
+    if wait is not None:
+        delay = wait + random.uniform(0, RESILIENCE_BACKOFF_BASE)
+    return delay
+
+
+def raise_for_retryable(response):
+    """
+    Raise for an httpx or requests response with a retryable status, so the
+    retry loop sees it; other statuses are left to the caller.
+    """
+    if response.status_code in RETRYABLE_STATUS:
+        response.raise_for_status()
+    return response
+
+
+def _next_delay(dependency, attempt, retries, error):
+    """
+    Seconds to wait before retrying after `error`, or None to give up.
+    """
+    if attempt >= retries or not is_retryable(error):
+        return None
+    delay = backoff_delay(attempt, error)
+    left = time_left()
+    if delay > RESILIENCE_RETRY_AFTER_MAX or (left is not None and delay >= left):
+        return None
+    metrics.count_retry(dependency)
+    message = str(error).splitlines()[0] if str(error) else ""
+    print(f"{dependency} call failed ({type(error).__name__}: {message}), retry {attempt + 1} in {delay:.2f}s")
+    return delay
+
+
+def _before_attempt(dependency, breaker):
+    if not breaker.allow():
+        raise CircuitOpenError(f"Circuit for {dependency} is open")
+    left = time_left()
+    if left is not None and left <= 0:
+        raise DeadlineExceededError(f"Request deadline passed before calling {dependency}")
+    return left
+
+
+def _record(breaker, error):
+    # Client errors (4xx) mean the dependency is up, so they don't trip the
+    # breaker; nor does a 429, which is throttling, not an outage (it is
+    # still retried)
+    if error is None or not is_retryable(error) or status_code(error) == 429:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+
+
+async def call_async(dependency, func, *args, retries=RESILIENCE_RETRIES, **kwargs):
+    """
+    Await func(*args, **kwargs) through the dependency's circuit breaker,
+    retrying transient errors within the current deadline.
+    """
+    breaker = get_breaker(dependency)
+    attempt = 0
+    while True:
+        left = _before_attempt(dependency, breaker)
+        try:
+            if left is None:
+                result = await func(*args, **kwargs)
+            else:
+                result = await asyncio.wait_for(func(*args, **kwargs), timeout=left)
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception as e:
+            if isinstance(e, TimeoutError) and left is not None and time_left() <= 0:
+                # The request ran out of time, which says nothing about the dependency
+                breaker.release()
+                raise DeadlineExceededError(f"Request deadline passed while calling {dependency}") from e
+            _record(breaker, e)
+            delay = _next_delay(dependency, attempt, retries, e)
+            if delay is None:
+                raise
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        _record(breaker, None)
+        return result
+
+
+def call_sync(dependency, func, *args, retries=RESILIENCE_RETRIES, **kwargs):
+    """
+    Blocking version of call_async. The deadline is checked between
+    attempts, but can't interrupt one already running.
+    """
+    breaker = get_breaker(dependency)
+    attempt = 0
+    while True:
+        _before_attempt(dependency, breaker)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            _record(breaker, e)
+            delay = _next_delay(dependency, attempt, retries, e)
+            if delay is None:
+                raise
+            attempt += 1
+            time.sleep(delay)
+            continue
+        _record(breaker, None)
+        return result
+
+
+def resilient(dependency, retries=RESILIENCE_RETRIES):
+    """
+    Decorator routing every call of a function (sync or async) through
+    call_async / call_sync.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                return await call_async(dependency, func, *args, retries=retries, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return call_sync(dependency, func, *args, retries=retries, **kwargs)
+        return wrapper
+
+    return decorator
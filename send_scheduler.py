@@ -0,0 +1,284 @@
+"""
+Pacing for outgoing WhatsApp messages.
+Meta and Twilio limit how fast one business number may send, and how fast
+messages may go to one user; bursts over those limits come back as 429s.
+Every chunk takes a token from the bucket of its sending number and of its
+recipient before it is posted. The chunks of a reply go out in order, and
+replies to the same recipient queue behind each other. Different
+recipients are served concurrently, up to SEND_MAX_CONCURRENCY posts at a
+time. A 429 pauses the recipient's bucket for the Retry-After (and the
+sending number's, unless the provider says only the recipient was
+limited), and the send is retried with backoff through resilience.py.
+Throttling only pauses the buckets: resilience.py doesn't count a 429
+against the provider's circuit breaker, so one throttled recipient can't
+open the circuit for every recipient on the number.
+With SHARED_STATE_URL set, the buckets live in the shared state, so all
+uvicorn workers draw from the same limits and see each other's pauses.
+"""
+import asyncio
+import os
+import threading
+import time
+from metrics import metrics
+from resilience import call_async, call_sync, retry_after, status_code
+from shared_state import shared_state
+
+SEND_NUMBER_RATE = float(os.getenv("SEND_NUMBER_RATE", "60"))  # messages/s per sending number
+SEND_NUMBER_BURST = float(os.getenv("SEND_NUMBER_BURST", "60"))
+SEND_RECIPIENT_RATE = float(os.getenv("SEND_RECIPIENT_RATE", "1"))  # messages/s to one user
+SEND_RECIPIENT_BURST = float(os.getenv("SEND_RECIPIENT_BURST", "5"))
+SEND_MAX_CONCURRENCY = int(os.getenv("SEND_MAX_CONCURRENCY", "32"))
+
+# Pause after a 429 without Retry-After
+DEFAULT_THROTTLE_PAUSE = 1.0
+# Idle, full recipient buckets are dropped once there are more than this many
+MAX_RECIPIENT_BUCKETS = 10000
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations: reserve() takes a token now
+    (going into debt if needed) and returns how long to wait before using
+    it, so concurrent callers are served in the order they asked.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = max(rate, 1e-9)
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def pause(self, seconds):
+        """
+        Hand out no tokens for `seconds` (after the provider throttled us).
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+    async def reserve_async(self):
+        return self.reserve()
+
+    async def pause_async(self, seconds):
+        self.pause(seconds)
+
+    def is_full(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens >= self.burst
+
+
+class SharedTokenBucket:
+    """
+    TokenBucket kept in the shared state under `key`.
+    """
+
+    def __init__(self, state, key, rate, burst):
+        self.state = state
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+
+    def reserve(self):
+        return self.state.reserve(self.key, self.rate, self.burst)
+
+    def pause(self, seconds):
+        self.state.pause(self.key, self.rate, self.burst, seconds)
+
+    async def reserve_async(self):
+        return await self.state.reserve_async(self.key, self.rate, self.burst)
+
+    async def pause_async(self, seconds):
+        await self.state.pause_async(self.key, self.rate, self.burst, seconds)
+
+    def is_full(self):
+        # The tokens are in the shared state; this handle can always be dropped
+        return True
+
+
+class SendScheduler:
+    """
+    Paces and orders chunk sends. `post_chunk(index, text)` posts one chunk
+    (index from 1) and returns False to drop the rest of the reply; a
+    throttled or failed post raises so it can be retried. With a shared
+    `state`, the token buckets are kept there.
+    """
+
+    def __init__(self, number_rate=SEND_NUMBER_RATE, number_burst=SEND_NUMBER_BURST,
+                 recipient_rate=SEND_RECIPIENT_RATE, recipient_burst=SEND_RECIPIENT_BURST,
+                 max_concurrency=SEND_MAX_CONCURRENCY, state=None):
+        self.number_rate = number_rate
+        self.number_burst = number_burst
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.max_concurrency = max(1, max_concurrency)
+        self.state = state
+        self._numbers = {}     # (dependency, sending number) -> TokenBucket
+        self._recipients = {}  # (dependency, recipient) -> TokenBucket
+        self._lanes = {}       # (dependency, recipient) -> [asyncio.Lock, users]
+        self._semaphore = None
+        self._loop = None
+        self._lock = threading.Lock()
+
+        # Counters
+        self.queued = 0  # chunks accepted but not sent yet
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.dropped = 0
+
+    def _bucket(self, kind, dependency, owner, rate, burst):
+        if self.state is not None:
+            return SharedTokenBucket(self.state, f"send:{dependency}:{kind}:{owner}", rate, burst)
+        return TokenBucket(rate, burst)
+
+    def _buckets(self, dependency, sender_id, to):
+        with self._lock:
+            number = self._numbers.get((dependency, sender_id))
+            if number is None:
+                number = self._numbers[(dependency, sender_id)] = self._bucket(
+                    "number", dependency, sender_id, self.number_rate, self.number_burst)
+            recipient = self._recipients.get((dependency, to))
+            if recipient is None:
+                if len(self._recipients) >= MAX_RECIPIENT_BUCKETS:
+                    self._recipients = {key: bucket for key, bucket in self._recipients.items()
+                                        if not bucket.is_full()}
+                recipient = self._recipients[(dependency, to)] = self._bucket(
+                    "recipient", dependency, to, self.recipient_rate, self.recipient_burst)
+        return number, recipient
+
+    def _to_pause(self, error, buckets, number_throttled):
+        """
+        The buckets a failed post should pause, and for how long.
+        """
+        if status_code(error) != 429:
+            return [], 0.0
+        self.throttled += 1
+        number, recipient = buckets
+        paused = [recipient]
+        if number_throttled is None or number_throttled(error):
+            paused.append(number)
+        return paused, retry_after(error) or DEFAULT_THROTTLE_PAUSE
+
+    def _get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # asyncio primitives belong to the loop they were first used on
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._lanes = {}
+        return self._semaphore
+
+    async def send(self, dependency, sender_id, to, chunks, post_chunk, number_throttled=None):
+        """
+        Send the chunks of one reply to `to`, in order, paced and retried.
+        `number_throttled(error)` tells whether a 429 applies to the whole
+        sending number; without it every 429 is treated that way.
+        """
+        semaphore = self._get_semaphore()
+        buckets = self._buckets(dependency, sender_id, to)
+        lane = self._lanes.setdefault((dependency, to), [asyncio.Lock(), 0])
+        lane[1] += 1
+        self.queued += len(chunks)
+        remaining = len(chunks)
+        try:
+            async with lane[0]:
+                for index, text in enumerate(chunks, start=1):
+                    queued_at = time.perf_counter()
+
+                    async def attempt():
+                        wait = max([await bucket.reserve_async() for bucket in buckets])
+                        if wait > 0:
+                            await asyncio.sleep(wait)
+                        async with semaphore:
+                            metrics.observe("send_wait", time.perf_counter() - queued_at, dependency)
+                            self.in_flight += 1
+                            start = time.perf_counter()
+                            try:
+                                return await post_chunk(index, text)
+                            except Exception as e:
+                                paused, seconds = self._to_pause(e, buckets, number_throttled)
+                                for bucket in paused:
+                                    await bucket.pause_async(seconds)
+                                raise
+                            finally:
+                                self.in_flight -= 1
+                                metrics.observe("send_chunk", time.perf_counter() - start, dependency)
+
+                    try:
+                        keep_going = await call_async(dependency, attempt)
+                    except Exception:
+                        self.failed += 1
+                        self.dropped += remaining - 1
+                        raise
+                    self.sent += 1
+                    self.queued -= 1
+                    remaining -= 1
+                    if keep_going is False:
+                        self.dropped += remaining
+                        break
+        finally:
+            self.queued -= remaining
+            lane[1] -= 1
+            if not lane[1]:
+                self._lanes.pop((dependency, to), None)
+
+    def send_sync(self, dependency, sender_id, to, chunks, post_chunk, number_throttled=None):
+        """
+        Blocking version of send, sharing the same rate limits.
+        """
+        buckets = self._buckets(dependency, sender_id, to)
+        for index, text in enumerate(chunks, start=1):
+            def attempt():
+                wait = max(bucket.reserve() for bucket in buckets)
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    return post_chunk(index, text)
+                except Exception as e:
+                    paused, seconds = self._to_pause(e, buckets, number_throttled)
+                    for bucket in paused:
+                        bucket.pause(seconds)
+                    raise
+
+            try:
+                keep_going = call_sync(dependency, attempt)
+            except Exception:
+                self.failed += 1
+                raise
+            self.sent += 1
+            if keep_going is False:
+                break
+
+    def stats(self):
+        return {
+            "queued_chunks": self.queued,
+            "in_flight": self.in_flight,
+            "active_recipients": len(self._lanes),
+            "sent": self.sent,
+            "failed": self.failed,
+            "throttled": self.throttled,
+            "dropped": self.dropped,
+            "number_rate": self.number_rate,
+            "recipient_rate": self.recipient_rate,
+            "max_concurrency": self.max_concurrency,
+            "shared_buckets": self.state is not None,
+        }
+
+
+# Shared by both WhatsApp providers
+send_scheduler = SendScheduler(state=shared_state if shared_state.distributed else None)
@@ -0,0 +1,552 @@
+"""
+State shared by all uvicorn workers: caches, idempotency keys, rate-limiter
+buckets and per-sender locks.
+Module globals live in one process, so with `uvicorn --workers N` (or
+several nodes) each worker had its own embedding cache, its own set of seen
+message IDs, its own send rate limits and its own idea of which sender is
+busy. With SHARED_STATE_URL pointing at a Redis-protocol server
+(redis-server, Valkey, KeyDB, Dragonfly) those live there instead:
+  - embedding_cache and image_cache get a shared tier,
+  - message_dedup claims message IDs there (SET NX),
+  - send_scheduler's token buckets are updated by a Lua script on the server,
+  - job_queue holds a per-sender lock while it runs a job, so the messages
+    of one sender still run one at a time across workers,
+  - the Gemini cached-content handle is created once for all workers.
+Without it everything stays in process (MemoryState), as with one worker.
+
+Every call has an *_async twin on a redis.asyncio client, used from the
+event loop; the blocking calls are for sync code paths and threads. If the
+server can't be reached, the "shared_state" circuit breaker opens and each
+call falls back to in-process state.
+
+Check a backend:
+    python shared_state.py check --url redis://localhost:6379/0
+    python shared_state.py check --fake    # fakeredis, no server needed
+"""
+import argparse
+import asyncio
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from resilience import get_breaker
+
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL")  # e.g. redis://localhost:6379/0
+SHARED_STATE_PREFIX = os.getenv("SHARED_STATE_PREFIX", "clearmydoubts:")
+SHARED_STATE_TIMEOUT = float(os.getenv("SHARED_STATE_TIMEOUT", "0.5"))  # socket timeout, seconds
+SENDER_LOCK_TTL = float(os.getenv("SENDER_LOCK_TTL", "180"))  # a lock left by a dead worker expires after this
+SENDER_LOCK_WAIT = float(os.getenv("SENDER_LOCK_WAIT", "150"))  # then the job runs without it
+
+# Polling interval while waiting for a lock held by another worker
+LOCK_POLL_MIN = 0.01
+LOCK_POLL_MAX = 0.25
+# Seconds between "shared state unavailable" messages
+ERROR_PRINT_INTERVAL = 30.0
+
+# Token bucket with reservations, as send_scheduler.TokenBucket. Uses the
+# server clock, so workers on different nodes agree on the refill.
+BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local pause = tonumber(ARGV[4])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate) - cost
+if pause > 0 then
+    tokens = math.min(tokens, -pause * rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+-- Gone once it would be full again
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+# Delete a lock only if this worker still holds it
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _to_bytes(value):
+    return value.encode("utf-8") if isinstance(value, str) else bytes(value)
+
+
+class _SharedState:
+    """
+    Locking on top of a backend's acquire(key, token, ttl) / release(key, token),
+    and *_async twins of every call. These run the blocking call directly,
+    which is right for in-process backends; RedisState overrides them.
+    """
+
+    distributed = False
+
+    def __init__(self):
+        self.locks = 0
+        self.lock_waits = 0
+        self.lock_wait_total = 0.0
+        self.lock_timeouts = 0
+
+    @asynccontextmanager
+    async def lock(self, key, ttl=SENDER_LOCK_TTL, wait=SENDER_LOCK_WAIT):
+        """
+        Hold `key` across workers. Waits up to `wait` seconds for another
+        holder, then goes ahead without the lock (yields False).
+        """
+        token = uuid.uuid4().hex
+        start = time.monotonic()
+        delay = LOCK_POLL_MIN
+        acquired = await self.acquire_async(key, token, ttl)
+        while not acquired and time.monotonic() - start < wait:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LOCK_POLL_MAX)
+            acquired = await self.acquire_async(key, token, ttl)
+        waited = time.monotonic() - start
+        self.locks += 1
+        if waited >= LOCK_POLL_MIN:
+            self.lock_waits += 1
+            self.lock_wait_total += waited
+        if not acquired:
+            self.lock_timeouts += 1
+            print(f"Shared state: lock {key} still held after {waited:.0f}s, going ahead without it")
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                await self.release_async(key, token)
+
+    async def get_async(self, key):
+        return self.get(key)
+
+    async def set_async(self, key, value, ttl=None):
+        self.set(key, value, ttl)
+
+    async def delete_async(self, key):
+        self.delete(key)
+
+    async def claim_async(self, key, ttl, value=b"1"):
+        return self.claim(key, ttl, value)
+
+    async def reserve_async(self, key, rate, burst, cost=1.0):
+        return self.reserve(key, rate, burst, cost)
+
+    async def pause_async(self, key, rate, burst, seconds):
+        self.pause(key, rate, burst, seconds)
+
+    async def acquire_async(self, key, token, ttl):
+        return self.acquire(key, token, ttl)
+
+    async def release_async(self, key, token):
+        self.release(key, token)
+
+    async def close_async(self):
+        pass
+
+    def stats(self):
+        return {
+            "backend": type(self).__name__,
+            "distributed": self.distributed,
+            "locks": self.locks,
+            "lock_waits": self.lock_waits,
+            "lock_wait_avg_ms": round(1000 * self.lock_wait_total / self.lock_waits, 2) if self.lock_waits else 0.0,
+            "lock_timeouts": self.lock_timeouts,
+        }
+
+
+class MemoryState(_SharedState):
+    """
+    In-process backend: a dict of (expires_at, value). Expired keys are
+    dropped when read, and swept every 1000 writes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._data = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _live(self, key, now):
+        item = self._data.get(key)
+        if item is not None and item[0] is not None and item[0] <= now:
+            del self._data[key]
+            return None
+        return item
+
+    def _put(self, key, value, ttl, now):
+        self._data[key] = (now + ttl if ttl else None, value)
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self._data = {k: item for k, item in self._data.items() if item[0] is None or item[0] > now}
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key, time.monotonic())
+            return item[1] if item is not None else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._put(key, _to_bytes(value), ttl, time.monotonic())
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def claim(self, key, ttl, value=b"1"):
+        """
+        Set key if it is absent; True if this call set it.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._live(key, now) is not None:
+                return False
+            self._put(key, _to_bytes(value), ttl, now)
+            return True
+
+    def _bucket(self, key, rate, burst, cost, pause):
+        now = time.monotonic()
+        with self._lock:
+            item = self._live(key, now)
+            tokens, updated = item[1] if item is not None else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate) - cost
+            if pause > 0:
+                tokens = min(tokens, -pause * rate)
+            self._put(key, (tokens, now), (burst - tokens) / rate + 1, now)
+            return 0.0 if tokens >= 0 else -tokens / rate
+
+    def reserve(self, key, rate, burst, cost=1.0):
+        """
+        Take `cost` tokens from the bucket at key (going into debt if
+        needed); returns how long to wait before using them.
+        """
+        return self._bucket(key, max(rate, 1e-9), max(1.0, burst), cost, 0.0)
+
+    def pause(self, key, rate, burst, seconds):
+        """
+        Hand out no tokens from the bucket at key for `seconds`.
+        """
+        self._bucket(key, max(rate, 1e-9), max(1.0, burst), 0.0, seconds)
+
+    def acquire(self, key, token, ttl):
+        return self.claim(key, ttl, token)
+
+    def release(self, key, token):
+        with self._lock:
+            item = self._live(key, time.monotonic())
+            if item is not None and item[1] == _to_bytes(token):
+                del self._data[key]
+
+    def stats(self):
+        return {**super().stats(), "keys": len(self._data)}
+
+
+class RedisState(_SharedState):
+    """
+    Backend on a Redis-protocol server. `client` may be any redis-py
+    compatible client (e.g. fakeredis.FakeRedis); otherwise one is made
+    from `url`. The *_async methods use a redis.asyncio client (or
+    `async_client`, e.g. fakeredis.FakeAsyncRedis), so they don't block the
+    event loop; with neither a url nor an async_client they run the blocking
+    call in a thread. Keys are namespaced with `prefix`.
+    """
+
+    distributed = True
+
+    def __init__(self, url=None, client=None, prefix=SHARED_STATE_PREFIX, timeout=SHARED_STATE_TIMEOUT,
+                 async_client=None):
+        super().__init__()
+        import redis
+        if client is None:
+            client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout,
+                                          health_check_interval=30)
+        self.url = url
+        self.client = client
+        self.prefix = prefix
+        self.timeout = timeout
+        self._errors = (redis.RedisError, OSError)
+        self._scripts = (client.register_script(BUCKET_SCRIPT), client.register_script(RELEASE_SCRIPT))
+        self._async_client = async_client
+        self._async_scripts = None
+        # Used while the server can't be reached
+        self._fallback = MemoryState()
+        self._breaker = get_breaker("shared_state")
+        self._last_error_print = 0.0
+        self.errors = 0
+        self.fallbacks = 0
+
+    def _command(self, operation, args):
+        """
+        (func(client, scripts), convert) for one operation. The same func
+        serves the blocking and the asyncio client.
+        """
+        key = self.prefix + args[0]
+        if operation == "get":
+            return lambda client, scripts: client.get(key), None
+        if operation == "set":
+            _, value, ttl = args
+            px = max(1, int(ttl * 1000)) if ttl else None
+            return lambda client, scripts: client.set(key, value, px=px), None
+        if operation == "delete":
+            return lambda client, scripts: client.delete(key), None
+        if operation == "claim":
+            _, ttl, value = args
+            px = max(1, int(ttl * 1000))
+            return lambda client, scripts: client.set(key, value, nx=True, px=px), bool
+        if operation in ("reserve", "pause"):
+            _, rate, burst, amount = args
+            cost, pause = (amount, 0) if operation == "reserve" else (0, amount)
+            script_args = [max(rate, 1e-9), max(1.0, burst), cost, pause]
+            return lambda client, scripts: scripts[0](keys=[key], args=script_args), float
+        if operation == "release":
+            token = args[1]
+            return lambda client, scripts: scripts[1](keys=[key], args=[token]), None
+        raise ValueError(f"Unknown shared state operation {operation}")
+
+    def _failed(self, operation, error):
+        self._breaker.record_failure()
+        self.errors += 1
+        if time.monotonic() - self._last_error_print > ERROR_PRINT_INTERVAL:
+            self._last_error_print = time.monotonic()
+            print(f"Shared state: {operation} failed ({type(error).__name__}: {str(error)}), "
+                  f"using in-process state")
+
+    def _call(self, operation, *args):
+        """
+        Run the operation on the server; on a server error (or with the
+        breaker open) run it on the in-process fallback.
+        """
+        if self._breaker.allow():
+            func, convert = self._command(operation, args)
+            try:
+                result = func(self.client, self._scripts)
+                self._breaker.record_success()
+                return convert(result) if convert else result
+            except self._errors as e:
+                self._failed(operation, e)
+        self.fallbacks += 1
+        return getattr(self._fallback, operation)(*args)
+
+    def _get_async_client(self):
+        if self._async_client is None and self.url:
+            import redis.asyncio
+            self._async_client = redis.asyncio.Redis.from_url(
+                self.url, socket_timeout=self.timeout, socket_connect_timeout=self.timeout,
+                health_check_interval=30)
+        if self._async_client is not None and self._async_scripts is None:
+            self._async_scripts = (self._async_client.register_script(BUCKET_SCRIPT),
+                                   self._async_client.register_script(RELEASE_SCRIPT))
+        return self._async_client
+
+    async def _call_async(self, operation, *args):
+        """
+        Async version of _call.
+        """
+        client = self._get_async_client()
+        if client is None:
+            return await asyncio.to_thread(self._call, operation, *args)
+        if self._breaker.allow():
+            func, convert = self._command(operation, args)
+            try:
+                result = await func(client, self._async_scripts)
+                self._breaker.record_success()
+                return convert(result) if convert else result
+            except asyncio.CancelledError:
+                self._breaker.release()
+                raise
+            except self._errors as e:
+                self._failed(operation, e)
+        self.fallbacks += 1
+        return getattr(self._fallback, operation)(*args)
+
+    def get(self, key):
+        return self._call("get", key)
+
+    async def get_async(self, key):
+        return await self._call_async("get", key)
+
+    def set(self, key, value, ttl=None):
+        self._call("set", key, value, ttl)
+
+    async def set_async(self, key, value, ttl=None):
+        await self._call_async("set", key, value, ttl)
+
+    def delete(self, key):
+        self._call("delete", key)
+
+    async def delete_async(self, key):
+        await self._call_async("delete", key)
+
+    def claim(self, key, ttl, value=b"1"):
+        return self._call("claim", key, ttl, value)
+
+    async def claim_async(self, key, ttl, value=b"1"):
+        return await self._call_async("claim", key, ttl, value)
+
+    def reserve(self, key, rate, burst, cost=1.0):
+        return self._call("reserve", key, rate, burst, cost)
+
+    async def reserve_async(self, key, rate, burst, cost=1.0):
+        return await self._call_async("reserve", key, rate, burst, cost)
+
+    def pause(self, key, rate, burst, seconds):
+        self._call("pause", key, rate, burst, seconds)
+
+    async def pause_async(self, key, rate, burst, seconds):
+        await self._call_async("pause", key, rate, burst, seconds)
+
+    def acquire(self, key, token, ttl):
+        return self.claim(key, ttl, token)
+
+    async def acquire_async(self, key, token, ttl):
+        return await self.claim_async(key, ttl, token)
+
+    def release(self, key, token):
+        self._call("release", key, token)
+
+    async def release_async(self, key, token):
+        await self._call_async("release", key, token)
+
+    async def close_async(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+            self._async_scripts = None
+
+    def stats(self):
+        return {
+            **super().stats(),
+            # Without the password
+            "url": re.sub(r"//[^@/]*@", "//", self.url) if self.url else None,
+            "errors": self.errors,
+            "fallbacks": self.fallbacks,
+        }
+
+
+def _build_default_state():
+    if not SHARED_STATE_URL:
+        return MemoryState()
+    try:
+        state = RedisState(SHARED_STATE_URL)
+    except ImportError as e:
+        print(f"Shared state: redis package unavailable ({str(e)}), state stays in process")
+        return MemoryState()
+    print(f"Shared state: {state.stats()['url']}")
+    return state
+
+
+shared_state = _build_default_state()
+
+
+async def async_twin(obj, name, *args):
+    """
+    await obj.<name>_async(*args) when obj has it (shared-state tiers),
+    else obj.<name>(*args) (in-process tiers).
+    """
+    method = getattr(obj, name + "_async", None)
+    if method is not None:
+        return await method(*args)
+    return getattr(obj, name)(*args)
+
+
+def sender_lock(sender):
+    """
+    Lock for one sender's jobs, for JobQueue(key_lock=...).
+    """
+    return shared_state.lock(f"sender:{sender}")
+
+
+def check(state, second):
+    """
+    Exercise a backend through two handles (two "workers") and time it.
+    Returns the list of failed checks.
+    """
+    failed = []
+
+    def expect(name, ok):
+        print(f"  {'ok  ' if ok else 'FAIL'} {name}")
+        if not ok:
+            failed.append(name)
+
+    run = uuid.uuid4().hex[:8]
+    state.set(f"check:{run}:cache", b"value", ttl=5)
+    expect("cache value seen by the other worker", second.get(f"check:{run}:cache") == b"value")
+    expect("idempotency key claimed once", state.claim(f"check:{run}:id", 5)
+           and not second.claim(f"check:{run}:id", 5))
+
+    waits = [state.reserve(f"check:{run}:bucket", 10, 2), second.reserve(f"check:{run}:bucket", 10, 2),
+             state.reserve(f"check:{run}:bucket", 10, 2)]
+    expect("rate-limit bucket shared (burst 2, third waits)", waits[:2] == [0.0, 0.0] and 0.05 < waits[2] <= 0.1)
+    second.pause(f"check:{run}:bucket", 10, 2, 1.0)
+    expect("pause applies to every worker", state.reserve(f"check:{run}:bucket", 10, 2) > 0.9)
+
+    async def locks():
+        order = []
+
+        async def job(handle, name):
+            async with handle.lock(f"check:{run}:sender", ttl=5, wait=5):
+                order.append(f"{name} start")
+                await asyncio.sleep(0.05)
+                order.append(f"{name} end")
+
+        await asyncio.gather(job(state, "a"), job(second, "b"))
+        claimed = [await state.claim_async(f"check:{run}:async-id", 5),
+                   await second.claim_async(f"check:{run}:async-id", 5)]
+        await state.close_async()
+        await second.close_async()
+        return order, claimed
+
+    order, claimed = asyncio.run(locks())
+    expect("per-sender lock serializes jobs", order in (["a start", "a end", "b start", "b end"],
+                                                        ["b start", "b end", "a start", "a end"]))
+    expect("async claim seen by the other worker", claimed == [True, False])
+
+    start = time.perf_counter()
+    for i in range(1000):
+        state.claim(f"check:{run}:bench:{i}", 5)
+    print(f"  claim latency: {1000 * (time.perf_counter() - start):.0f} us avg over 1000 calls")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the shared state backend")
+    sub = parser.add_subparsers(dest="command", required=True)
+    check_parser = sub.add_parser("check", help="Run cache, claim, bucket and lock checks against a backend")
+    check_parser.add_argument("--url", default=SHARED_STATE_URL, help="redis:// URL (default: SHARED_STATE_URL)")
+    check_parser.add_argument("--fake", action="store_true", help="use fakeredis instead of a server")
+    check_parser.add_argument("--memory", action="store_true", help="check the in-process backend")
+
+    args = parser.parse_args()
+    if args.memory or not (args.fake or args.url):
+        state = second = MemoryState()
+    elif args.fake:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        state = RedisState(client=fakeredis.FakeRedis(server=server),
+                           async_client=fakeredis.FakeAsyncRedis(server=server))
+        second = RedisState(client=fakeredis.FakeRedis(server=server),
+                            async_client=fakeredis.FakeAsyncRedis(server=server))
+    else:
+        state = RedisState(args.url)
+        second = RedisState(args.url)
+    print(f"Checking {type(state).__name__}" + (" (fakeredis)" if args.fake else ""))
+    failed = check(state, second)
+    if getattr(state, "errors", 0):
+        print(f"  {state.errors} server errors, see above")
+        failed.append("server errors")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    main()
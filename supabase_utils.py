@@ -1,19 +1,33 @@
 from supabase import create_client
+import asyncio
 import os
+from bm25 import RAG_HYBRID, RAG_HYBRID_CANDIDATES, fuse_rows, get_bm25_index
+from context_assembly import RAG_CONTEXT_ASSEMBLY, RAG_CONTEXT_CANDIDATES, assemble_context
+from http_clients import get_async_client, register_warmup_url
+from resilience import call_async, call_sync
 
-supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+
+supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+MATCH_FUNCTION = "match_cbse_context"
+MATCH_COUNT = 3
+
+# "supabase" (remote match_cbse_context RPC) or "local" (see local_index.py)
+RAG_BACKEND = os.getenv("RAG_BACKEND", "supabase").lower()
+
+if SUPABASE_URL and SUPABASE_KEY:
+    register_warmup_url("supabase", f"{SUPABASE_URL}/rest/v1/", {"apikey": SUPABASE_KEY})
 
-def fetch_rag_context(question_embedding):
-    response = supabase.rpc(
-        "match_cbse_context",
-        {
-            "query_embedding": question_embedding,
-            "match_count": 3
-        }
-    ).execute()
+
+def _rows_to_context(rows, question_embedding=None):
+    if RAG_CONTEXT_ASSEMBLY:
+        # Dedup, MMR and the token budget (see context_assembly.py)
+        return assemble_context(rows, question_embedding)
 
     chunks = []
-    for row in response.data or []:
+    for row in rows or []:
         if "content" in row:
             chunks.append(row["content"])
         else:
@@ -23,4 +37,94 @@ def fetch_rag_context(question_embedding):
                     chunks.append(row[key])
                     break
 
-    return "\n\n".join(chunks)
\ No newline at end of file
+    return "\n\n".join(chunks)
+
+
+# Rows kept for the context stage: context assembly chooses from more than it uses
+FUSED_COUNT = RAG_CONTEXT_CANDIDATES if RAG_CONTEXT_ASSEMBLY else MATCH_COUNT
+
+
+def _match_count(question):
+    # Hybrid retrieval over-fetches vector results so fusion has some to choose from
+    return max(FUSED_COUNT, RAG_HYBRID_CANDIDATES) if RAG_HYBRID and question else FUSED_COUNT
+
+
+def _lexical_rows(question):
+    try:
+        if RAG_BACKEND == "local":
+            from local_index import get_local_index
+            return get_bm25_index(get_local_index().chunks).match(question, RAG_HYBRID_CANDIDATES)
+        return get_bm25_index().match(question, RAG_HYBRID_CANDIDATES)
+    except Exception as e:
+        # Vector results alone are still a usable context
+        print(f"BM25 lookup failed ({type(e).__name__}: {str(e)}), using vector results only")
+        return []
+
+
+def _local_rows(question_embedding, question):
+    from local_index import get_local_index
+    index = get_local_index()
+    rows = index.match(question_embedding, _match_count(question))
+    if RAG_HYBRID and question:
+        rows = fuse_rows(rows, _lexical_rows(question), FUSED_COUNT)
+    if RAG_CONTEXT_ASSEMBLY:
+        # Lets MMR compare chunks by embedding rather than by their words
+        for row in rows:
+            row["embedding"] = index.embeddings[row["id"]]
+    return rows
+
+
+def fetch_rag_context(question_embedding, question=None):
+    """
+    Context for a question from its embedding. With RAG_HYBRID=1 and the
+    question text, vector and BM25 results are fused (see bm25.py). The
+    chunks are then deduplicated and packed within the token budget.
+    """
+    if RAG_BACKEND == "local":
+        return _rows_to_context(_local_rows(question_embedding, question), question_embedding)
+
+    response = call_sync("supabase", supabase.rpc(
+        MATCH_FUNCTION,
+        {
+            "query_embedding": question_embedding,
+            "match_count": _match_count(question)
+        }
+    ).execute)
+
+    rows = response.data
+    if RAG_HYBRID and question:
+        rows = fuse_rows(rows, _lexical_rows(question), FUSED_COUNT)
+    return _rows_to_context(rows, question_embedding)
+
+
+async def fetch_rag_context_async(question_embedding, question=None):
+    """
+    Async version of fetch_rag_context.
+    Calls the same RPC through PostgREST on the shared async HTTP client,
+    or searches the local index in a thread when RAG_BACKEND=local.
+    Failures are retried, and fail fast while the Supabase circuit is open.
+    The BM25 lookup for hybrid retrieval runs while the RPC is in flight.
+    """
+    if RAG_BACKEND == "local":
+        rows = await asyncio.to_thread(_local_rows, question_embedding, question)
+        return _rows_to_context(rows, question_embedding)
+
+    async def match():
+        response = await get_async_client("supabase").post(
+            f"{SUPABASE_URL}/rest/v1/rpc/{MATCH_FUNCTION}",
+            json={
+                "query_embedding": question_embedding,
+                "match_count": _match_count(question)
+            },
+            headers={
+                "apikey": SUPABASE_KEY,
+                "Authorization": f"Bearer {SUPABASE_KEY}"
+            }
+        )
+        response.raise_for_status()
+        return response.json()
+
+    if not (RAG_HYBRID and question):
+        return _rows_to_context(await call_async("supabase", match), question_embedding)
+    rows, lexical = await asyncio.gather(call_async("supabase", match), asyncio.to_thread(_lexical_rows, question))
+    return _rows_to_context(fuse_rows(rows, lexical, FUSED_COUNT), question_embedding)
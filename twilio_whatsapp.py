@@ -4,10 +4,23 @@ Twilio WhatsApp integration
 import os
 from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
+from http_clients import HTTP_TIMEOUT, get_async_client, get_session, register_warmup_url
+from resilience import call_async, call_sync, is_retryable, raise_for_retryable
+from send_scheduler import send_scheduler
 
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_WHATSAPP_FROM = os.getenv("TWILIO_WHATSAPP_FROM")  # Format: whatsapp:+14155238886
+TWILIO_API_BASE = os.getenv("TWILIO_API_BASE", "https://api.twilio.com/2010-04-01")
+MAX_MESSAGE_LEN = 1500  # Twilio limit is 1600, keep a buffer
+
+
+def _split_message(text):
+    return [text[i:i + MAX_MESSAGE_LEN] for i in range(0, len(text), MAX_MESSAGE_LEN)] or [text]
+
+
+if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
+    register_warmup_url("twilio", TWILIO_API_BASE)
 
 # Initialize Twilio client
 twilio_client = None
@@ -19,6 +32,8 @@ def send_whatsapp_message(to, message):
     """
     Send message via Twilio WhatsApp API.
     Twilio messages can be up to 1600 characters. Split long replies into chunks.
+    Chunks are paced by the send scheduler; rate limits and server errors are
+    retried, and raised if they persist.
     """
     if message is None:
         print("No message to send")
@@ -33,14 +48,13 @@ def send_whatsapp_message(to, message):
         return
 
     text = str(message)
-    max_len = 1500  # Twilio limit is 1600, keep a buffer
-    chunks = [text[i:i + max_len] for i in range(0, len(text), max_len)] or [text]
+    chunks = _split_message(text)
 
     # Ensure 'to' is in correct format (whatsapp:+countrycode+number)
     if not to.startswith("whatsapp:"):
         to = f"whatsapp:{to}"
 
-    for idx, part in enumerate(chunks, start=1):
+    def post_chunk(idx, part):
         try:
             message_obj = twilio_client.messages.create(
                 body=part,
@@ -48,10 +62,64 @@ def send_whatsapp_message(to, message):
                 to=to
             )
             print(f"Twilio WhatsApp response (chunk {idx}/{len(chunks)}): SID={message_obj.sid}, Status={message_obj.status}")
+            return True
         except Exception as e:
             print(f"Twilio WhatsApp error (chunk {idx}/{len(chunks)}): {str(e)}")
+            if is_retryable(e):
+                raise
+            # If the API returns an error, stop sending remaining chunks
+            return False
+
+    send_scheduler.send_sync("twilio", TWILIO_WHATSAPP_FROM, to, chunks, post_chunk)
+
+
+async def send_whatsapp_message_async(to, message):
+    """
+    Async version of send_whatsapp_message.
+    Posts to the Twilio Messages REST API on the shared HTTP client instead
+    of the blocking twilio.rest Client.
+    """
+    if message is None:
+        print("No message to send")
+        return
+
+    if not (TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN):
+        print("Twilio credentials not configured")
+        return
+
+    if not TWILIO_WHATSAPP_FROM:
+        print("TWILIO_WHATSAPP_FROM not configured")
+        return
+
+    chunks = _split_message(str(message))
+
+    # Ensure 'to' is in correct format (whatsapp:+countrycode+number)
+    if not to.startswith("whatsapp:"):
+        to = f"whatsapp:{to}"
+
+    url = f"{TWILIO_API_BASE}/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json"
+    client = get_async_client("twilio")
+
+    async def post_chunk(idx, part):
+        response = raise_for_retryable(await client.post(
+            url,
+            data={"Body": part, "From": TWILIO_WHATSAPP_FROM, "To": to},
+            auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+        ))
+        try:
+            resp_json = response.json()
+        except Exception:
+            resp_json = {}
+
+        if response.status_code >= 400:
+            print(f"Twilio WhatsApp error (chunk {idx}/{len(chunks)}): {response.status_code} {resp_json.get('message', '')}")
             # If the API returns an error, stop sending remaining chunks
-            break
+            return False
+
+        print(f"Twilio WhatsApp response (chunk {idx}/{len(chunks)}): SID={resp_json.get('sid')}, Status={resp_json.get('status')}")
+        return True
+
+    await send_scheduler.send("twilio", TWILIO_WHATSAPP_FROM, to, chunks, post_chunk)
 
 
 def download_media_from_twilio(media_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)):
@@ -59,10 +127,24 @@ def download_media_from_twilio(media_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_
     Download media file from Twilio.
     Twilio media URLs require Basic Auth with Account SID and Auth Token.
     """
-    import requests
-    response = requests.get(media_url, auth=auth)
-    response.raise_for_status()
-    return response.content
+    def download():
+        response = get_session("twilio").get(media_url, auth=auth, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response
+
+    return call_sync("twilio", download).content
+
+
+async def download_media_from_twilio_async(media_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)):
+    """
+    Async version of download_media_from_twilio.
+    """
+    async def download():
+        response = await get_async_client("twilio").get(media_url, auth=auth)
+        response.raise_for_status()
+        return response
+
+    return (await call_async("twilio", download)).content
 
 
 def create_twiml_response(message_text):
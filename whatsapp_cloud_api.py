@@ -2,17 +2,68 @@
 WhatsApp Cloud API integration (original implementation)
 Preserved for backward compatibility
 """
-import requests
 import os
+from http_clients import HTTP_TIMEOUT, get_async_client, get_session, register_warmup_url
+from resilience import call_async, call_sync, raise_for_retryable
+from send_scheduler import send_scheduler
 
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 PHONE_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
+GRAPH_API_BASE = os.getenv("GRAPH_API_BASE", "https://graph.facebook.com/v20.0")
+MAX_MESSAGE_LEN = 4000  # keep a buffer under 4096
+# Graph API throttling codes that limit the whole business number; others
+# (e.g. 131056, too many messages to one user) only concern that recipient
+NUMBER_RATE_LIMIT_CODES = {4, 80007, 130429}
+
+
+def _split_message(text):
+    return [text[i:i + MAX_MESSAGE_LEN] for i in range(0, len(text), MAX_MESSAGE_LEN)] or [text]
+
+
+def _auth_headers():
+    return {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
+
+
+if WHATSAPP_TOKEN and PHONE_ID:
+    register_warmup_url("graph", f"{GRAPH_API_BASE}/{PHONE_ID}", _auth_headers())
+
+
+def _message_body(to, part):
+    return {
+        "messaging_product": "whatsapp",
+        "to": to,
+        "text": {"body": part}
+    }
+
+
+def _handle_response(idx, total, response):
+    """
+    Log the API response for a chunk. Returns False to stop sending the rest.
+    """
+    try:
+        resp_json = response.json()
+    except Exception:
+        resp_json = {"error": "failed to parse response", "status": response.status_code}
+
+    print(f"WhatsApp Cloud API response (chunk {idx}/{total}):", resp_json)
+
+    # If the API returns an error, stop sending remaining chunks to avoid spam
+    return response.status_code < 400
+
+
+def _is_number_throttled(error):
+    try:
+        return error.response.json().get("error", {}).get("code") in NUMBER_RATE_LIMIT_CODES
+    except Exception:
+        return False
 
 
 def send_whatsapp_message(to, message):
     """
     Send message via WhatsApp Cloud API.
     WhatsApp text body must be <= 4096 chars. Split long replies into chunks.
+    Chunks are paced by the send scheduler; rate limits and server errors are
+    retried, and raised if they persist.
     """
     if message is None:
         print("No message to send")
@@ -23,32 +74,55 @@ def send_whatsapp_message(to, message):
         return
 
     text = str(message)
-    max_len = 4000  # keep a buffer under 4096
-    chunks = [text[i:i + max_len] for i in range(0, len(text), max_len)] or [text]
+    chunks = _split_message(text)
 
-    url = f"https://graph.facebook.com/v20.0/{PHONE_ID}/messages"
+    url = f"{GRAPH_API_BASE}/{PHONE_ID}/messages"
     headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
+        **_auth_headers(),
         "Content-Type": "application/json"
     }
 
-    for idx, part in enumerate(chunks, start=1):
-        data = {
-            "messaging_product": "whatsapp",
-            "to": to,
-            "text": {"body": part}
-        }
-        response = requests.post(url, json=data, headers=headers)
-        try:
-            resp_json = response.json()
-        except Exception:
-            resp_json = {"error": "failed to parse response", "status": response.status_code}
+    def post_chunk(idx, part):
+        response = get_session("graph").post(url, json=_message_body(to, part), headers=headers,
+                                             timeout=HTTP_TIMEOUT)
+        return _handle_response(idx, len(chunks), raise_for_retryable(response))
 
-        print(f"WhatsApp Cloud API response (chunk {idx}/{len(chunks)}):", resp_json)
+    send_scheduler.send_sync("graph", PHONE_ID, to, chunks, post_chunk, _is_number_throttled)
 
-        # If the API returns an error, stop sending remaining chunks to avoid spam
-        if response.status_code >= 400:
-            break
+
+async def send_whatsapp_message_async(to, message):
+    """
+    Async version of send_whatsapp_message, using the shared HTTP client.
+    """
+    if message is None:
+        print("No message to send")
+        return
+
+    if not WHATSAPP_TOKEN or not PHONE_ID:
+        print("WhatsApp Cloud API credentials not configured")
+        return
+
+    chunks = _split_message(str(message))
+    url = f"{GRAPH_API_BASE}/{PHONE_ID}/messages"
+    client = get_async_client("graph")
+
+    async def post_chunk(idx, part):
+        response = await client.post(url, json=_message_body(to, part), headers=_auth_headers())
+        return _handle_response(idx, len(chunks), raise_for_retryable(response))
+
+    await send_scheduler.send("graph", PHONE_ID, to, chunks, post_chunk, _is_number_throttled)
+
+
+def _get(url):
+    response = get_session("graph").get(url, headers=_auth_headers(), timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response
+
+
+async def _get_async(url):
+    response = await get_async_client("graph").get(url, headers=_auth_headers())
+    response.raise_for_status()
+    return response
 
 
 def get_media_url(media_id):
@@ -58,12 +132,8 @@ def get_media_url(media_id):
     if not WHATSAPP_TOKEN:
         raise ValueError("WhatsApp Cloud API token not configured")
     
-    media_url = f"https://graph.facebook.com/v20.0/{media_id}"
-    media_resp = requests.get(
-        media_url,
-        headers={"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
-    )
-    media_resp.raise_for_status()
+    media_url = f"{GRAPH_API_BASE}/{media_id}"
+    media_resp = call_sync("graph", _get, media_url)
     media_data = media_resp.json()
     return media_data["url"]
 
@@ -75,10 +145,28 @@ def download_media(file_url):
     if not WHATSAPP_TOKEN:
         raise ValueError("WhatsApp Cloud API token not configured")
     
-    img_resp = requests.get(
-        file_url,
-        headers={"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
-    )
-    img_resp.raise_for_status()
+    img_resp = call_sync("graph", _get, file_url)
+    return img_resp.content
+
+
+async def get_media_url_async(media_id):
+    """
+    Async version of get_media_url.
+    """
+    if not WHATSAPP_TOKEN:
+        raise ValueError("WhatsApp Cloud API token not configured")
+
+    media_resp = await call_async("graph", _get_async, f"{GRAPH_API_BASE}/{media_id}")
+    return media_resp.json()["url"]
+
+
+async def download_media_async(file_url):
+    """
+    Async version of download_media.
+    """
+    if not WHATSAPP_TOKEN:
+        raise ValueError("WhatsApp Cloud API token not configured")
+
+    img_resp = await call_async("graph", _get_async, file_url)
     return img_resp.content
 